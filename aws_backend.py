@@ -2,11 +2,17 @@
 
 # todo: move EFS mounting into userdata for things to happen in parallel
 # TODO: fix remote_fn must be absolute for uploading with check_with_existing
+import codecs
 import glob
 import os
+import queue
 import shlex
+import socket
 import sys
+import tarfile
+import threading
 import time
+import urllib.parse
 import datetime
 
 import backend
@@ -15,8 +21,19 @@ import util as u
 TASKDIR_PREFIX='/tmp/tasklogs'
 TIMEOUT_SEC=5
 MAX_RETRIES = 10
+MAX_EXEC_CHANNELS=8  # max concurrently open ssh exec channels per task
+UPLOAD_TAR_MIN_FILES=16  # send this many or more changed files as single tar
+UPLOAD_DELTA_BLOCK_SIZE=1<<20  # block size for delta uploads
+UPLOAD_INCREMENTAL_MIN_SIZE=8<<20  # by default single files this large or larger are uploaded incrementally
+BROADCAST_CHUNK_SIZE=1<<20  # chunk size used by Job.upload_broadcast
+BROADCAST_QUEUE_CHUNKS=16  # chunks buffered per task by upload_broadcast
+STREAM_CHUNK_SIZE=32768  # bytes read from exec channel at a time in stream_output
+RELAY_PORT=9876  # port for serving file to other tasks during relay upload
 DEFAULT_PORT=3000  # port used for task internal communication
 TENSORBOARD_PORT=6006  # port used for external HTTP communication
+USE_POLLING=False  # if True, Task.run detects completion by polling over SFTP
+WATCHER_SENTINEL='__task_done__'
+WATCHER_INTERVAL_SEC=0.05  # how often remote watcher checks for status file
 
 # TODO: a way to capture output of task.run. This could help with checking if umount is needed ('/dev/xdvf' in df)
 
@@ -32,6 +49,27 @@ def _strip_comment(cmd):
     return cmd
 
 
+def _make_watcher_cmd(tmux_cmd, status_fn, pid_fn):
+  """Makes shell command that runs tmux_cmd, then waits on the instance until
+  status_fn is non-empty and prints "<sentinel> <status> <elapsed_ms>". While
+  waiting, PID of the watcher shell is kept in pid_fn."""
+  return ("echo $$ > {pid_fn} && {tmux_cmd} && start=$(date +%s%N); "
+          "while [ ! -s {fn} ]; do sleep {interval}; done; rm -f {pid_fn}; "
+          "echo {sentinel} $(cat {fn}) $(( ($(date +%s%N)-start)/1000000 ))"
+          ).format(tmux_cmd=tmux_cmd, fn=status_fn, pid_fn=pid_fn,
+                   interval=WATCHER_INTERVAL_SEC, sentinel=WATCHER_SENTINEL)
+
+
+def _parse_watcher_output(output):
+  """Returns status, elapsed_ms from watcher output, or None, None if
+  sentinel line is missing."""
+  for line in reversed(output.strip().split('\n')):
+    toks = line.split()
+    if len(toks) == 3 and toks[0] == WATCHER_SENTINEL:
+      return toks[1], int(toks[2])
+  return None, None
+
+
 class Run(backend.Run):
   """In charge of creating resources and allocating instances. AWS instances
   are then wrapped in Job and Task objects."""
@@ -43,11 +81,20 @@ class Run(backend.Run):
     self.logdir_ = None   # set during setup_logdir()
     self.kwargs = kwargs
     self.jobs = []
+    self._instance_index = None  # set during make_job()
 
   @property
   def logdir(self):
     assert self.logdir_ is not None, "logdir not yet initialized"
     return self.logdir_
+
+  @property
+  def instance_index(self):
+    """Index of existing instances for all jobs of this run, shared
+    between make_job calls."""
+    if self._instance_index is None:
+      self._instance_index = u.InstanceIndex('*.'+self.name)
+    return self._instance_index
   
   # TODO: get rid of linux type (only login username)
   # move everything into kwargs
@@ -58,7 +105,7 @@ class Run(backend.Run):
 
     # TODO: document launch parameters
     job_name = u.format_job_name(role_name, self.name)
-    instances = u.lookup_aws_instances(job_name)
+    instances = u.lookup_aws_instances(job_name, index=self.instance_index)
     kwargs = u.merge_kwargs(kwargs, self.kwargs)
     ami = kwargs.get('ami', '')
     ami_name = kwargs.get('ami_name', '')
@@ -156,6 +203,9 @@ class Run(backend.Run):
               str(e), TIMEOUT_SEC))
             time.sleep(TIMEOUT_SEC)
 
+      # index no longer reflects instances of this run
+      self._instance_index = None
+
     job = Job(self, job_name, instances=instances,
               install_script=install_script,
               linux_type=linux_type,
@@ -181,13 +231,9 @@ class Run(backend.Run):
     assert head_task.initialized, "Head task not initialized, must wait_until_ready"
 
     # get list of all logdirs
-    find_command = f'find {backend.LOGDIR_PREFIX} -type d -maxdepth 1'
-    # TODO: get rid of find warning
-    #    find: warning: you have specified the -maxdepth option after a non-option argument -type, but options are not positional (-maxdepth affects tests specified befo
-    # re it as well as those specified after it).  Please specify options before other
-    # arguments.
-
-    logdir_ls = head_task.run_and_capture_output(find_command)
+    find_command = f'find {backend.LOGDIR_PREFIX} -maxdepth 1 -type d'
+    logdir_ls = set(head_task.run_and_capture_output(
+      find_command, session_env=False).split())
     new_logdir = f"{backend.LOGDIR_PREFIX}/{self.name}"
     # TODO: change logic to count backwards from 99 instead (with error
     # checking). Otherwise run clean-up will cause insertion of new runs into
@@ -238,6 +284,106 @@ class Job(backend.Job):
     for task in self.tasks:
       task._initialize()
 
+  def upload_broadcast(self, local_fn, remote_fn=None,
+                       max_workers=backend.MAX_WORKERS, relay=False):
+    """Uploads same file to every task. File is read locally once and each
+    chunk is streamed to up to max_workers tasks at the same time.
+
+    If relay, file is only sent to first task, remaining tasks fetch it
+    from the first task over private network. Use it when local uplink is
+    the bottleneck. Tasks must be able to reach each other on TCP
+    RELAY_PORT, which the security group made by create_resources.py allows
+    (all TCP within the group). Custom security groups need a rule for it."""
+    if remote_fn is None:
+      remote_fn = os.path.basename(local_fn)
+    if os.path.isdir(local_fn):
+      self._run.log("%s is a directory, using parallel upload"%(local_fn,))
+      return self.upload(local_fn, remote_fn, parallel=True,
+                         max_workers=max_workers)
+    assert os.path.isfile(local_fn), "%s is not a file"%(local_fn,)
+
+    start_time = time.time()
+    size = os.path.getsize(local_fn)
+    if relay and len(self.tasks) > 1:
+      _broadcast_file(self.tasks[:1], local_fn, remote_fn)
+      self._relay_file(remote_fn, max_workers)
+    else:
+      for i in range(0, len(self.tasks), max_workers):
+        _broadcast_file(self.tasks[i:i+max_workers], local_fn, remote_fn)
+
+    elapsed = time.time() - start_time
+    self._run.log("broadcast %s (%.1f MB) to %d tasks in %.1f sec, aggregate %.1f MB/s"%(
+      local_fn, size/1e6, len(self.tasks), elapsed,
+      size*len(self.tasks)/elapsed/1e6))
+
+  def _relay_file(self, remote_fn, max_workers):
+    """Serves remote_fn from first task over HTTP, fetches it on remaining
+    tasks. Only a temporary directory holding a link to remote_fn is served,
+    on the private address."""
+    head_task = self.tasks[0]
+    if not remote_fn.startswith('/'):
+      remote_fn = head_task.taskdir+'/'+remote_fn
+    dirname, basename = os.path.split(remote_fn)
+    stdout_bytes, _ = head_task.ssh.run('mktemp -d')
+    serve_dir = stdout_bytes.decode().strip()
+    assert serve_dir.startswith('/'), "mktemp failed on task %s"%(head_task.id,)
+    stdout_bytes, _ = head_task.ssh.run(
+      '(ln {fn} {serve_dir}/ 2>/dev/null || cp {fn} {serve_dir}/) && '
+      'cd {serve_dir} && (nohup python3 -m http.server {port} --bind {ip} '
+      '>/dev/null 2>&1 & echo $!)'.format(fn=shlex.quote(remote_fn),
+                                          serve_dir=shlex.quote(serve_dir),
+                                          port=RELAY_PORT, ip=head_task.ip))
+    server_pid = stdout_bytes.decode().strip()
+    url = 'http://%s:%d/%s'%(head_task.ip, RELAY_PORT,
+                             urllib.parse.quote(basename))
+
+    def fetch(task):
+      # server may take a moment to start listening
+      stdout_bytes, stderr_bytes = task.ssh.run(
+        'mkdir -p {dir} && wget -q --tries=10 --retry-connrefused -O {fn} {url}'
+        ' && echo ok'.format(dir=shlex.quote(dirname),
+                             fn=shlex.quote(remote_fn), url=shlex.quote(url)))
+      assert stdout_bytes.decode().strip() == 'ok', "Relay to task %s failed: %s"%(
+        task.id, stderr_bytes.decode())
+    try:
+      backend.parallel_map(fetch, self.tasks[1:], max_workers)
+    finally:
+      head_task.ssh.run('kill %s; rm -rf %s'%(server_pid,
+                                              shlex.quote(serve_dir)))
+
+
+def _broadcast_file(tasks, local_fn, remote_fn):
+  """Streams local file to remote_fn on all given tasks concurrently,
+  reading it once."""
+  queues = [queue.Queue(maxsize=BROADCAST_QUEUE_CHUNKS) for task in tasks]
+  errors = []
+
+  def writer(task, chunk_queue):
+    try:
+      with task.ssh.open(remote_fn, 'wb') as f:
+        f.set_pipelined(True)
+        for chunk in iter(chunk_queue.get, None):
+          f.write(chunk)
+          task.ssh.stats['bytes_sent'] += len(chunk)
+    except Exception as e:
+      task.log("broadcast upload failed with %s", e)
+      errors.append(e)
+      for chunk in iter(chunk_queue.get, None):  # keep reader unblocked
+        pass
+
+  threads = [threading.Thread(target=writer, args=(task, chunk_queue))
+             for task, chunk_queue in zip(tasks, queues)]
+  for thread in threads: thread.start()
+  with open(local_fn, 'rb') as f:
+    for chunk in iter(lambda: f.read(BROADCAST_CHUNK_SIZE), b''):
+      for chunk_queue in queues:
+        chunk_queue.put(chunk)
+  for chunk_queue in queues:
+    chunk_queue.put(None)
+  for thread in threads: thread.join()
+  if errors:
+    raise errors[0]
+
 
 class Task(backend.Task):
   # TODO: replace linux_type with username
@@ -254,6 +400,8 @@ class Task(backend.Task):
     self.user_data = user_data
     self.linux_type = linux_type
     self._run_counter = 0
+    self.last_run_timing = None  # timing of last sync run, set by watcher
+    self.last_upload_stats = None  # set by upload()
     self.cached_ip = None
     self.cached_public_ip = None
     self.skip_efs_mount = skip_efs_mount
@@ -316,45 +464,58 @@ class Task(backend.Task):
     # ignore error on remount
     self.run("sudo mount -t nfs -o nfsvers=4.1,rsize=1048576,wsize=1048576,hard,timeo=600,retrans=2 %s:/ /efs"%(dns,), ignore_errors=True) 
 
+  def _connect_ssh(self):
+    """Connects to the task, retrying until success."""
+    while True:
+      ssh_client = u.ssh_to_host(self.public_ip, self.keypair_fn,
+                                 self.username)
+      if ssh_client is None:
+        self.log("SSH into %s:%s failed, retrying in %d seconds" %(self.job.name, self.id,TIMEOUT_SEC))
+        time.sleep(TIMEOUT_SEC)
+      else:
+        return ssh_client
+
+  @property
+  def ssh_client(self):
+    """paramiko.SSHClient of the current connection."""
+    return self.ssh.client
+
   def _initialize(self):
     """Tries to initialize the task."""
 
     self.log("Running initialize")
     self.initialize_called = True
-    public_ip = self.public_ip # todo: add retry logic to public_ip property
-
-    while True:
-      self.ssh_client = u.ssh_to_host(self.public_ip, self.keypair_fn,
-                                      self.username)
-      if self.ssh_client is None:
-        self.log("SSH into %s:%s failed, retrying in %d seconds" %(self.job.name, self.id,TIMEOUT_SEC))
-        time.sleep(TIMEOUT_SEC)
-      else:
-        break
+    with self._timed_phase('connect'):
+      public_ip = self.public_ip # todo: add retry logic to public_ip property
+      self.ssh = u.SshSession(self._connect_ssh,
+                              max_channels=MAX_EXEC_CHANNELS)
 
     # todo: install tmux
-    self._setup_tmux()
-    self.run('mkdir -p '+self.remote_scratch)
+    with self._timed_phase('tmux'):
+      self._setup_tmux()
+      self.run('mkdir -p '+self.remote_scratch)
     if not self.skip_efs_mount:
-      self._mount_efs()
+      with self._timed_phase('efs'):
+        self._mount_efs()
 
     # run initialization commands here
-    if self._is_initialized_file_present():
-      self.log("reusing previous initialized state")
-    elif self.install_script:
-      self.log("running install script")
-
-      self.install_script+='\necho ok > /tmp/is_initialized\n'
-      self.file_write('install.sh', u._add_echo(self.install_script))
-      self.run('bash -e install.sh', max_wait_sec=2400) # fail on errors
-      # TODO(y): propagate error messages printed on console to the user
-      # right now had to log into tmux to see it
-      assert self._is_initialized_file_present()
-    else:
-      self.log('No install script. Skipping to end')
-      # installation happens through user-data instead of install script
-      # if neither one is passed, manually create is_initialized
-      self.run('echo ok > /tmp/is_initialized')
+    with self._timed_phase('install'):
+      if self._is_initialized_file_present():
+        self.log("reusing previous initialized state")
+      elif self.install_script:
+        self.log("running install script")
+
+        self.install_script+='\necho ok > /tmp/is_initialized\n'
+        self.file_write('install.sh', u._add_echo(self.install_script))
+        self.run('bash -e install.sh', max_wait_sec=2400) # fail on errors
+        # TODO(y): propagate error messages printed on console to the user
+        # right now had to log into tmux to see it
+        assert self._is_initialized_file_present()
+      else:
+        self.log('No install script. Skipping to end')
+        # installation happens through user-data instead of install script
+        # if neither one is passed, manually create is_initialized
+        self.run('echo ok > /tmp/is_initialized')
 
 
     self.connect_instructions = """
@@ -372,9 +533,10 @@ tmux a
   def wait_until_ready(self):
     if not self.initialize_called:
       self._initialize()
-    while not self._is_initialized_file_present():
-      self.log("wait_until_ready: Not initialized, retrying in %d seconds"%(TIMEOUT_SEC))
-      time.sleep(TIMEOUT_SEC)
+    with self._timed_phase('wait'):
+      while not self._is_initialized_file_present():
+        self.log("wait_until_ready: Not initialized, retrying in %d seconds"%(TIMEOUT_SEC))
+        time.sleep(TIMEOUT_SEC)
 
 
   # TODO: dedup with tmux_backend.py?
@@ -412,12 +574,19 @@ tmux a
     self.upload(source, target)
     
 
-  def upload(self, local_fn, remote_fn=None, skip_existing=False):
+  def upload(self, local_fn, remote_fn=None, skip_existing=False,
+             incremental=None, delta=False):
     """Uploads file to remote instance. If location not specified, dumps it
-    in default directory."""
-    # TODO: self.ssh_client is sometimes None
+    in default directory.
+
+    If incremental, compares sha1 of local files against remote copies and
+    only sends files that changed, many changed files are sent as a single
+    tar. Comparing costs an extra remote command, so by default it's only
+    done for directories and files of UPLOAD_INCREMENTAL_MIN_SIZE or more.
+    If delta, changed files that already exist remotely are patched in
+    UPLOAD_DELTA_BLOCK_SIZE blocks instead of being sent whole.
+    Statistics of last upload are saved in last_upload_stats."""
     self.log('uploading '+local_fn)
-    sftp = self.ssh_client.open_sftp()
     
     if remote_fn is None:
       remote_fn = os.path.basename(local_fn)
@@ -425,21 +594,118 @@ tmux a
       self.log("Remote file %s exists, skipping"%(remote_fn,))
       return
 
+    if incremental is None:
+      incremental = (os.path.isdir(local_fn) or
+                     os.path.getsize(local_fn) >= UPLOAD_INCREMENTAL_MIN_SIZE)
+    if incremental:
+      self._upload_incremental(local_fn, remote_fn, delta)
+    elif os.path.isdir(local_fn):
+      self.ssh.put_dir(local_fn, remote_fn)
+    else:
+      assert os.path.isfile(local_fn), "%s is not a file"%(local_fn,)
+      self.ssh.put(local_fn, remote_fn)
+
+  def _remote_sha1s(self, remote_fn):
+    """Returns {path: sha1} for remote file, or for all files under remote
+    directory."""
+    cmd = "find %s -type f -print0 2>/dev/null | xargs -0 -r sha1sum"%(
+      shlex.quote(remote_fn),)
+    stdout_bytes, stderr_bytes = self.ssh.run(cmd)
+    return u.parse_sha1sum_output(stdout_bytes.decode())
+
+  def _upload_incremental(self, local_fn, remote_fn, delta):
     if os.path.isdir(local_fn):
-      u.put_dir(sftp, local_fn, remote_fn)
+      remote_fn = remote_fn.rstrip('/')
+      relpaths = u.list_files(local_fn)
+      pairs = [(os.path.join(local_fn, rel), remote_fn+'/'+rel)
+               for rel in relpaths]
     else:
       assert os.path.isfile(local_fn), "%s is not a file"%(local_fn,)
-      sftp.put(local_fn, remote_fn)
+      relpaths = None
+      pairs = [(local_fn, remote_fn)]
+
+    remote_sha1s = self._remote_sha1s(remote_fn)
+    changed = [(local, remote) for local, remote in pairs
+               if remote_sha1s.get(remote) != u.file_sha1(local)]
+
+    bytes_total = sum(os.path.getsize(local) for local, remote in pairs)
+    bytes_sent = 0
+    full = []
+    for local, remote in changed:
+      if (delta and remote in remote_sha1s and
+          os.path.getsize(local) > UPLOAD_DELTA_BLOCK_SIZE):
+        bytes_sent += self._upload_delta(local, remote)
+      else:
+        full.append((local, remote))
+
+    if relpaths is not None and len(full) >= UPLOAD_TAR_MIN_FILES:
+      bytes_sent += self._upload_tar(local_fn, remote_fn, full)
+    elif full:
+      remote_dirs = set(os.path.dirname(remote) for local, remote in full)
+      remote_dirs.discard('')
+      if remote_dirs:
+        self.ssh.run('mkdir -p '+' '.join(shlex.quote(d) for d in
+                                          sorted(remote_dirs)))
+      for local, remote in full:
+        self.ssh.put(local, remote)
+        bytes_sent += os.path.getsize(local)
+
+    self.last_upload_stats = {'files': len(pairs),
+                              'files_sent': len(changed),
+                              'bytes_sent': bytes_sent,
+                              'bytes_saved': bytes_total - bytes_sent}
+    self.log("uploaded %d/%d files, sent %d bytes, saved %d bytes",
+             len(changed), len(pairs), bytes_sent, bytes_total - bytes_sent)
+
+  def _upload_tar(self, local_dir, remote_dir, pairs):
+    """Sends files from local_dir as single tar unpacked into remote_dir,
+    returns number of bytes sent."""
+    ts = str(u.now_micros())
+    tar_fn = self.scratch+'/upload.'+ts+'.tar'
+    remote_tar_fn = self.remote_scratch+'/upload.'+ts+'.tar'
+    with tarfile.open(tar_fn, 'w') as tar:
+      for local, remote in pairs:
+        tar.add(local, arcname=os.path.relpath(local, local_dir))
+    self.ssh.put(tar_fn, remote_tar_fn)
+    bytes_sent = os.path.getsize(tar_fn)
+    os.remove(tar_fn)
+    stdout_bytes, stderr_bytes = self.ssh.run(
+      'mkdir -p {dir} && tar -xf {tar} -C {dir} && rm {tar} && echo ok'.format(
+        dir=shlex.quote(remote_dir), tar=shlex.quote(remote_tar_fn)))
+    assert stdout_bytes.decode().strip() == 'ok', "Failed unpacking %s: %s"%(
+      remote_tar_fn, stderr_bytes.decode())
+    return bytes_sent
+
+  def _upload_delta(self, local_fn, remote_fn):
+    """Updates existing remote file by sending only blocks that differ,
+    returns number of bytes sent."""
+    block_size = UPLOAD_DELTA_BLOCK_SIZE
+    script = ("import hashlib,sys\n"
+              "f=open(sys.argv[1],'rb')\n"
+              "for b in iter(lambda: f.read(%d), b''):\n"
+              "  print(hashlib.sha1(b).hexdigest())\n")%(block_size,)
+    stdout_bytes, stderr_bytes = self.ssh.run('python3 -c %s %s'%(
+      shlex.quote(script), shlex.quote(remote_fn)))
+    remote_blocks = stdout_bytes.decode().split()
+    local_blocks = u.block_sha1s(local_fn, block_size)
+
+    blocks = []
+    with open(local_fn, 'rb') as f:
+      for i, sha1 in enumerate(local_blocks):
+        if i < len(remote_blocks) and remote_blocks[i] == sha1:
+          continue
+        f.seek(i*block_size)
+        blocks.append((i*block_size, f.read(block_size)))
+    self.ssh.write_blocks(remote_fn, blocks, os.path.getsize(local_fn))
+    return sum(len(data) for offset, data in blocks)
 
 
   def download(self, remote_fn, local_fn=None):
-    # TODO: self.ssh_client is sometimes None
     #    self.log("downloading %s"%(remote_fn))
-    sftp = self.ssh_client.open_sftp()
     if local_fn is None:
-      local_fn = os.path.basename(local_fn)
+      local_fn = os.path.basename(remote_fn)
       self.log("downloading %s to %s"%(remote_fn, local_fn))
-    sftp.get(remote_fn, local_fn)
+    self.ssh.get(remote_fn, local_fn)
 
 
   def file_exists(self, remote_fn):
@@ -447,28 +713,15 @@ tmux a
     if not remote_fn.startswith('/'):
       remote_fn = self.taskdir + '/'+remote_fn
     assert remote_fn.startswith('/'), "Remote fn must be absolute"
-    stdin, stdout, stderr = self.ssh_client.exec_command('stat '+remote_fn,
-                                                    get_pty=True)
-    stdout_bytes = stdout.read()
-    stdout_str = stdout_bytes.decode()  # AWS linux uses unicode quotes
-    stderr_bytes = stderr.read()
-    stderr_str = stderr_bytes.decode()
-    if 'No such file' in stdout_str:
-      return False
-    else:
-      return True
+    return self.ssh.exists(remote_fn)
   
   def file_write(self, remote_fn, contents):
-    tmp_fn = self.scratch+'/'+str(u.now_micros())
-    open(tmp_fn, 'w').write(contents)
-    self.upload(tmp_fn, remote_fn)
+    self.ssh.write(remote_fn, contents)
   
 
   def file_read(self, remote_fn):
     #    self.log("file_read")
-    tmp_fn = self.scratch+'/'+str(u.now_micros())
-    self.download(remote_fn, tmp_fn)
-    return open(tmp_fn).read()
+    return self.ssh.read(remote_fn).decode()
 
   def _run_ssh(self, cmd):
     """Runs given cmd in the task using current SSH session, returns
@@ -482,23 +735,66 @@ tmux a
     minimal dependencies (no tmux)
     """
     #    self.log("run_ssh: %s"%(cmd,))
-    stdin, stdout, stderr = self.ssh_client.exec_command(cmd, get_pty=True)
-    stdout_str = stdout.read().decode()
-    stderr_str = stderr.read().decode()
+    stdout_bytes, stderr_bytes = self.ssh.run(cmd, get_pty=True)
+    stdout_str = stdout_bytes.decode()
+    stderr_str = stderr_bytes.decode()
     # todo, line below always prints nothing
     if 'command not found' in stdout_str or 'command not found' in stderr_str:
       self.log(f"command ({cmd}) failed with ({stdout_str}), ({stderr_str})")
       assert False, "run_ssh command failed"
     return stdout_str, stderr_str
 
-  def run_and_capture_output(self, cmd, sync=True, ignore_errors=False):
-    assert '|' not in cmd, "don't support piping (since we append piping here)"
-    
-    ts = str(u.now_micros())
-    cmd_stdout_fn = self.remote_scratch+'/'+str(self._run_counter)+'.'+ts+'.out'
-    cmd = f'{cmd} | tee {cmd_stdout_fn}'
-    self.run(cmd, sync, ignore_errors)
-    return self.file_read(cmd_stdout_fn)
+  def stream_output(self, cmd, ignore_errors=False, max_wait_sec=600,
+                    session_env=True):
+    """Runs command in taskdir over a separate exec channel, yields lines of
+    its output as they arrive. Stdout and stderr are merged. Fails if
+    there's no output for max_wait_sec.
+
+    Command doesn't go through tmux. If session_env, it first sources
+    variables exported in the tmux session (ie, by conda activate in
+    earlier run calls), saving them costs a tmux run after such calls.
+
+    Once generator is exhausted, exit status is in last_run_status and
+    timings (time to first output, total time) in last_run_timing."""
+    self.log("exec> %s", cmd)
+    self.last_run_status = None
+    start_time = time.time()
+    first_output_ms = None
+    exec_cmd = 'cd %s && {\n%s\n}'%(shlex.quote(self.taskdir), cmd)
+    if session_env:
+      env_fn = self.remote_scratch+'/session.env'
+      self._save_session_env(env_fn)
+      exec_cmd = '. %s 2>/dev/null; %s'%(env_fn, exec_cmd)
+    with self.ssh.exec_command(exec_cmd, timeout=max_wait_sec) as (
+        stdin, stdout, stderr):
+      channel = stdout.channel
+      channel.set_combine_stderr(True)
+      decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+      partial_line = ''
+      try:
+        for data in iter(lambda: channel.recv(STREAM_CHUNK_SIZE), b''):
+          if first_output_ms is None:
+            first_output_ms = 1000*(time.time()-start_time)
+          self.ssh.stats['bytes_received'] += len(data)
+          lines = (partial_line + decoder.decode(data)).split('\n')
+          partial_line = lines.pop()
+          for line in lines:
+            yield line+'\n'
+        partial_line += decoder.decode(b'', final=True)
+        if partial_line:
+          yield partial_line
+        status = channel.recv_exit_status()
+      except socket.timeout:
+        assert False, "Timeout %s exceeded for %s" %(max_wait_sec, cmd)
+
+    self.last_run_status = status
+    self.last_run_timing = {'first_output_ms': first_output_ms,
+                            'local_ms': 1000*(time.time()-start_time)}
+    if status != 0:
+      if not ignore_errors:
+        assert False, "Command %s returned status %s"%(cmd, status)
+      else:
+        self.log("Warning: command %s returned status %s"%(cmd, status))
 
   # TODO: make run_tmux a proper first-class citizen
   def _run_raw(self, cmd):
@@ -507,9 +803,14 @@ tmux a
 
   # todo: transition to higher-level SshClient instead of paramiko.SSHClient
   def run(self, cmd, sync=True, ignore_errors=False,
-          max_wait_sec=600, check_interval=0.5):
+          max_wait_sec=600, check_interval=0.5, use_polling=None):
     """Runs command in tmux session. No need for multiple tmux sessions per
-    task, so assume tmux session/window is always called tmux:0"""
+    task, so assume tmux session/window is always called tmux:0
+
+    For sync commands, completion is detected by a watcher running on the
+    instance which reports exit status once the command is done, this costs
+    a single SSH round trip. If use_polling is True (or USE_POLLING is set
+    globally), falls back to polling status file over SFTP."""
 
     assert self._run_command_available, "Have you done wait_until_ready?"
     cmd = cmd.strip()
@@ -533,10 +834,54 @@ tmux a
     tmux_window = self._tmux_session_name+':0'
     tmux_cmd = "tmux send-keys -t {} {} Enter".format(tmux_window,
                                                         shlex.quote(modified_cmd))
-    self._run_ssh(tmux_cmd)
-    if not sync:
-      return
-    
+    if use_polling is None:
+      use_polling = USE_POLLING
+
+    if not sync or use_polling:
+      self._run_ssh(tmux_cmd)
+      if not sync:
+        return
+      contents = self._wait_for_status_poll(cmd, cmd_fn_out, max_wait_sec,
+                                            check_interval)
+    else:
+      contents = self._run_and_watch_status(cmd, tmux_cmd, cmd_fn_out,
+                                            max_wait_sec)
+
+    if contents != '0':
+      if not ignore_errors:
+        assert False, "Command %s returned status %s"%(cmd, contents)
+      else:
+        self.log("Warning: command %s returned status %s"%(cmd, contents))
+    return int(contents)
+
+  def _run_and_watch_status(self, cmd, tmux_cmd, cmd_fn_out, max_wait_sec):
+    """Sends tmux_cmd and waits for cmd_fn_out using a watcher loop running
+    on the instance. Watcher prints a sentinel line with exit status and
+    remote elapsed time in millis once the status file is written."""
+
+    pid_fn = cmd_fn_out+'.watcher_pid'
+    watcher_cmd = _make_watcher_cmd(tmux_cmd, cmd_fn_out, pid_fn)
+    start_time = time.time()
+    try:
+      stdout_bytes, stderr_bytes = self.ssh.run(watcher_cmd,
+                                                timeout=max_wait_sec)
+    except socket.timeout:
+      # closing the channel leaves the watcher loop running on the instance
+      self.ssh.run('kill $(cat {0}) 2>/dev/null; rm -f {0}'.format(pid_fn))
+      assert False, "Timeout %s exceeded for %s" %(max_wait_sec, cmd)
+
+    output = stdout_bytes.decode()
+    status, remote_ms = _parse_watcher_output(output)
+    assert status is not None, "Watcher for %s failed: (%s), (%s)"%(
+      cmd, output, stderr_bytes.decode())
+    self.last_run_timing = {'remote_ms': remote_ms,
+                            'local_ms': 1000*(time.time()-start_time)}
+    return status
+
+  def _wait_for_status_poll(self, cmd, cmd_fn_out, max_wait_sec,
+                            check_interval):
+    """Waits for cmd_fn_out to appear by polling over SFTP, returns its
+    contents."""
     start_time = time.time()
 
     while True:
@@ -551,33 +896,30 @@ tmux a
       # if empty wait a bit to allow for race condition
       if len(contents) == 0:
         time.sleep(check_interval)
-        contents = task.file_read(cmd_fn_out)
+        contents = self.file_read(cmd_fn_out)
 
-      contents = contents.strip()
-      if contents != '0':
-        if not ignore_errors:
-          assert False, "Command %s returned status %s"%(cmd, contents)
-        else:
-          self.log("Warning: command %s returned status %s"%(cmd, contents))
-      break
+      return contents.strip()
 
 
   def run_and_stream_output(self, cmd, sync):
     """Runs command on task and streams output locally on stderr."""
 
 
-    stdin, stdout, stderr = self.ssh_client.exec_command(cmd, get_pty=True)
-    # todo: add error handling, currently see this in stdout.readline()
-    # 'bash: asdfasdf: command not found\r\n'
-    if stdout:
-      t1 = u._StreamOutputToStdout(stdout)
-    if stderr:
-      t2 = u._StreamOutputToStdout(stderr)
-      
-    if stdout and sync:
-      t1.join()
-    if stderr and sync:
-      t2.join()    
+    def stream():
+      # streams (ie, tail -f) may never finish, so they don't take one of MAX_EXEC_CHANNELS
+      with self.ssh.exec_command(cmd, long_lived=True, get_pty=True) as (
+          stdin, stdout, stderr):
+        # todo: add error handling, currently see this in stdout.readline()
+        # 'bash: asdfasdf: command not found\r\n'
+        t1 = u._StreamOutputToStdout(stdout)
+        t2 = u._StreamOutputToStdout(stderr)
+        t1.join()
+        t2.join()
+
+    if sync:
+      stream()
+    else:
+      threading.Thread(target=stream, daemon=True).start()
 
 
   def stream_file(self, fn, sync=True):
@@ -2,9 +2,12 @@
 # Job launcher Python API: https://docs.google.com/document/d/1yTkb4IPJXOUaEWksQPCH7q0sjqHgBf3f70cWzfoFboc/edit
 # AWS job launcher (concepts): https://docs.google.com/document/d/1IbVn8_ckfVO3Z9gIiE0b9K3UrBRRiO9HYZvXSkPXGuw/edit
 
+import contextlib
 import os
 import glob
-import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 
 import util as u
 
@@ -12,6 +15,8 @@ import util as u
 # tmux_backend.py
 
 LOGDIR_PREFIX='/efs/runs'
+MAX_INIT_WORKERS=16  # max number of tasks initialized concurrently
+MAX_WORKERS=32  # max number of tasks receiving commands/uploads concurrently
 
 
 """
@@ -39,6 +44,58 @@ def set_global_logdir_prefix(logdir_prefix):
   global LOGDIR_PREFIX
   LOGDIR_PREFIX = logdir_prefix
 
+class ParallelError(Exception):
+  """Raised by parallel_map when some calls failed. results contains
+  per-item results in order, with exception objects in place of failed
+  calls, errors is the list of those exceptions."""
+
+  def __init__(self, results, errors):
+    super().__init__("%d/%d parallel calls failed, first error: %s"%(
+      len(errors), len(results), errors[0]))
+    self.results = results
+    self.errors = errors
+
+
+def parallel_map(fn, items, max_workers=MAX_WORKERS, fail_fast=True):
+  """Calls fn on every item concurrently using up to max_workers threads,
+  returns list of results in the same order as items.
+
+  If fail_fast, the first exception is re-raised as soon as it happens and
+  calls that haven't started yet are cancelled. Otherwise all calls run to
+  completion and ParallelError with all results is raised if any failed."""
+  items = list(items)
+  if not items:
+    return []
+  max_workers = max(1, min(max_workers, len(items)))
+  executor = ThreadPoolExecutor(max_workers=max_workers)
+  futures = [executor.submit(fn, item) for item in items]
+  try:
+    if fail_fast:
+      done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+      for future in futures:
+        if future in done and future.exception() is not None:
+          for pending in not_done:
+            pending.cancel()
+          raise future.exception()
+      return [future.result() for future in futures]
+
+    wait(futures)
+    results = []
+    errors = []
+    for future in futures:
+      e = future.exception()
+      if e is not None:
+        errors.append(e)
+        results.append(e)
+      else:
+        results.append(future.result())
+    if errors:
+      raise ParallelError(results, errors)
+    return results
+  finally:
+    executor.shutdown(wait=not fail_fast)
+
+
 # todo: rename to "start_run" instead of setup_run?
 def make_run(name):
   """Sets up "run" with given name, such as "training run"."""
@@ -63,9 +120,24 @@ class Run:
     raise NotImplementedError()
   
 
-  def run(self, *args, **kwargs):
-    """Runs command on every job in the run."""
-    
+  @property
+  def tasks(self):
+    """All tasks of all jobs in the run."""
+    return [task for job in self.jobs for task in job.tasks]
+
+  def parallel_map(self, task_fn, max_workers=MAX_WORKERS, fail_fast=True):
+    """Calls task_fn on every task of every job concurrently, returns
+    results in order of jobs and tasks. See backend.parallel_map."""
+    return parallel_map(task_fn, self.tasks, max_workers, fail_fast)
+
+  def run(self, *args, parallel=False, max_workers=MAX_WORKERS,
+          fail_fast=True, **kwargs):
+    """Runs command on every job in the run. If parallel, runs it on all
+    tasks at once and returns list of per-task exit statuses."""
+
+    if parallel:
+      return self.parallel_map(lambda t: t.run(*args, **kwargs),
+                               max_workers, fail_fast)
     for job in self.jobs:
       job.run(*args, **kwargs)
 
@@ -74,17 +146,25 @@ class Run:
 
     return self.jobs[0].run_and_capture_output(*args, **kwargs)
 
-  def _run_raw(self, *args, **kwargs):
+  def _run_raw(self, *args, parallel=False, max_workers=MAX_WORKERS,
+               fail_fast=True, **kwargs):
     """_run_raw on every job in the run."""
     
+    if parallel:
+      return self.parallel_map(lambda t: t._run_raw(*args, **kwargs),
+                               max_workers, fail_fast)
     for job in self.jobs:
       job._run_raw(*args, **kwargs)
 
       
-  def upload(self, *args, **kwargs):
+  def upload(self, *args, parallel=False, max_workers=MAX_WORKERS,
+             fail_fast=True, **kwargs):
     
-    """Runs command on every job in the run."""
+    """Uploads file to every task of every job in the run."""
     
+    if parallel:
+      return self.parallel_map(lambda t: t.upload(*args, **kwargs),
+                               max_workers, fail_fast)
     for job in self.jobs:
       job.upload(*args, **kwargs)
 
@@ -104,9 +184,19 @@ class Job:
   def run_async(self, cmd, *args, **kwargs):
     self.run(cmd, sync=False, *args, **kwargs)
     
-  def run(self, cmd, *args, **kwargs):
-    """Runs command on every task in the job."""
-
+  def parallel_map(self, task_fn, max_workers=MAX_WORKERS, fail_fast=True):
+    """Calls task_fn on every task concurrently, returns results in task
+    order. See backend.parallel_map."""
+    return parallel_map(task_fn, self.tasks, max_workers, fail_fast)
+
+  def run(self, cmd, *args, parallel=False, max_workers=MAX_WORKERS,
+          fail_fast=True, **kwargs):
+    """Runs command on every task in the job. If parallel, runs it on all
+    tasks at once and returns list of per-task exit statuses."""
+
+    if parallel:
+      return self.parallel_map(lambda t: t.run(cmd, *args, **kwargs),
+                               max_workers, fail_fast)
     for task in self.tasks:
       task.run(cmd, *args, **kwargs)
 
@@ -115,8 +205,12 @@ class Job:
 
     return self.tasks[0].run_and_capture_output(cmd, *args, **kwargs)
 
-  def _run_raw(self, *args, **kwargs):
+  def _run_raw(self, *args, parallel=False, max_workers=MAX_WORKERS,
+               fail_fast=True, **kwargs):
     """_run_raw on every task in the job."""
+    if parallel:
+      return self.parallel_map(lambda t: t._run_raw(*args, **kwargs),
+                               max_workers, fail_fast)
     for task in self.tasks:
       task._run_raw(*args, **kwargs)
 
@@ -125,36 +219,70 @@ class Job:
     def t_run_cmd(t): t.run(cmd, *args, **kwargs)
     self.async_join(t_run_cmd)
   
-  def upload(self, *args, **kwargs):
-    """Runs command on every task in the job."""
+  def upload(self, *args, parallel=False, max_workers=MAX_WORKERS,
+             fail_fast=True, **kwargs):
+    """Uploads file to every task in the job."""
     
+    if parallel:
+      return self.parallel_map(lambda t: t.upload(*args, **kwargs),
+                               max_workers, fail_fast)
     for task in self.tasks:
       task.upload(*args, **kwargs)
 
-  def upload_async(self, *args, **kwargs):
+  def upload_async(self, *args, broadcast=False, **kwargs):
+    """Uploads file to all tasks concurrently. If broadcast, uses
+    upload_broadcast which reads the file only once."""
+    if broadcast:
+      return self.upload_broadcast(*args, **kwargs)
     def t_upload(t): t.upload(*args, **kwargs)
     self.async_join(t_upload)
 
+  def upload_broadcast(self, local_fn, remote_fn=None,
+                       max_workers=MAX_WORKERS, **kwargs):
+    """Uploads same file to every task, reading it once. Backends that can't
+    stream to several tasks fall back on parallel upload."""
+    return self.upload(local_fn, remote_fn, parallel=True,
+                       max_workers=max_workers)
+
   def async_join(self, task_fn):
-    exceptions = []
-    def fn_wrapper(x): # Propagate exceptions to crash the main thread
-      try: task_fn(x)
-      except Exception as e: exceptions.append(e)
-    t_threads = [threading.Thread(name=f't_{i}', target=fn_wrapper, args=[t]) for i,t in enumerate(self.tasks)]
-    for thread in t_threads: thread.start()
-    for thread in t_threads: thread.join()
-    if exceptions: raise exceptions[0]
+    """Calls task_fn on every task in a separate thread, waits for all to
+    finish. First exception is propagated to the main thread."""
+    try:
+      parallel_map(task_fn, self.tasks, max_workers=len(self.tasks),
+                   fail_fast=False)
+    except ParallelError as e:
+      raise e.errors[0]
       
   # todo: rename to initialize
-  def wait_until_ready(self):
-    """Waits until all tasks in the job are available and initialized."""
-    # import threading
-    # t_threads = [threading.Thread(name=f't_{i}', target=lambda t: t.wait_until_ready(), args=[t]) for i,t in enumerate(self.tasks)]
-    # for thread in t_threads: thread.start()
-    # for thread in t_threads: thread.join()
+  def wait_until_ready(self, max_workers=MAX_INIT_WORKERS):
+    """Waits until all tasks in the job are available and initialized.
+
+    Tasks are initialized concurrently using up to max_workers threads. A
+    failing task doesn't interrupt initialization of other tasks, failures
+    are collected in self.init_failures {task_id: exception} and first one is
+    raised once all tasks are done."""
+    # todo: initialization should start async in constructor instead of here
+    self.init_failures = OrderedDict()
+    def init_task(task):
+      try:
+        task.wait_until_ready()
+      except Exception as e:
+        task.log("Initialization failed with %s", e)
+        self.init_failures[task.id] = e
+
+    max_workers = max(1, min(max_workers, len(self.tasks)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      list(executor.map(init_task, self.tasks))
+
     for task in self.tasks:
-      task.wait_until_ready()
-      # todo: initialization should start async in constructor instead of here
+      task.log_init_timings()
+    if self.init_failures:
+      failed_ids = ', '.join(str(i) for i in self.init_failures)
+      print("%s: %d/%d tasks failed to initialize (%s)"%(self.name,
+                                                       len(self.init_failures),
+                                                       len(self.tasks),
+                                                       failed_ids))
+      raise next(iter(self.init_failures.values()))
   
   # these methods redirect to the first task
   @property
@@ -187,8 +315,40 @@ class Job:
 
     
 class Task:
+  # {phase_name: seconds} for phases of initialization that were completed
+  init_timings = None
+  # exit status of last command run through stream_output
+  last_run_status = None
+  # _run_counter at the time session environment was last saved
+  _session_env_counter = None
+
+  def stream_output(self, cmd, ignore_errors=False, max_wait_sec=600,
+                    session_env=True):
+    """Runs command on given task outside of tmux, yields lines of its
+    output (stdout and stderr merged) as they arrive. Exit status is saved
+    in last_run_status once generator is exhausted.
+
+    If session_env, command sees variables exported in the tmux session,
+    ie by activating conda env with earlier run calls."""
+    raise NotImplementedError()
+
+  def _save_session_env(self, env_fn):
+    """Saves variables exported in the task's tmux shell into env_fn as
+    shell script, unless no commands went through tmux since last save."""
+    if self._session_env_counter != self._run_counter:
+      self.run('export -p > '+env_fn)
+      self._session_env_counter = self._run_counter
+
+  def run_and_capture_output(self, cmd, sync=True, ignore_errors=False,
+                             max_wait_sec=600, session_env=True):
+    """Runs command on given task, returns its output as string. Command
+    may contain pipes. See stream_output for session_env."""
+    assert sync, "run_and_capture_output only supports sync commands"
+    return ''.join(self.stream_output(cmd, ignore_errors, max_wait_sec,
+                                      session_env))
+
   def run(self, cmd, sync, ignore_errors):
-    """Runs command on given task."""
+    """Runs command on given task. For sync commands returns exit status."""
     raise NotImplementedError()    
 
   def _run_raw(self, cmd, sync, ignore_errors):
@@ -268,6 +428,26 @@ class Task:
 
     print("%s %d.%s: %s"%(ts, self.id, self.job.name, message))
 
+  @contextlib.contextmanager
+  def _timed_phase(self, name):
+    """Records time spent in the block as initialization phase name."""
+    if self.init_timings is None:
+      self.init_timings = OrderedDict()
+    start_time = time.time()
+    try:
+      yield
+    finally:
+      self.init_timings[name] = time.time() - start_time
+
+  def log_init_timings(self):
+    """Logs time taken by each initialization phase."""
+    if not self.init_timings:
+      return
+    total = sum(self.init_timings.values())
+    phases = ', '.join('%s %.1fs'%(name, sec) for name, sec in
+                       self.init_timings.items())
+    self.log("initialized in %.1fs (%s)", total, phases)
+
   def file_write(self, fn, contents):
     """Write string contents to file fn in task."""
     raise NotImplementedError()
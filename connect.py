@@ -54,24 +54,9 @@ def main():
   if not args.skip_tmux:
     print("Launching into TMUX session, use CTRL+b d to exit")
 
-  region = u.get_region()
-  client = u.create_ec2_client()
-  ec2 =u.create_ec2_resource()
-  response = client.describe_instances()
-
   username = os.environ.get("USERNAME", "ubuntu")
   print("Using username '%s'"%(username,))
     
-  instance_list = []
-  for instance in ec2.instances.all():
-    if instance.state['Name'] != 'running':
-      continue
-    
-    name = u.get_name(instance.tags)
-    if (fragment in name or fragment in instance.public_ip_address or
-        fragment in instance.id or fragment in instance.private_ip_address):
-      instance_list.append((u.toseconds(instance.launch_time), instance))
-      
   from tzlocal import get_localzone # $ pip install tzlocal
 
   filtered_instance_list = u.get_instances(fragment)
@@ -182,6 +182,7 @@ def network_setup():
         else:
           assert False, "Failed while authorizing ingress with "+str(e)
       
+  u.invalidate_resource_cache()
   return vpc, security_group
 
 
@@ -209,6 +210,7 @@ def keypair_setup():
   
   open(keypair_fn, 'w').write(keypair.key_material)
   os.system('chmod 400 '+keypair_fn)
+  u.invalidate_resource_cache()
   return keypair
 
 
@@ -228,6 +230,7 @@ def placement_group_setup(group_name):
   print("Creating group "+group_name)
   ec2 = u.create_ec2_resource()
   group = ec2.create_placement_group(GroupName=group_name, Strategy='cluster')
+  u.invalidate_resource_cache()
   return group
 
   
@@ -140,6 +140,8 @@ def main():
   if os.path.exists(keypair_fn):
     print("Deleting local keypair file %s" % (keypair_fn,))
     os.system('rm -f '+keypair_fn)
+
+  u.invalidate_resource_cache()
     
 
 
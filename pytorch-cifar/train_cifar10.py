@@ -36,6 +36,8 @@ def get_parser():
     parser.add_argument('--save-dir', type=str, default=Path.cwd(), help='Directory to save logs and models.')
     parser.add_argument('-j', '--workers', default=8, type=int, metavar='N',
                         help='number of data loading workers (default: 4)')
+    parser.add_argument('--torch-loader', action='store_true',
+                        help='Load data with DataLoader workers and PIL transforms instead of in-memory ArrayLoader')
     parser.add_argument('--momentum', default=0.9, type=float, metavar='M', help='momentum')
     parser.add_argument('--weight-decay', '--wd', default=5e-4, type=float,
                         metavar='W', help='weight decay (default: 1e-4)')
@@ -215,8 +217,8 @@ class DataPrefetcher():
             self.next_target = None
             return
         with torch.cuda.stream(self.stream):
-            self.next_input = self.next_input.cuda(async=True)
-            self.next_target = self.next_target.cuda(async=True)
+            self.next_input = self.next_input.cuda(non_blocking=True)
+            self.next_target = self.next_target.cuda(non_blocking=True)
 
     def __iter__(self):
         count = 0
@@ -233,6 +235,69 @@ class DataPrefetcher():
                 break
 
 
+# ### In-memory loader
+def array_loader(data_path, size, bs, val_bs=None, pad=4):
+    val_bs = val_bs or bs
+    train_dataset = datasets.CIFAR10(root=data_path, train=True, download=(args.local_rank==0))
+    val_dataset  = datasets.CIFAR10(root=data_path, train=False, download=(args.local_rank==0))
+    rank, world_size = (dist.get_rank(), dist.get_world_size()) if args.distributed else (0, 1)
+    train_loader = ArrayLoader(train_dataset.data, train_dataset.targets, bs, size=size, pad=pad, train=True,
+                               rank=rank, world_size=world_size)
+    val_loader = ArrayLoader(val_dataset.data, val_dataset.targets, val_bs)
+    return train_loader, val_loader
+
+class ArrayLoader():
+    """Serves normalized batches on GPU from a dataset held in memory as one uint8 NHWC array, no worker processes.
+    Train batches are shuffled, randomly cropped to size from reflect-padded images and flipped, all with batched
+    NumPy indexing over per-epoch permutation, crop offsets and flips drawn up front. Like DistributedSampler, each
+    rank serves an equal share of every epoch's permutation."""
+    mean = torch.tensor([0.4914, 0.4822, 0.4465]).view(1,3,1,1) * 255
+    std = torch.tensor([0.24703, 0.24349, 0.26159]).view(1,3,1,1) * 255
+
+    def __init__(self, data, targets, bs, size=32, pad=4, train=False, rank=0, world_size=1, seed=0):
+        self.data = np.pad(data, ((0, 0), (pad, pad), (pad, pad), (0, 0)), 'reflect') if train else data
+        self.targets = torch.tensor(targets, dtype=torch.int64)
+        self.bs, self.size, self.pad, self.train = bs, size, pad if train else 0, train
+        self.rank, self.world_size, self.seed = rank, world_size, seed
+        self.num_samples = -(-len(data) // world_size)
+        self.epoch = 0
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.mean, self.std = self.mean.to(self.device), self.std.to(self.device)
+
+    def __len__(self): return -(-self.num_samples // self.bs)
+
+    def epoch_indices(self):
+        "(sample indices, crop offsets, flips) of this rank for current epoch"
+        n = len(self.targets)
+        if not self.train: return np.arange(n), np.zeros((n, 2), np.int64), np.zeros(n, bool)
+        # permutation is shared by all ranks, augmentation differs
+        idx = np.random.RandomState([self.seed, self.epoch]).permutation(n)
+        idx = np.resize(idx, self.num_samples * self.world_size)[self.rank::self.world_size]
+        rng = np.random.RandomState([self.seed, self.epoch, self.rank + 1])
+        return idx, rng.randint(0, 2*self.pad + 1, (len(idx), 2)), rng.rand(len(idx)) < 0.5
+
+    def get_batch(self, idx, offsets, flips):
+        "crops flipped where flips is set, gathered as whole pixels in one take into uint8 NHWC batch"
+        if not self.train: return self.data[idx]
+        n, h, w, c = self.data.shape
+        crop = np.arange(self.size)
+        rows = offsets[:, 0:1] + crop
+        cols = offsets[:, 1:2] + np.where(flips[:, None], crop[::-1], crop)
+        pixels = (idx[:, None, None] * h + rows[:, :, None]) * w + cols[:, None, :]
+        return np.take(self.data.reshape(n*h*w, c), pixels, axis=0)
+
+    def __iter__(self):
+        idx, offsets, flips = self.epoch_indices()
+        self.epoch += 1
+        for start in range(0, len(idx), self.bs):
+            batch = slice(start, start + self.bs)
+            input = torch.from_numpy(self.get_batch(idx[batch], offsets[batch], flips[batch]))
+            target = self.targets[idx[batch]]
+            if self.device.type == 'cuda': input, target = input.pin_memory(), target.pin_memory()
+            input = input.to(self.device, non_blocking=True).permute(0, 3, 1, 2).contiguous().float()
+            yield (input - self.mean) / self.std, target.to(self.device, non_blocking=True)
+
+
 # ### Learning rate scheduler
 class Scheduler():
     def __init__(self, optimizer, phases=[(0,2e-1,15),(2e-1,1e-2,15),(1e-2,0,50)]):
@@ -484,7 +549,8 @@ def main():
 
 
     sz = 32
-    trn_loader, val_loader = torch_loader(args.data_path, sz, args.batch_size, args.batch_size*2)
+    get_loaders = torch_loader if args.torch_loader else array_loader
+    trn_loader, val_loader = get_loaders(args.data_path, sz, args.batch_size, args.batch_size*2)
 
     print(args)
     print('\n\n')
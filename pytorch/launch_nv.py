@@ -513,6 +513,9 @@ def create_job(run, job_name, num_tasks, env_name):
   # upload files
   job.upload_async('training/resnet.py')
   job.upload_async('training/fp16util.py')
+  job.upload_async('training/loss_scaler.py')
+  job.upload_async('training/metrics.py')
+  job.upload_async('training/grad_buckets.py')
   job.upload_async('training/autoaugment.py')
   job.upload_async('training/dataloader.py')
   job.upload_async('training/dataloader_performance.py')
@@ -1,5 +1,6 @@
 # Taken from https://github.com/DeepVoltaire/AutoAugment
 
+from functools import lru_cache
 from PIL import Image, ImageEnhance, ImageOps
 import numpy as np
 import random
@@ -178,7 +179,7 @@ class SubPolicy(object):
             "translateY": np.linspace(0, 150 / 331, 10),
             "rotate": np.linspace(0, 30, 10),
             "color": np.linspace(0.0, 0.9, 10),
-            "posterize": np.round(np.linspace(8, 4, 10), 0).astype(np.int),
+            "posterize": np.round(np.linspace(8, 4, 10), 0).astype(int),
             "solarize": np.linspace(256, 0, 10),
             "contrast": np.linspace(0.0, 0.9, 10),
             "sharpness": np.linspace(0.0, 0.9, 10),
@@ -226,6 +227,7 @@ class SubPolicy(object):
         #     operation1, ranges[operation1][magnitude_idx1],
         #     operation2, ranges[operation2][magnitude_idx2])
         self.p1 = p1
+        self.name1, self.name2 = operation1, operation2
         self.operation1 = func[operation1]
         self.magnitude1 = ranges[operation1][magnitude_idx1]
         self.p2 = p2
@@ -236,4 +238,196 @@ class SubPolicy(object):
     def __call__(self, img):
         if random.random() < self.p1: img = self.operation1(img, self.magnitude1)
         if random.random() < self.p2: img = self.operation2(img, self.magnitude2)
-        return img
\ No newline at end of file
+        return img
+
+class BatchPolicy(object):
+    """ Applies sub-policies of policy (e.g. ImageNetPolicy()) to a whole uint8 NCHW NumPy batch in place.
+
+        Every image draws its sub-policy and op probabilities as in SubPolicy, then each op runs once over all images
+        that drew it: LUTs for pixel-wise ops, vectorized blends for enhancements and affine warps for geometric ops.
+        Results follow PIL semantics (rounding, fill, resampling) of the per-image ops.
+
+        Example as BatchCollator transform:
+        >>> collate_fn = dataloader.BatchCollator(batch_tfms=[BatchPolicy(ImageNetPolicy())])
+    """
+    def __init__(self, policy, fillcolor=(128, 128, 128)):
+        self.policies = [(p.p1, p.name1, p.magnitude1, p.p2, p.name2, p.magnitude2) for p in policy.policies]
+        self.fill = np.array(fillcolor, dtype=np.uint8)
+
+    def __call__(self, batch):
+        # seeded from python random, which DataLoader reseeds in every worker
+        rng = np.random.RandomState(random.getrandbits(32))
+        policy_idx = rng.randint(len(self.policies), size=len(batch))
+        for stage in range(2):
+            applied = rng.random_sample(len(batch))
+            groups = {}
+            for idx, policy in enumerate(self.policies):
+                p, name, magnitude = policy[stage*3:stage*3+3]
+                ids = np.flatnonzero((policy_idx == idx) & (applied < p))
+                if len(ids): groups.setdefault((name, magnitude), []).append(ids)
+            for (name, magnitude), ids in groups.items():
+                ids = np.concatenate(ids)
+                signs = rng.choice([-1, 1], len(ids))
+                batch[ids] = batch_ops[name](batch[ids], magnitude, signs, self.fill)
+        return batch
+
+    def __repr__(self):
+        return "AutoAugment Batch Policy"
+
+
+def apply_lut(imgs, lut):
+    "lut of shape (256,), (N, 256) or (N, C, 256) applied to uint8 NCHW imgs, one image plane at a time to stay in cache"
+    n, c = imgs.shape[:2]
+    lut = np.clip(lut, 0, 255).astype(np.uint8)
+    lut = np.broadcast_to(lut.reshape(n, -1, 256) if lut.ndim > 1 else lut, (n, c, 256))
+    out = np.empty_like(imgs)
+    for i in range(n):
+        for j in range(c): np.take(lut[i, j], imgs[i, j], out=out[i, j])
+    return out
+
+
+def blend(degenerate, imgs, factors):
+    "Image.blend(degenerate, imgs, factor) truncated and clipped as in PIL, factor per image, float32 inputs"
+    imgs -= degenerate
+    imgs *= factors.astype(np.float32).reshape(-1, 1, 1, 1)
+    imgs += degenerate
+    return np.clip(imgs, 0, 255, out=imgs).astype(np.uint8)
+
+
+def grayscale(imgs):
+    "convert('L') of RGB NCHW imgs as float32, keeping channel dim"
+    r, g, b = (imgs[:, i:i+1] for i in range(3))
+    return ((r * np.uint32(19595) + g * np.uint32(38470) + b * np.uint32(7471) + 0x8000) >> 16).astype(np.float32)
+
+
+def smooth(imgs):
+    "ImageFilter.SMOOTH of float32 imgs: 3x3 kernel with center weight 5, border pixels are copied"
+    rows = imgs[:, :, :-2] + imgs[:, :, 1:-1] + imgs[:, :, 2:]
+    acc = rows[..., :-2] + rows[..., 1:-1] + rows[..., 2:] + 4 * imgs[:, :, 1:-1, 1:-1]
+    out = imgs.copy()
+    out[:, :, 1:-1, 1:-1] = np.floor((acc + 6.5) * np.float32(1 / 13))
+    return out
+
+
+def equalize_lut(imgs):
+    "(N, C, 256) luts of ImageOps.equalize"
+    n, c = imgs.shape[:2]
+    hist = np.stack([np.bincount(plane.reshape(-1), minlength=256) for plane in imgs.reshape(n*c, -1)])
+    last = hist[np.arange(n*c), 255 - np.argmax(hist[:, ::-1] > 0, axis=1)]
+    step = (hist.sum(1) - last) // 255
+    lut = (step[:, None] // 2 + np.cumsum(hist, 1) - hist) // np.maximum(step, 1)[:, None]
+    identity = ((hist > 0).sum(1) <= 1) | (step == 0)
+    lut[identity] = np.arange(256)
+    return lut.reshape(n, c, 256)
+
+
+def autocontrast_lut(imgs):
+    "(N, C, 256) luts of ImageOps.autocontrast"
+    lo, hi = imgs.min(axis=(2, 3)).astype(np.float64), imgs.max(axis=(2, 3)).astype(np.float64)
+    scale = 255.0 / np.maximum(hi - lo, 1)
+    lut = (np.arange(256) * scale[..., None] - (lo * scale)[..., None]).astype(np.int64)
+    return np.where((hi > lo)[..., None], lut, np.arange(256))
+
+
+def cubic_weights(d):
+    "weights of 4 taps around d in PIL's bicubic (a=-1) interpolation"
+    d2, d3 = d * d, d * d * d
+    return [-d + 2 * d2 - d3, 1 - 2 * d2 + d3, d + d2 - d3, d3 - d2]
+
+
+@lru_cache(maxsize=256)
+def warp_taps(matrix, h, w, bicubic):
+    """Flat input indices and weights of every output pixel for Image.transform(size, Image.AFFINE, matrix), taps
+    without weight anywhere are dropped (e.g. rows of shearX). Also returns mask of pixels mapped inside the image."""
+    a, b, c, d, e, f = matrix
+    ys, xs = np.mgrid[0:h, 0:w] + 0.5
+    x, y = (a * xs + b * ys + c).reshape(-1), (d * xs + e * ys + f).reshape(-1)
+    valid = (x >= 0) & (x < w) & (y >= 0) & (y < h)
+    if not bicubic:
+        idx = np.clip(np.floor(y), 0, h-1).astype(np.intp) * w + np.clip(np.floor(x), 0, w-1).astype(np.intp)
+        return [idx], None, valid
+    x0, y0 = np.floor(x - 0.5), np.floor(y - 0.5)
+    wx, wy = cubic_weights(x - 0.5 - x0), cubic_weights(y - 0.5 - y0)
+    idx, weights = [], []
+    for j in range(4):
+        for k in range(4):
+            weight = np.where(valid, wy[j] * wx[k], 0).astype(np.float32)
+            if not weight.any(): continue
+            idx.append(np.clip(y0 + j - 1, 0, h-1).astype(np.intp) * w + np.clip(x0 + k - 1, 0, w-1).astype(np.intp))
+            weights.append(weight)
+    return idx, weights, valid
+
+
+def warp(imgs, matrix, fill, bicubic=False):
+    "Image.transform(size, Image.AFFINE, matrix, resample, fillcolor) of all NCHW imgs, nearest or bicubic resampling"
+    n, c, h, w = imgs.shape
+    idx, weights, valid = warp_taps(tuple(matrix), h, w, bicubic)
+    flat = imgs.reshape(n, c, -1)
+    if weights is None: out = np.take(flat, idx[0], axis=2)
+    else:
+        acc = np.zeros(flat.shape, np.float32)
+        for i, weight in zip(idx, weights): acc += np.take(flat, i, axis=2) * weight
+        out = np.clip(acc, 0, 255, out=acc).astype(np.uint8)
+    out[:, :, ~valid] = fill[:, None]
+    return out.reshape(n, c, h, w)
+
+
+def warp_signed(imgs, signs, fill, matrix_fn, bicubic=False):
+    "warp with matrix_fn(sign), images grouped by their sign"
+    out = np.empty_like(imgs)
+    for sign in (-1, 1):
+        ids = signs == sign
+        if ids.any(): out[ids] = warp(imgs[ids], matrix_fn(sign), fill, bicubic)
+    return out
+
+
+def rotate_matrix(angle, size):
+    "matrix of Image.rotate(angle) around image center"
+    w, h = size
+    angle = -np.radians(angle)
+    a, b = round(np.cos(angle), 15), round(np.sin(angle), 15)
+    return (a, b, w/2 - a*w/2 - b*h/2, -b, a, h/2 + b*w/2 - a*h/2)
+
+
+def _sharpness(imgs, magnitude, signs, fill):
+    imgs = imgs.astype(np.float32)
+    return blend(smooth(imgs), imgs, 1 + magnitude * signs)
+
+
+def _contrast(imgs, magnitude, signs, fill):
+    mean = np.floor(grayscale(imgs).mean(axis=(1, 2, 3)) + 0.5).astype(np.float32)[:, None]
+    factors = (1 + magnitude * signs).astype(np.float32)[:, None]
+    return apply_lut(imgs, np.floor(mean + factors * (np.arange(256, dtype=np.float32) - mean)))
+
+
+def _brightness(imgs, magnitude, signs, fill):
+    factors = (1 + magnitude * signs).astype(np.float32)[:, None]
+    return apply_lut(imgs, np.floor(factors * np.arange(256, dtype=np.float32)))
+
+
+def _solarize(imgs, magnitude, signs, fill):
+    return apply_lut(imgs, np.where(np.arange(256) < magnitude, np.arange(256), 255 - np.arange(256)))
+
+
+batch_ops = {
+    "shearX": lambda imgs, magnitude, signs, fill: warp_signed(
+        imgs, signs, fill, lambda sign: (1, magnitude * sign, 0, 0, 1, 0), bicubic=True),
+    "shearY": lambda imgs, magnitude, signs, fill: warp_signed(
+        imgs, signs, fill, lambda sign: (1, 0, 0, magnitude * sign, 1, 0), bicubic=True),
+    "translateX": lambda imgs, magnitude, signs, fill: warp_signed(
+        imgs, signs, fill, lambda sign: (1, 0, magnitude * imgs.shape[3] * sign, 0, 1, 0)),
+    "translateY": lambda imgs, magnitude, signs, fill: warp_signed(
+        imgs, signs, fill, lambda sign: (1, 0, 0, 0, 1, magnitude * imgs.shape[2] * sign)),
+    # like rotate_with_fill: always counterclockwise and filled with 128
+    "rotate": lambda imgs, magnitude, signs, fill: warp(
+        imgs, rotate_matrix(magnitude, imgs.shape[:1:-1]), np.full(imgs.shape[1], 128, np.uint8)),
+    "color": lambda imgs, magnitude, signs, fill: blend(grayscale(imgs), imgs.astype(np.float32), 1 + magnitude * signs),
+    "posterize": lambda imgs, magnitude, signs, fill: apply_lut(imgs, np.arange(256) & ~(2 ** (8 - int(magnitude)) - 1)),
+    "solarize": _solarize,
+    "contrast": _contrast,
+    "sharpness": _sharpness,
+    "brightness": _brightness,
+    "autocontrast": lambda imgs, magnitude, signs, fill: apply_lut(imgs, autocontrast_lut(imgs)),
+    "equalize": lambda imgs, magnitude, signs, fill: apply_lut(imgs, equalize_lut(imgs)),
+    "invert": lambda imgs, magnitude, signs, fill: 255 - imgs
+}
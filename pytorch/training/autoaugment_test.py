@@ -0,0 +1,90 @@
+import random
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import autoaugment
+import dataloader
+
+
+def make_images(n, h=30, w=36, seed=0):
+    "noisy gradients of random colors, so that every op changes them"
+    rs = np.random.RandomState(seed)
+    gradient = np.linspace(0, 1, w)[None, None, :, None] * np.linspace(0.3, 1, h)[None, :, None, None]
+    imgs = gradient * rs.uniform(50, 255, (n, 1, 1, 3)) + rs.normal(0, 20, (n, h, w, 3))
+    return np.clip(imgs, 0, 255).astype(np.uint8)
+
+
+def pil_batch(imgs, tfm):
+    return np.stack([np.asarray(tfm(Image.fromarray(img))) for img in imgs]).transpose(0, 3, 1, 2)
+
+
+@pytest.mark.parametrize('name', sorted(autoaugment.batch_ops))
+@pytest.mark.parametrize('sign', [-1, 1])
+def test_batch_ops_match_pil(name, sign, monkeypatch):
+    imgs = make_images(8)
+    monkeypatch.setattr(autoaugment.random, 'choice', lambda seq: sign)
+    fill = np.array((128, 128, 128), dtype=np.uint8)
+    for magnitude_idx in [2, 9]:
+        sub_policy = autoaugment.SubPolicy(1.0, name, magnitude_idx, 0.0, name, magnitude_idx)
+        expected = pil_batch(imgs, sub_policy)
+        result = autoaugment.batch_ops[name](imgs.transpose(0, 3, 1, 2).copy(), sub_policy.magnitude1,
+                                             np.full(len(imgs), sign), fill)
+        diff = np.abs(result.astype(int) - expected)
+        # bicubic weights are summed in float32 instead of PIL's double, which rarely rounds the other way
+        if name.startswith('shear'): assert diff.max() <= 1 and (diff == 0).mean() > 0.99
+        else: assert diff.max() == 0
+
+
+def ks_statistic(a, b):
+    "two-sample Kolmogorov-Smirnov statistic"
+    values = np.concatenate([a, b])
+    cdf_a = np.searchsorted(np.sort(a), values, side='right') / len(a)
+    cdf_b = np.searchsorted(np.sort(b), values, side='right') / len(b)
+    return np.abs(cdf_a - cdf_b).max()
+
+
+def test_batch_policy_distribution():
+    "per-image statistics after PIL ImageNetPolicy and BatchPolicy come from the same distribution"
+    random.seed(0)
+    n = 3000
+    imgs = np.repeat(make_images(4), n // 4, axis=0)
+    expected = pil_batch(imgs, autoaugment.ImageNetPolicy()).astype(np.float64)
+    result = autoaugment.BatchPolicy(autoaugment.ImageNetPolicy())(imgs.transpose(0, 3, 1, 2).copy()).astype(np.float64)
+    unchanged = imgs.transpose(0, 3, 1, 2)
+    # critical value of KS test with significance 0.001
+    critical = 1.95 * np.sqrt(2 / n)
+    for stat in [lambda x: x.mean(axis=(1, 2, 3)), lambda x: x.std(axis=(1, 2, 3)),
+                 lambda x: x[:, 0].mean(axis=(1, 2)) - x[:, 2].mean(axis=(1, 2)),
+                 lambda x: np.abs(x - unchanged).mean(axis=(1, 2, 3))]:
+        assert ks_statistic(stat(expected), stat(result)) < critical
+
+
+def test_batch_policy_in_place_and_reproducible():
+    imgs = make_images(64).transpose(0, 3, 1, 2)
+    policy = autoaugment.BatchPolicy(autoaugment.ImageNetPolicy())
+    random.seed(1)
+    batch = imgs.copy()
+    assert policy(batch) is batch and not np.array_equal(batch, imgs)
+    random.seed(1)
+    assert np.array_equal(policy(imgs.copy()), batch)
+
+
+def test_collator_batch_tfms():
+    imgs = make_images(4)
+    invert = lambda batch: np.subtract(255, batch, out=batch)
+    collator = dataloader.BatchCollator(batch_tfms=[None, invert])
+    input, target = collator([(img, i, 0) for i, img in enumerate(imgs)])
+    assert np.array_equal(input.numpy(), imgs.transpose(0, 3, 1, 2)) and target.tolist() == [0, 1, 2, 3]
+    input, _ = collator([(img, i, 1) for i, img in enumerate(imgs)])
+    assert np.array_equal(input.numpy(), 255 - imgs.transpose(0, 3, 1, 2))
+
+
+def main():
+    sys.exit(pytest.main([__file__]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Microbenchmark of dataloader.BatchCollator against the original fast_collate.
+
+python collate_performance.py --batch-size 512 --sz 128
+"""
+import argparse, time, warnings
+
+import numpy as np
+import torch
+from PIL import Image
+
+import dataloader
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Collate microbenchmark')
+    parser.add_argument('--batch-size', '-b', default=512, type=int)
+    parser.add_argument('--sz', default=128, type=int, help='image size')
+    parser.add_argument('--iters', default=20, type=int)
+    parser.add_argument('--grayscale-frac', default=0.0, type=float, help='fraction of grayscale images in batch')
+    return parser
+
+def reference_collate(batch):
+    "fast_collate as it was before BatchCollator: zero-filled batch per call, images added one at a time"
+    if not batch: return torch.tensor([]), torch.tensor([])
+    imgs = [img[0] for img in batch]
+    targets = torch.tensor([target[1] for target in batch], dtype=torch.int64)
+    w = imgs[0].size[0]
+    h = imgs[0].size[1]
+    tensor = torch.zeros( (len(imgs), 3, h, w), dtype=torch.uint8 )
+    for i, img in enumerate(imgs):
+        nump_array = np.asarray(img, dtype=np.uint8)
+        if(nump_array.ndim < 3):
+            nump_array = np.expand_dims(nump_array, axis=-1)
+        nump_array = np.rollaxis(nump_array, 2)
+        tensor[i] += torch.from_numpy(nump_array)
+    return tensor, targets
+
+def make_batch(bs, sz, grayscale_frac):
+    batch = []
+    for i in range(bs):
+        if i < bs*grayscale_frac: img = Image.fromarray(np.random.randint(0, 256, (sz, sz), dtype=np.uint8), 'L')
+        else: img = Image.fromarray(np.random.randint(0, 256, (sz, sz, 3), dtype=np.uint8), 'RGB')
+        batch.append((img, i % 1000))
+    return batch
+
+def bench(collate_fn, batch, iters):
+    collate_fn(batch)  # warmup, allocates buffers
+    start = time.perf_counter()
+    for _ in range(iters): collate_fn(batch)
+    return (time.perf_counter() - start) / iters
+
+def main():
+    args = get_parser().parse_args()
+    warnings.filterwarnings('ignore', 'The given NumPy array is not writable')  # from reference_collate
+    batch = make_batch(args.batch_size, args.sz, args.grayscale_frac)
+    collator = dataloader.BatchCollator()
+
+    ref_input, ref_target = reference_collate(batch)
+    input, target = collator(batch)
+    assert torch.equal(ref_input, input) and torch.equal(ref_target, target), 'BatchCollator output differs from reference'
+
+    ref_sec = bench(reference_collate, batch, args.iters)
+    new_sec = bench(collator, batch, args.iters)
+    print(f'bs={args.batch_size} sz={args.sz} grayscale={args.grayscale_frac}')
+    print(f'reference_collate: {ref_sec*1000:.2f} ms/batch')
+    print(f'BatchCollator:     {new_sec*1000:.2f} ms/batch ({ref_sec/new_sec:.2f}x)')
+
+if __name__ == '__main__': main()
@@ -1,4 +1,4 @@
-import argparse, os, shutil, time, warnings
+import argparse, collections, copy, io, os, random, shutil, socket, time, warnings
 from pathlib import Path
 import numpy as np
 import sys
@@ -6,45 +6,80 @@ import math
 
 import torch
 import torch.distributed as dist
+import torch.nn.functional as F
 import torch.utils.data
 import torch.utils.data.distributed
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from torch.utils.data.sampler import Sampler
 import torchvision
-import pickle
+from PIL import Image
 from tqdm import tqdm
 
-from autoaugment import ImageNetPolicy
+from autoaugment import BatchPolicy, ImageNetPolicy
 
 def get_world_size(): return int(os.environ['WORLD_SIZE'])
 def get_rank(): return int(os.environ['RANK'])
 
-def get_loaders(traindir, valdir, sz, bs, val_bs=None, workers=8, use_ar=False, min_scale=0.08, distributed=False, autoaugment=False):
+def get_loaders(traindir, valdir, sz, bs, val_bs=None, workers=8, use_ar=False, min_scale=0.08, distributed=False, autoaugment=False,
+                cache_dir=None, cache_budget_gb=64, gpu_aug=False, train_use_ar=False):
+    """cache_dir: train from decoded images cached under cache_dir (see DecodedCacheDataset), images beyond
+    cache_budget_gb are decoded from JPEG as usual.
+    autoaugment: ImageNetPolicy is applied to whole collated batches (see autoaugment.BatchPolicy).
+    gpu_aug: train images are only resized to gpu_aug_canvas(sz) squares, crop and flip are left to
+    DataPrefetcher with GPUAugment(sz, (min_scale, 1.0)).
+    train_use_ar: train on aspect-ratio bucketed batches (DistArBatchSampler), train_sampler is a batch sampler then."""
     val_bs = val_bs or bs
-    train_tfms = [
-            # AdaptiveRandomResizedCrop(sz, scale=(min_scale, 1.0)),
-            transforms.RandomResizedCrop(sz, scale=(min_scale, 1.0)),
-            transforms.RandomHorizontalFlip()
-        ]
-    if autoaugment: train_tfms.append(ImageNetPolicy())
-    train_dataset = datasets.ImageFolder(traindir, transforms.Compose(train_tfms))
-    train_sampler = (torch.utils.data.distributed.DistributedSampler(train_dataset, num_replicas=get_world_size(), rank=get_rank()) if distributed else None)
+    train_dataset, train_sampler, val_dataset, val_sampler = get_datasets(
+        traindir, valdir, sz, val_bs, use_ar, min_scale, distributed, autoaugment, cache_dir, cache_budget_gb, gpu_aug,
+        train_use_ar, bs)
 
-    train_loader = torch.utils.data.DataLoader(
+    train_collate = BatchCollator(batch_tfms=[getattr(train_dataset, 'batch_tfm', None)], pin_memory=True)
+    if train_use_ar:
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset, num_workers=workers, pin_memory=True, collate_fn=train_collate,
+            batch_sampler=train_sampler)
+    else: train_loader = torch.utils.data.DataLoader(
         train_dataset, batch_size=bs, shuffle=(train_sampler is None),
-        num_workers=workers, pin_memory=True, collate_fn=fast_collate, 
+        num_workers=workers, pin_memory=True, collate_fn=train_collate,
         sampler=train_sampler)
 
-    val_dataset, val_sampler = create_validation_set(valdir, val_bs, sz, use_ar=use_ar, distributed=distributed)
     val_loader = torch.utils.data.DataLoader(
         val_dataset,
-        num_workers=workers, pin_memory=True, collate_fn=fast_collate, 
+        num_workers=workers, pin_memory=True, collate_fn=BatchCollator(pin_memory=True),
         batch_sampler=val_sampler)
 
     return train_loader, val_loader, train_sampler, val_sampler
 
+def gpu_aug_canvas(sz): return int(sz*1.14)
+
+def get_datasets(traindir, valdir, sz, val_bs, use_ar=False, min_scale=0.08, distributed=False, autoaugment=False,
+                 cache_dir=None, cache_budget_gb=64, gpu_aug=False, train_use_ar=False, bs=None):
+    """Datasets and samplers behind get_loaders, val_sampler (and train_sampler with train_use_ar) is a batch sampler.
+    With autoaugment, train_dataset.batch_tfm holds the policy to be applied by BatchCollator."""
+    assert not (gpu_aug and autoaugment), 'autoaugment needs crops done in loader workers'
+    assert not (gpu_aug and train_use_ar), 'gpu_aug crops square images'
+    train_tfms = [
+            # AdaptiveRandomResizedCrop(sz, scale=(min_scale, 1.0)),
+            transforms.RandomResizedCrop(sz, scale=(min_scale, 1.0)),
+            transforms.RandomHorizontalFlip()
+        ]
+    if gpu_aug: train_tfms = [transforms.Resize(gpu_aug_canvas(sz)), transforms.CenterCrop(gpu_aug_canvas(sz))]
+    if train_use_ar:
+        sizes = image_sizes(traindir)
+        train_sampler = DistArBatchSampler(sizes[:,0] / sizes[:,1], bs, distributed=distributed)
+        ar_tfms = [RandomCropArTfm(train_sampler.bucket_of, train_sampler.target_sizes(sz), (min_scale, 1.0)), transforms.RandomHorizontalFlip()]
+        train_dataset = PackedDataset(traindir, transform=ar_tfms) if is_packed(traindir) else ValDataset(traindir, transform=ar_tfms)
+    elif cache_dir and not gpu_aug:
+        train_dataset = DecodedCacheDataset(traindir, decoded_cache_path(cache_dir, traindir), sz, (min_scale, 1.0), cache_budget_gb)
+    else: train_dataset = image_folder(traindir, transforms.Compose(train_tfms))
+    if autoaugment: train_dataset.batch_tfm = BatchPolicy(ImageNetPolicy())
+    if not train_use_ar: train_sampler = (torch.utils.data.distributed.DistributedSampler(train_dataset, num_replicas=get_world_size(), rank=get_rank()) if distributed else None)
+    val_dataset, val_sampler = create_validation_set(valdir, val_bs, sz, use_ar=use_ar, distributed=distributed)
+    return train_dataset, train_sampler, val_dataset, val_sampler
+
 
 def create_validation_set(valdir, batch_size, target_size, use_ar, distributed):
     if use_ar:
@@ -53,85 +88,302 @@ def create_validation_set(valdir, batch_size, target_size, use_ar, distributed):
         idx2ar = map_idx2ar(idx_ar_sorted, batch_size)
 
         ar_tfms = [transforms.Resize(int(target_size*1.14)), CropArTfm(idx2ar, target_size)]
-        val_dataset = ValDataset(valdir, transform=ar_tfms)
+        val_dataset = PackedDataset(valdir, transform=ar_tfms) if is_packed(valdir) else ValDataset(valdir, transform=ar_tfms)
         val_sampler = DistValSampler(idx_sorted, batch_size=batch_size, distributed=distributed)
         return val_dataset, val_sampler
     
     val_tfms = [transforms.Resize(int(target_size*1.14)), transforms.CenterCrop(target_size)]
-    val_dataset = datasets.ImageFolder(valdir, transforms.Compose(val_tfms))
+    val_dataset = image_folder(valdir, transforms.Compose(val_tfms))
     val_sampler = DistValSampler(list(range(len(val_dataset))), batch_size=batch_size, distributed=distributed)
     return val_dataset, val_sampler
 
+class PhasedDataset(torch.utils.data.Dataset):
+    "Dataset over datasets of several phases, indexed by (dataset_idx, sample_idx). Samples are (image, target, dataset_idx)"
+    def __init__(self, datasets): self.datasets = datasets
+    def __getitem__(self, index):
+        dataset_idx, sample_idx = index
+        img, target = self.datasets[dataset_idx][sample_idx]
+        return img, target, dataset_idx
+
+class SegmentBatchSampler(Sampler):
+    """Chains batches of all segments, set_epoch of segment sampler is called right before its batches are generated.
+    skip_to(k) makes iteration jump to the start of k-th segment, batches of earlier segments are not generated
+    anymore. dispatched is the position of the next batch in the chain."""
+    def __init__(self, segments):
+        self.segments = segments
+        self.starts = np.cumsum([0] + [len(batch_sampler) for _, batch_sampler, _ in segments]).tolist()
+        self.dispatched, self.skip_segment = 0, 0
+    def __len__(self): return self.starts[-1]
+    def skip_to(self, k): self.skip_segment = max(self.skip_segment, k)
+    def __iter__(self):
+        self.dispatched = 0
+        for k, (dataset_idx, batch_sampler, epoch) in enumerate(self.segments):
+            if k < self.skip_segment: continue
+            self.dispatched = self.starts[k]
+            sampler = getattr(batch_sampler, 'sampler', batch_sampler)
+            if hasattr(sampler, 'set_epoch'): sampler.set_epoch(epoch)
+            for batch in batch_sampler:
+                # skipped while the segment was being generated
+                if k < self.skip_segment: break
+                self.dispatched += 1
+                yield [(dataset_idx, idx) for idx in batch]
+
+class PhasedLoader():
+    """Serves all data phases of training from a single DataLoader worker pool, which is never respawned.
+    segments lists (dataset_idx, batch_sampler, epoch) in the order they are consumed, e.g. train epoch 0, validation 0,
+    train epoch 1... They are served as one stream, so workers prefetch the first batches of the next segment (and
+    next phase) while the current one is still being consumed. segment(k) returns loader over k-th segment, segments
+    can be skipped or left unfinished but not revisited. Skipped batches are not loaded, except for those workers
+    already prefetched."""
+    def __init__(self, datasets, segments, workers=8, collate_fn=None):
+        self.segments = list(segments)
+        self.sampler = SegmentBatchSampler(self.segments)
+        self.loader = torch.utils.data.DataLoader(
+            PhasedDataset(datasets), batch_sampler=self.sampler,
+            num_workers=workers, pin_memory=True,
+            collate_fn=collate_fn or BatchCollator(batch_tfms=[getattr(ds, 'batch_tfm', None) for ds in datasets], pin_memory=True))
+        self.loaditer = None
+        self.cur_segment, self.remaining, self.position = -1, 0, 0
+
+    def segment(self, k): return SegmentLoader(self, k, len(self.segments[k][1]))
+
+    def seek(self, k):
+        "Skips to start of k-th segment"
+        assert k > self.cur_segment, f'Segment {k} was already served'
+        start = self.sampler.starts[k]
+        # batches dispatched before the skip still arrive, in order
+        stale = min(self.sampler.dispatched, start) - self.position
+        self.sampler.skip_to(k)
+        if self.loaditer is None: self.loaditer = iter(self.loader)
+        for _ in range(stale): next(self.loaditer)
+        self.cur_segment, self.remaining, self.position = k, len(self.segments[k][1]), start
+
+class SegmentLoader():
+    def __init__(self, phased_loader, k, length): self.phased_loader, self.k, self.length = phased_loader, k, length
+    def __len__(self): return self.length
+    def __iter__(self):
+        pl = self.phased_loader
+        pl.seek(self.k)
+        while pl.remaining:
+            pl.remaining -= 1
+            pl.position += 1
+            yield next(pl.loaditer)
+
 # Seems to speed up training by ~2%
 class DataPrefetcher():
-    def __init__(self, loader, prefetch=True, fp16=True):
+    """Iterates over loader with batches moved to device, optionally augmented with GPUAugment and normalized.
+    On GPU, depth batches are kept in flight on a side stream. Without CUDA everything runs synchronously on CPU."""
+    def __init__(self, loader, prefetch=True, fp16=True, depth=1, augment=None):
         self.loader = loader
         self.prefetch = prefetch
-        self.mean = torch.tensor([0.485 * 255, 0.456 * 255, 0.406 * 255]).cuda().view(1,3,1,1)
-        self.std = torch.tensor([0.229 * 255, 0.224 * 255, 0.225 * 255]).cuda().view(1,3,1,1)
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.mean = torch.tensor([0.485 * 255, 0.456 * 255, 0.406 * 255], device=self.device).view(1,3,1,1)
+        self.std = torch.tensor([0.229 * 255, 0.224 * 255, 0.225 * 255], device=self.device).view(1,3,1,1)
         self.fp16 = fp16
+        self.depth = depth
+        self.augment = augment
         self.loaditer = iter(self.loader)
         if self.fp16: self.mean, self.std = self.mean.half(), self.std.half()
+        self.stream = torch.cuda.Stream() if self.prefetch and self.device.type == 'cuda' else None
+        self.queue = collections.deque()
         if self.prefetch:
-            self.stream = torch.cuda.Stream()
-            self.next_input = self.next_target = None
-            self.preload()
+            for _ in range(depth): self.preload()
 
     def __len__(self): return len(self.loader)
 
     def preload(self):
-        self.next_input, self.next_target = next(self.loaditer)
+        try: input, target = next(self.loaditer)
+        except StopIteration: return
+        if self.stream is None:
+            self.queue.append((*self.process_tensors(input, target, non_blocking=False), None))
+            return
         with torch.cuda.stream(self.stream):
-            self.next_input, self.next_target = self.process_tensors(self.next_input, self.next_target, non_blocking=True)
+            input, target = self.process_tensors(input, target, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.queue.append((input, target, event))
     
     def process_tensors(self, input, target, non_blocking=True):
-        input = input.cuda(non_blocking=non_blocking)
-        if self.fp16: input = input.half()
-        else: input = input.float()
-        if len(input.shape) < 3: return input, target.cuda(non_blocking=non_blocking)
-        return input.sub_(self.mean).div_(self.std), target.cuda(non_blocking=non_blocking)
+        input = input.to(self.device, non_blocking=non_blocking)
+        target = target.to(self.device, non_blocking=non_blocking)
+        if len(input.shape) < 3: return input.half() if self.fp16 else input.float(), target
+        if self.augment is not None: input = self.augment(input)
+        input = input.half() if self.fp16 else input.float()
+        return input.sub_(self.mean).div_(self.std), target
             
     def __iter__(self):
         if not self.prefetch:
             for input, target in self.loaditer: yield self.process_tensors(input, target, non_blocking=False)
             return
-        while True:
-            torch.cuda.current_stream().wait_stream(self.stream)
-            input, target = self.next_input, self.next_target
-            try: self.preload() # 0.5 fix
-            except Exception as e:
-                yield input, target
-                break
+        while self.queue:
+            input, target, event = self.queue.popleft()
+            if event is not None:
+                # tensors were allocated on side stream, tell caching allocator they are used on current stream too
+                torch.cuda.current_stream().wait_event(event)
+                input.record_stream(torch.cuda.current_stream())
+                target.record_stream(torch.cuda.current_stream())
+            self.preload()
             yield input, target
 
-def fast_collate(batch):
-    if not batch: return torch.tensor([]), torch.tensor([])
-    imgs = [img[0] for img in batch]
-    targets = torch.tensor([target[1] for target in batch], dtype=torch.int64)
-    w = imgs[0].size[0]
-    h = imgs[0].size[1]
-    tensor = torch.zeros( (len(imgs), 3, h, w), dtype=torch.uint8 )
-    for i, img in enumerate(imgs):
-        nump_array = np.asarray(img, dtype=np.uint8)
-        tens = torch.from_numpy(nump_array)
-        if(nump_array.ndim < 3):
-            nump_array = np.expand_dims(nump_array, axis=-1)
-        nump_array = np.rollaxis(nump_array, 2)
-        tensor[i] += torch.from_numpy(nump_array)
-    return tensor, targets
+class GPUAugment():
+    """RandomResizedCrop to sz and horizontal flip of uint8 NCHW batch on its own device, all images in one batched
+    grid_sample, so loader workers only decode (see gpu_aug in get_datasets). Crop area and aspect ratio are sampled
+    like RandomResizedCrop but clamped to the image instead of resampled. Returns float batch in 0-255 range."""
+    def __init__(self, sz, scale=(0.08, 1.0), ratio=(3/4, 4/3), flip=True):
+        self.sz, self.scale, self.ratio, self.flip = sz, scale, ratio, flip
+
+    def __call__(self, input):
+        n, c, h, w = input.shape
+        uniform = lambda lo, hi: torch.empty(n, device=input.device).uniform_(lo, hi)
+        area = uniform(*self.scale) * h * w
+        aspect_ratio = torch.exp(uniform(math.log(self.ratio[0]), math.log(self.ratio[1])))
+        # crop size as fraction of image, which is also scale in grid_sample's [-1, 1] coordinates
+        crop_w = (torch.sqrt(area * aspect_ratio) / w).clamp_(max=1)
+        crop_h = (torch.sqrt(area / aspect_ratio) / h).clamp_(max=1)
+        theta = torch.zeros(n, 2, 3, device=input.device)
+        theta[:, 0, 0] = crop_w
+        theta[:, 1, 1] = crop_h
+        theta[:, 0, 2] = (1 - crop_w) * uniform(-1, 1)
+        theta[:, 1, 2] = (1 - crop_h) * uniform(-1, 1)
+        if self.flip: theta[:, 0, 0] *= torch.randint(0, 2, (n,), device=input.device).float() * 2 - 1
+        grid = F.affine_grid(theta, (n, c, self.sz, self.sz), align_corners=False)
+        return F.grid_sample(input.float(), grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+class BatchCollator():
+    """Collates (image, target) pairs into uint8 NCHW batch, copying each PIL image or HWC uint8 array
+    into place once. Inside workers of a DataLoader with pin_memory (pass the same pin_memory here) batches
+    are written into a ring of reusable shared memory buffers. This is safe because the loader copies every
+    batch into pinned memory before it is handed out, as long as num_buffers stays above DataLoader
+    prefetch_factor + 2. Otherwise (no pinning, or collating in main process with num_workers=0) the consumer
+    gets the collated tensor itself and could still hold it when the ring wraps, so every batch gets a fresh buffer.
+    batch_tfms: in-place transforms of the uint8 NCHW NumPy batch (e.g. autoaugment.BatchPolicy), samples
+    (image, target, k) are transformed by batch_tfms[k], plain (image, target) samples by batch_tfms[0]."""
+    def __init__(self, num_buffers=4, batch_tfms=None, pin_memory=False):
+        # DataLoader only pins (and so copies) batches with CUDA available, checked here rather than in forked workers
+        self.__setstate__({'num_buffers': num_buffers, 'batch_tfms': batch_tfms,
+                           'pin_memory': pin_memory and torch.cuda.is_available()})
+
+    # buffers belong to the process that allocated them, workers start with an empty ring
+    def __getstate__(self): return {'num_buffers': self.num_buffers, 'batch_tfms': self.batch_tfms, 'pin_memory': self.pin_memory}
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.buffers = [None] * self.num_buffers
+        self.buffer_idx = 0
+
+    def reuses_buffers(self): return self.pin_memory and torch.utils.data.get_worker_info() is not None
+
+    def get_buffer(self, numel):
+        if not self.reuses_buffers(): return torch.empty(numel, dtype=torch.uint8)
+        buf = self.buffers[self.buffer_idx]
+        if buf is None or buf.numel() < numel:
+            buf = torch.empty(numel, dtype=torch.uint8).share_memory_()
+            self.buffers[self.buffer_idx] = buf
+        self.buffer_idx = (self.buffer_idx + 1) % self.num_buffers
+        return buf[:numel]
+
+    def __call__(self, batch):
+        if not batch: return torch.tensor([]), torch.tensor([])
+        targets = torch.tensor([sample[1] for sample in batch], dtype=torch.int64)
+        img = batch[0][0]
+        h, w = img.shape[:2] if isinstance(img, np.ndarray) else (img.size[1], img.size[0])
+        tensor = self.get_buffer(len(batch)*3*h*w).view(len(batch), 3, h, w)
+        out = tensor.numpy()
+        for i, (img, *_) in enumerate(batch):
+            arr = np.asarray(img, dtype=np.uint8)
+            # grayscale broadcasts over channels, RGB is copied NHWC -> NCHW through strided view
+            out[i] = arr if arr.ndim < 3 else arr.transpose(2, 0, 1)
+        batch_tfm = self.batch_tfms and self.batch_tfms[batch[0][2] if len(batch[0]) > 2 else 0]
+        if batch_tfm: batch_tfm(out)
+        return tensor, targets
+
+fast_collate = BatchCollator()
 
 import os.path
 def sort_ar(valdir):
-    idx2ar_file = valdir+'/../sorted_idxar.p'
-    if os.path.isfile(idx2ar_file): return pickle.load(open(idx2ar_file, 'rb'))
-    print('Creating AR indexes. Please be patient this may take a couple minutes...')
-    val_dataset = datasets.ImageFolder(valdir) # AS: TODO: use Image.open instead of looping through dataset
-    sizes = [img[0].size for img in tqdm(val_dataset, total=len(val_dataset))]
-    idx_ar = [(i, round(s[0]/s[1], 5)) for i,s in enumerate(sizes)]
-    sorted_idxar = sorted(idx_ar, key=lambda x: x[1])
-    pickle.dump(sorted_idxar, open(idx2ar_file, 'wb'))
-    print('Done')
-    return sorted_idxar
+    "[(idx, aspect ratio)] of images in valdir sorted by aspect ratio"
+    sizes = image_sizes(valdir)
+    ars = np.round(sizes[:,0] / sizes[:,1], 5)
+    order = np.argsort(ars, kind='stable')
+    return list(zip(order.tolist(), ars[order].tolist()))
+
+def size_index_fn(root): return os.path.join(os.path.dirname(os.path.abspath(root)), os.path.basename(os.path.normpath(root))+'_sizes.npy')
+
+def read_image_sizes(root, keys):
+    "(width, height) of given images, keys are file paths relative to root, or sample indices for packed root"
+    if is_packed(root):
+        dataset = PackedDataset(root, raw=True)
+        files = (io.BytesIO(dataset.get_bytes(int(key))) for key in keys)
+    else: files = (os.path.join(root, key) for key in keys)
+    sizes = []
+    for f in files:
+        with Image.open(f) as img: sizes.append(img.size)  # only parses image header
+    return sizes
+
+def create_lock(lock_fn):
+    "Creates lock_fn holding 'hostname pid' of this process, False if it already exists"
+    try: fd = os.open(lock_fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError: return False
+    with os.fdopen(fd, 'w') as f: f.write(f'{socket.gethostname()} {os.getpid()}')
+    return True
+
+def lock_owner_died(lock_fn, grace_sec=60):
+    """Whether the process that created lock_fn is gone. Known only for owners on this host, locks without owner
+    (creator died before writing it) count as dead after grace_sec."""
+    try:
+        with open(lock_fn) as f: owner = f.read().split()
+        age = time.time() - os.path.getmtime(lock_fn)
+    except FileNotFoundError: return False
+    if len(owner) != 2: return age > grace_sec
+    host, pid = owner
+    if host != socket.gethostname(): return False
+    try: os.kill(int(pid), 0)
+    except ProcessLookupError: return True
+    except PermissionError: pass
+    return False
+
+def break_lock(lock_fn):
+    print(f'Removing {lock_fn}, its owner died')
+    try: os.remove(lock_fn)
+    except FileNotFoundError: pass
+
+def index_lock(lock_fn, what, poll_sec=1):
+    "Waits until lock_fn could be created, processes holding it (e.g. local ranks starting together) update an index in turn"
+    while not create_lock(lock_fn):
+        print(f'Waiting for {what}')
+        while os.path.exists(lock_fn):
+            if lock_owner_died(lock_fn): break_lock(lock_fn)
+            else: time.sleep(poll_sec)
+
+def image_sizes(root, workers=None, chunk_size=1024):
+    """(N, 2) array of (width, height) of images in root, in dataset order. Reads only image headers, in a process
+    pool, and keeps them in {root}_sizes.npy next to root. Later calls only read images added since.
+    Safe to call from several processes, first one reads the images while the rest wait for its index."""
+    index_fn = size_index_fn(root)
+    lock_fn = index_fn + '.lock'
+    if is_packed(root): keys = [str(i) for i in range(len(PackedDataset(root)))]
+    else: keys = [os.path.relpath(path, root) for path, _ in datasets.ImageFolder(root).samples]
+    index_lock(lock_fn, f'image sizes of {root}')
+    try:
+        known = {}
+        if os.path.isfile(index_fn):
+            index = np.load(index_fn)
+            known = dict(zip(np.char.decode(index['path']).tolist(), index[['w', 'h']].tolist()))
+        new_keys = [key for key in keys if key not in known]
+        if new_keys:
+            print(f'Reading sizes of {len(new_keys)} images in {root}')
+            with ProcessPoolExecutor(workers) as e:
+                key_chunks = list(chunks(new_keys, chunk_size))
+                for key_chunk, sizes in zip(key_chunks, tqdm(e.map(read_image_sizes, [root]*len(key_chunks), key_chunks), total=len(key_chunks))):
+                    known.update(zip(key_chunk, sizes))
+        if new_keys or len(known) != len(keys):
+            index = np.array([(key.encode(), *known[key]) for key in keys],
+                             dtype=[('path', f'S{max(map(len, keys), default=1)}'), ('w', np.int32), ('h', np.int32)])
+            # readers of an older index never see a partly written one
+            tmp_fn = index_fn[:-len('.npy')] + '.tmp.npy'
+            np.save(tmp_fn, index)
+            os.rename(tmp_fn, index_fn)
+    finally: os.remove(lock_fn)
+    return np.array([known[key] for key in keys], dtype=np.int64).reshape(-1, 2)
 
 def chunks(l, n):
     n = max(1, n)
@@ -147,6 +399,12 @@ def map_idx2ar(idx_ar_sorted, batch_size):
             idx2ar[idx] = mean
     return idx2ar
 
+def apply_ar_tfms(tfms, sample, index):
+    for tfm in tfms:
+        if isinstance(tfm, (CropArTfm, RandomCropArTfm)): sample = tfm(sample, index)
+        else: sample = tfm(sample)
+    return sample
+
 class ValDataset(datasets.ImageFolder):
     def __init__(self, root, transform=None, target_transform=None):
         super().__init__(root, transform, target_transform)
@@ -154,14 +412,55 @@ class ValDataset(datasets.ImageFolder):
         path, target = self.imgs[index]
         sample = self.loader(path)
         if self.transform is not None:
-            for tfm in self.transform:
-                if isinstance(tfm, CropArTfm): sample = tfm(sample, index)
-                else: sample = tfm(sample)
+            sample = apply_ar_tfms(self.transform, sample, index)
         if self.target_transform is not None:
             target = self.target_transform(target)
 
         return sample, target
 
+PACKED_INDEX_FN = 'index.npz'
+def packed_shard_fn(root, shard_idx): return os.path.join(root, f'shard-{shard_idx:05d}.bin')
+def is_packed(root): return os.path.isfile(os.path.join(root, PACKED_INDEX_FN))
+def image_folder(root, transform=None):
+    "ImageFolder over root, or PackedDataset if root was packed with pack_images.py"
+    return PackedDataset(root, transform) if is_packed(root) else datasets.ImageFolder(root, transform)
+
+class PackedDataset(torch.utils.data.Dataset):
+    """Dataset over shards written by pack_images.py, same order and targets as ImageFolder on the original tree.
+    Shards are memory-mapped on first access in each process, raw=True returns image bytes as a zero-copy
+    memoryview into the shard instead of decoded RGB PIL image. transform can be a list containing CropArTfm,
+    like in ValDataset."""
+    def __init__(self, root, transform=None, target_transform=None, raw=False):
+        self.root, self.transform, self.target_transform, self.raw = root, transform, target_transform, raw
+        index = np.load(os.path.join(root, PACKED_INDEX_FN))
+        self.shard, self.offset, self.length = index['shard'], index['offset'], index['length']
+        self.targets = index['label'].tolist()
+        self.classes = index['classes'].tolist()
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self.shards = None
+
+    # memory maps are not pickled to loader workers, each worker maps shards itself
+    def __getstate__(self): return {**self.__dict__, 'shards': None}
+
+    def __len__(self): return len(self.targets)
+
+    def get_bytes(self, index):
+        if self.shards is None:
+            self.shards = [np.memmap(packed_shard_fn(self.root, i), dtype=np.uint8, mode='r')
+                           for i in range(int(self.shard.max())+1)]
+        offset = self.offset[index]
+        return memoryview(self.shards[self.shard[index]][offset:offset+self.length[index]])
+
+    def __getitem__(self, index):
+        sample, target = self.get_bytes(index), self.targets[index]
+        if not self.raw:
+            sample = Image.open(io.BytesIO(sample)).convert('RGB')
+            if isinstance(self.transform, list): sample = apply_ar_tfms(self.transform, sample, index)
+            elif self.transform is not None: sample = self.transform(sample)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return sample, target
+
 class DistValSampler(Sampler):
     # DistValSampler distrbutes batches equally (based on batch size) to every gpu (even if there aren't enough images). 
     # Some baches will contain an empty array to signify there aren't enough images
@@ -192,6 +491,57 @@ class DistValSampler(Sampler):
     def __len__(self): return self.expected_num_batches
     def set_epoch(self, epoch): return
     
+class DistArBatchSampler(Sampler):
+    """Training batch sampler grouping images of similar aspect ratio, so batches can be cropped to non-square shapes.
+    Images sorted by aspect ratio are split into num_buckets equally sized buckets. Every epoch each bucket is shuffled
+    and cut into full batches, and all batches are shuffled and split evenly between ranks, leftovers are dropped.
+    Shuffling is seeded with seed+epoch, so all ranks agree on it without communication."""
+    def __init__(self, ars, batch_size, num_buckets=16, distributed=True, seed=0):
+        self.batch_size, self.seed, self.epoch = batch_size, seed, 0
+        if distributed:
+            self.world_size = get_world_size()
+            self.global_rank = get_rank()
+        else:
+            self.global_rank = 0
+            self.world_size = 1
+        ars = np.asarray(ars)
+        self.buckets = np.array_split(np.argsort(ars, kind='stable'), num_buckets)
+        self.bucket_ars = [float(np.median(ars[bucket])) for bucket in self.buckets]
+        self.bucket_of = np.empty(len(ars), np.int16)
+        for i, bucket in enumerate(self.buckets): self.bucket_of[bucket] = i
+
+    def target_sizes(self, sz):
+        "(height, width) of each bucket, keeping about sz*sz pixels so batch size stays valid, multiple of 8"
+        return [(max(8, int(sz/math.sqrt(ar))//8*8), max(8, int(sz*math.sqrt(ar))//8*8)) for ar in self.bucket_ars]
+
+    def with_batch_size(self, batch_size):
+        sampler = copy.copy(self)
+        sampler.batch_size = batch_size
+        return sampler
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        bs = self.batch_size
+        batches = []
+        for bucket in self.buckets:
+            bucket = rng.permutation(bucket)
+            batches += [bucket[i:i+bs] for i in range(0, len(bucket)-bs+1, bs)]
+        order = rng.permutation(len(batches))
+        per_rank = len(batches) // self.world_size
+        for i in order[self.global_rank*per_rank:(self.global_rank+1)*per_rank]: yield batches[i].tolist()
+    def __len__(self): return sum(len(bucket)//self.batch_size for bucket in self.buckets) // self.world_size
+    def set_epoch(self, epoch): self.epoch = epoch
+
+class RandomCropArTfm(object):
+    "RandomResizedCrop to target size of image's aspect ratio bucket, crop ratio is sampled around bucket's ratio"
+    def __init__(self, bucket_of, target_sizes, scale=(0.08, 1.0)):
+        self.bucket_of, self.target_sizes, self.scale = bucket_of, target_sizes, scale
+    def __call__(self, img, idx):
+        h, w = self.target_sizes[self.bucket_of[idx]]
+        ratio = (w/h*3/4, w/h*4/3)
+        i, j, ch, cw = transforms.RandomResizedCrop.get_params(img, self.scale, ratio)
+        return torchvision.transforms.functional.resized_crop(img, i, j, ch, cw, (h, w))
+
 class CropArTfm(object):
     def __init__(self, idx2ar, target_size):
         self.idx2ar, self.target_size = idx2ar, target_size
@@ -215,4 +565,91 @@ class AdaptiveRandomResizedCrop(transforms.RandomResizedCrop):
         # print('Size:', self.size[0])
         # print('W, h', w, h)
         self.scale = (self.target_scale[0] * self.size[0]/min(w,h), self.target_scale[1])
-        return super().__call__(img)
\ No newline at end of file
+        return super().__call__(img)
+
+def decoded_cache_path(cache_dir, root): return os.path.join(cache_dir, os.path.abspath(root).strip('/').replace('/', '_'))
+
+def build_decoded_cache(root, cache_path, budget_gb, workers=16):
+    """Decodes images of root once into cache_path/data.u8 (flat HWC uint8 arrays) with offset/shape index.
+    Images are cached in dataset order until budget_gb is reached. Safe to call from several processes,
+    first one builds the cache while the rest wait for its index. The lock stays once the cache is built,
+    a lock whose builder died without an index is taken over."""
+    index_fn = os.path.join(cache_path, 'index.npz')
+    lock_fn = os.path.join(cache_path, 'lock')
+    os.makedirs(cache_path, exist_ok=True)
+    while not create_lock(lock_fn):
+        if os.path.exists(index_fn): return
+        if lock_owner_died(lock_fn):
+            break_lock(lock_fn)
+            continue
+        print(f'Waiting for decoded cache {cache_path}')
+        time.sleep(10)
+
+    folder = image_folder(root)
+    n, budget = len(folder), int(budget_gb * 1024**3)
+    offset, shape = np.zeros(n, np.int64), np.zeros((n, 2), np.int64)
+    pos, num_cached = 0, 0
+    print(f'Decoding {root} into {cache_path}, budget {budget_gb} GB')
+    with open(os.path.join(cache_path, 'data.u8'), 'wb') as f, ThreadPoolExecutor(workers) as e:
+        chunk_size = 1024
+        for start in tqdm(range(0, n, chunk_size)):
+            for i, (img, _) in enumerate(e.map(folder.__getitem__, range(start, min(start+chunk_size, n))), start):
+                arr = np.asarray(img, dtype=np.uint8)
+                if pos + arr.nbytes > budget: break
+                f.write(arr.tobytes())
+                offset[i], shape[i] = pos, arr.shape[:2]
+                pos, num_cached = pos + arr.nbytes, i + 1
+            else: continue
+            break
+    tmp_fn = os.path.join(cache_path, 'index.tmp.npz')
+    np.savez(tmp_fn, offset=offset[:num_cached], shape=shape[:num_cached])
+    os.rename(tmp_fn, index_fn)
+    print(f'Cached {num_cached}/{n} images ({pos/1024**3:.1f} GB)')
+
+def random_resized_crop_box(h, w, scale, ratio=(3/4, 4/3)):
+    "Same sampling as transforms.RandomResizedCrop.get_params, returns top, left, height, width"
+    area = h * w
+    log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+    for _ in range(10):
+        target_area = area * random.uniform(*scale)
+        aspect_ratio = math.exp(random.uniform(*log_ratio))
+        cw = int(round(math.sqrt(target_area * aspect_ratio)))
+        ch = int(round(math.sqrt(target_area / aspect_ratio)))
+        if 0 < cw <= w and 0 < ch <= h:
+            return random.randint(0, h - ch), random.randint(0, w - cw), ch, cw
+    # fallback to central crop
+    in_ratio = w / h
+    if in_ratio < min(ratio): cw, ch = w, int(round(w / min(ratio)))
+    elif in_ratio > max(ratio): ch, cw = h, int(round(h * max(ratio)))
+    else: cw, ch = w, h
+    return (h - ch) // 2, (w - cw) // 2, ch, cw
+
+class DecodedCacheDataset(torch.utils.data.Dataset):
+    """Training dataset serving RandomResizedCrop + horizontal flip from images decoded once by build_decoded_cache.
+    Crops and flips are done in NumPy on the memory-mapped cache (put it on local NVMe or tmpfs) and returned as
+    HWC uint8 arrays for BatchCollator. Images that didn't fit into the cache budget are decoded from root with PIL transforms."""
+    def __init__(self, root, cache_path, sz, scale=(0.08, 1.0), budget_gb=64):
+        build_decoded_cache(root, cache_path, budget_gb)
+        self.sz, self.scale, self.cache_path = sz, scale, cache_path
+        index = np.load(os.path.join(cache_path, 'index.npz'))
+        self.offset, self.shape = index['offset'], index['shape']
+        self.folder = image_folder(root, transforms.Compose([transforms.RandomResizedCrop(sz, scale=scale),
+                                                             transforms.RandomHorizontalFlip()]))
+        self.targets = self.folder.targets
+        self.data = None
+
+    # memory map is not pickled to loader workers, each worker maps cache itself
+    def __getstate__(self): return {**self.__dict__, 'data': None}
+
+    def __len__(self): return len(self.folder)
+
+    def __getitem__(self, index):
+        if index >= len(self.offset): return self.folder[index]
+        if self.data is None: self.data = np.memmap(os.path.join(self.cache_path, 'data.u8'), dtype=np.uint8, mode='r')
+        h, w = self.shape[index]
+        img = self.data[self.offset[index]:self.offset[index] + h*w*3].reshape(h, w, 3)
+        top, left, ch, cw = random_resized_crop_box(h, w, self.scale)
+        # resize stays in PIL, it is faster than anything we can do in NumPy
+        img = np.asarray(Image.fromarray(img[top:top+ch, left:left+cw]).resize((self.sz, self.sz), Image.BILINEAR))
+        if random.random() < 0.5: img = img[:, ::-1]
+        return img, self.targets[index]
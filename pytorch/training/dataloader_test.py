@@ -0,0 +1,233 @@
+import os
+import pickle
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+import dataloader
+
+
+def make_loader(num_batches=5, bs=4, sz=8):
+    batches = []
+    for i in range(num_batches):
+        input = torch.randint(0, 256, (bs, 3, sz, sz), dtype=torch.uint8)
+        batches.append((input, torch.arange(bs) + i*bs))
+    return batches
+
+
+def test_prefetcher_depth():
+    loader = make_loader()
+    expected = list(dataloader.DataPrefetcher(loader, prefetch=False, fp16=False))
+    for depth in [1, 2, 8]:
+        result = list(dataloader.DataPrefetcher(loader, fp16=False, depth=depth))
+        assert len(result) == len(expected)
+        for (input, target), (expected_input, expected_target) in zip(result, expected):
+            assert torch.equal(input, expected_input) and torch.equal(target, expected_target)
+
+
+def test_prefetcher_normalizes():
+    input, target = make_loader(1)[0]
+    result, _ = next(iter(dataloader.DataPrefetcher([(input, target)], fp16=False)))
+    mean = torch.tensor([0.485, 0.456, 0.406]).view(1,3,1,1) * 255
+    std = torch.tensor([0.229, 0.224, 0.225]).view(1,3,1,1) * 255
+    assert torch.allclose(result, (input.float() - mean) / std, atol=1e-5)
+
+
+def test_prefetcher_empty_batch():
+    result = list(dataloader.DataPrefetcher([(torch.tensor([]), torch.tensor([]))], fp16=True))
+    assert result[0][0].numel() == 0
+
+
+def test_gpu_augment_identity_and_flip():
+    input = torch.randint(0, 256, (16, 3, 8, 8), dtype=torch.uint8)
+    identity = dataloader.GPUAugment(8, scale=(1, 1), ratio=(1, 1), flip=False)
+    assert torch.allclose(identity(input), input.float(), atol=1e-3)
+
+    flip = dataloader.GPUAugment(8, scale=(1, 1), ratio=(1, 1), flip=True)
+    result = flip(input)
+    for img, out in zip(input.float(), result):
+        assert torch.allclose(out, img, atol=1e-3) or torch.allclose(out, img.flip(-1), atol=1e-3)
+
+
+def test_gpu_augment_crop():
+    # constant columns, so every crop of a horizontal gradient stays within the gradient's range
+    input = torch.arange(64, dtype=torch.uint8).repeat(4, 3, 64, 1)
+    result = dataloader.GPUAugment(16, scale=(0.1, 0.3))(input)
+    assert result.shape == (4, 3, 16, 16)
+    assert result.min() >= 0 and result.max() <= 63
+    # crops cover at most sqrt(0.3*4/3) of image width
+    assert (result.amax(dim=(1,2,3)) - result.amin(dim=(1,2,3))).max() < 64*0.64
+
+
+def test_prefetcher_with_augment():
+    loader = make_loader(sz=12)
+    result = list(dataloader.DataPrefetcher(loader, fp16=True, depth=3, augment=dataloader.GPUAugment(8)))
+    assert len(result) == len(loader)
+    assert result[0][0].shape == (4, 3, 8, 8) and result[0][0].dtype == torch.float16
+
+
+class ArrayDataset(torch.utils.data.Dataset):
+    def __len__(self): return 24
+    def __getitem__(self, idx): return np.full((4, 4, 3), idx, dtype=np.uint8), idx
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+def test_collator_batches_stay_intact_without_pinning(num_workers):
+    collator = dataloader.BatchCollator(num_buffers=2, pin_memory=False)
+    loader = torch.utils.data.DataLoader(ArrayDataset(), batch_size=2, num_workers=num_workers, collate_fn=collator)
+    # all batches are held at once, far more than the ring has buffers
+    batches = list(loader)
+    assert len(batches) == 12
+    for input, target in batches:
+        assert input.shape == (2, 3, 4, 4)
+        assert torch.equal(input, target.to(torch.uint8).view(2, 1, 1, 1).expand(2, 3, 4, 4))
+
+
+def test_collator_ring_only_in_pinned_workers(monkeypatch):
+    batch = [ArrayDataset()[i] for i in range(2)]
+    def storages(collator):
+        inputs = [collator(batch)[0] for _ in range(4)]
+        return [input.data_ptr() for input in inputs]
+
+    ptrs = storages(dataloader.BatchCollator(num_buffers=2, pin_memory=True))
+    assert len(set(ptrs)) == 4
+    monkeypatch.setattr(torch.utils.data, 'get_worker_info', lambda: object())
+    ptrs = storages(dataloader.BatchCollator(num_buffers=2, pin_memory=False))
+    assert len(set(ptrs)) == 4
+    monkeypatch.setattr(torch.cuda, 'is_available', lambda: True)
+    collator = dataloader.BatchCollator(num_buffers=2, pin_memory=True)
+    # workers get the pinning flag of the parent, they don't query CUDA themselves
+    monkeypatch.setattr(torch.cuda, 'is_available', lambda: 1/0)
+    ptrs = storages(pickle.loads(pickle.dumps(collator)))
+    assert ptrs[0] == ptrs[2] and ptrs[1] == ptrs[3] and ptrs[0] != ptrs[1]
+
+
+class EpochSampler(torch.utils.data.Sampler):
+    def __init__(self, n, epochs): self.n, self.epochs = n, epochs
+    def __len__(self): return self.n
+    def __iter__(self): return iter(range(self.n))
+    def set_epoch(self, epoch): self.epochs.append(epoch)
+
+
+class LoggedDataset(ArrayDataset):
+    def __init__(self, offset, loaded): self.offset, self.loaded = offset, loaded
+    def __getitem__(self, idx):
+        self.loaded.append(self.offset + idx)
+        return super().__getitem__(self.offset + idx)
+
+
+def make_phased_loader(workers, loaded, epochs):
+    datasets = [LoggedDataset(0, loaded), LoggedDataset(100, loaded)]
+    # train 0 (3 batches), val (2 batches), train 1, val, train 2 on the second dataset
+    segments = [(0, torch.utils.data.BatchSampler(EpochSampler(n, epochs), 2, drop_last=False), epoch)
+                for n, epoch in [(6, 0), (3, -1), (6, 1), (3, -1)]]
+    segments.append((1, torch.utils.data.BatchSampler(EpochSampler(4, epochs), 2, drop_last=False), 2))
+    return dataloader.PhasedLoader(datasets, segments, workers=workers)
+
+
+def targets(segment_loader, limit=None):
+    result = []
+    for i, (input, target) in enumerate(segment_loader):
+        assert torch.equal(input[:, 0, 0, 0], target.to(torch.uint8))
+        result.append(target.tolist())
+        if i+1 == limit: break
+    return result
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_phased_loader_segments(workers):
+    loaded, epochs = [], []
+    pl = make_phased_loader(workers, loaded, epochs)
+    assert [len(pl.segment(k)) for k in range(5)] == [3, 2, 3, 2, 2] and len(pl.loader) == 12
+    assert targets(pl.segment(0)) == [[0, 1], [2, 3], [4, 5]]
+    # validation left after its first batch, train epoch 1 skipped entirely, as with --prof
+    assert targets(pl.segment(1), limit=1) == [[0, 1]]
+    assert targets(pl.segment(3)) == [[0, 1], [2]]
+    assert targets(pl.segment(4)) == [[100, 101], [102, 103]]
+    with pytest.raises(AssertionError): pl.seek(2)
+    if workers == 0:
+        # skipped batches were neither sampled nor loaded
+        assert epochs == [0, -1, -1, 2]
+        assert loaded == [0, 1, 2, 3, 4, 5, 0, 1, 0, 1, 2, 100, 101, 102, 103]
+
+
+def test_phased_loader_skip_before_start():
+    loaded, epochs = [], []
+    pl = make_phased_loader(0, loaded, epochs)
+    assert targets(pl.segment(4)) == [[100, 101], [102, 103]]
+    assert epochs == [2] and loaded == [100, 101, 102, 103]
+
+
+def make_image_folder(root):
+    "Writes 6 images of 2 classes, returns their (width, height) in ImageFolder order"
+    sizes = [(8+i, 4+i) for i in range(6)]
+    for i, (w, h) in enumerate(sizes):
+        (root/str(i % 2)).mkdir(parents=True, exist_ok=True)
+        Image.new('RGB', (w, h), (i, i, i)).save(root/str(i % 2)/f'{i}.png')
+    # by class, then file name
+    return [sizes[i] for i in [0, 2, 4, 1, 3, 5]]
+
+
+def test_image_sizes_from_concurrent_ranks(tmp_path):
+    root = tmp_path/'validation'
+    expected = make_image_folder(root)
+    # local ranks index the same directory at once
+    with ProcessPoolExecutor(4) as e:
+        results = list(e.map(dataloader.image_sizes, [str(root)]*4, [1]*4, [2]*4))
+    for sizes in results: assert sizes.tolist() == [list(s) for s in expected]
+    assert sorted(os.listdir(tmp_path)) == ['validation', 'validation_sizes.npy']
+    assert dataloader.image_sizes(str(root)).tolist() == results[0].tolist()
+
+
+def dead_pid():
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+    return proc.pid
+
+
+def test_locks_of_dead_builders_are_broken(tmp_path):
+    root = tmp_path/'train'
+    expected = make_image_folder(root)
+    host = socket.gethostname()
+    (tmp_path/'train_sizes.npy.lock').write_text(f'{host} {dead_pid()}')
+    assert dataloader.image_sizes(str(root), 1).tolist() == [list(s) for s in expected]
+
+    cache_path = tmp_path/'cache'
+    cache_path.mkdir()
+    (cache_path/'lock').write_text(f'{host} {dead_pid()}')
+    dataloader.build_decoded_cache(str(root), str(cache_path), 1, workers=2)
+    index = np.load(cache_path/'index.npz')
+    assert [tuple(s[::-1]) for s in index['shape'].tolist()] == expected
+    assert (cache_path/'lock').read_text() == f'{host} {os.getpid()}'
+    # a finished cache keeps its lock and isn't rebuilt
+    os.remove(cache_path/'data.u8')
+    dataloader.build_decoded_cache(str(root), str(cache_path), 1)
+    assert not (cache_path/'data.u8').exists()
+
+
+def test_lock_owner_died(tmp_path):
+    lock_fn = str(tmp_path/'lock')
+    assert dataloader.create_lock(lock_fn) and not dataloader.create_lock(lock_fn)
+    assert not dataloader.lock_owner_died(lock_fn)
+    # owners on other hosts are never presumed dead, locks without owner only after a grace period
+    for owner, died in [(f'other-host {dead_pid()}', False), ('', False)]:
+        with open(lock_fn, 'w') as f: f.write(owner)
+        assert dataloader.lock_owner_died(lock_fn) == died
+    os.utime(lock_fn, (time.time() - 120,)*2)
+    assert dataloader.lock_owner_died(lock_fn)
+    assert not dataloader.lock_owner_died(str(tmp_path/'missing'))
+
+
+def main():
+    sys.exit(pytest.main([__file__]))
+
+
+if __name__ == "__main__":
+    main()
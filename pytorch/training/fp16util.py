@@ -141,4 +141,93 @@ def to_python_float(t):
     if hasattr(t, 'item'):
         return t.item()
     else:
-        return t[0]
\ No newline at end of file
+        return t[0]
+
+class FlatMaster():
+    """
+    FP32 master copy of a model's parameters in which model params, model grads, master params and master
+    grads are all views into contiguous flat buffers. Model params are grouped by dtype (e.g. fp16 weights
+    and fp32 batchnorm params of :func:`network_to_half`), one flat buffer per dtype, while the fp32 master
+    params of all groups share one buffer. Copying grads to master (with loss scale removed) and copying
+    master params back to the model then take a couple of bulk ops instead of one per parameter.
+
+    ``master_params`` keeps one tensor per model parameter in model order, so optimizers (and their
+    ``state_dict``) see the same parameters as with :func:`prep_param_lists`.
+
+    Args:
+        model (torch.nn.Module): Model to flatten, before wrapping it in DistributedDataParallel.
+
+    Example::
+
+        flat_master = FlatMaster(model)
+        optimizer = torch.optim.SGD(flat_master.master_params, lr)
+        ...
+        flat_master.zero_grad()
+        (loss*loss_scale).backward()
+        flat_master.model_grads_to_master_grads(loss_scale)
+        optimizer.step()
+        flat_master.master_params_to_model_params()
+
+    .. warning::
+        Gradients must stay views into the flat buffers: zero them with :func:`zero_grad` rather than
+        ``model.zero_grad()`` or ``optimizer.zero_grad()``, which may set them to ``None``.
+    """
+    def __init__(self, model):
+        self.model_params = [param for param in model.parameters() if param.requires_grad]
+        dtypes = sorted({param.dtype for param in self.model_params}, key=str)
+        self.groups = [[param for param in self.model_params if param.dtype == dtype] for dtype in dtypes]
+        numel = sum(param.numel() for param in self.model_params)
+        device = self.model_params[0].device
+
+        self.master = torch.empty(numel, dtype=torch.float32, device=device)
+        self.master_grad = torch.zeros_like(self.master)
+        self.model_flat, self.model_grad, master_of = [], [], {}
+        offset = 0
+        for group in self.groups:
+            group_numel = sum(param.numel() for param in group)
+            flat = _flatten_dense_tensors([param.data for param in group])
+            grad = torch.zeros_like(flat)
+            self.master[offset:offset+group_numel].copy_(flat)
+            for param, data, param_grad, master, master_grad in zip(
+                    group, _unflatten_dense_tensors(flat, group), _unflatten_dense_tensors(grad, group),
+                    _unflatten_dense_tensors(self.master[offset:offset+group_numel], group),
+                    _unflatten_dense_tensors(self.master_grad[offset:offset+group_numel], group)):
+                param.data, param.grad = data, param_grad
+                master = torch.nn.Parameter(master)
+                master.grad = master_grad
+                master_of[param] = master
+            self.model_flat.append(flat)
+            self.model_grad.append(grad)
+            offset += group_numel
+        self.master_params = [master_of[param] for param in self.model_params]
+
+    def zero_grad(self):
+        "Zeroes model grads in place, keeping them views into the flat buffers."
+        for grad in self.model_grad: grad.zero_()
+
+    def model_grads_to_master_grads(self, loss_scale=1):
+        "Copies model grads of all groups to master grads and divides them by ``loss_scale``."
+        offset = 0
+        for grad in self.model_grad:
+            self.master_grad[offset:offset+grad.numel()].copy_(grad)
+            offset += grad.numel()
+        if loss_scale != 1: self.master_grad.mul_(1./loss_scale)
+
+    def master_params_to_model_params(self):
+        "Copies master params back to model params."
+        offset = 0
+        for flat in self.model_flat:
+            flat.copy_(self.master[offset:offset+flat.numel()])
+            offset += flat.numel()
+
+    def state_dict(self):
+        """
+        FP32 master params as a list of per-parameter tensors in model order. Saving them next to the model
+        keeps master precision across restarts. Checkpoints without them load as before, by recreating
+        master params from the model.
+        """
+        return {'master_params': [master.detach().clone() for master in self.master_params]}
+
+    def load_state_dict(self, state_dict):
+        for master, saved in zip(self.master_params, state_dict['master_params']): master.data.copy_(saved)
+        self.master_params_to_model_params()
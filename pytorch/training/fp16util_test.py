@@ -0,0 +1,114 @@
+import copy
+import sys
+
+import pytest
+import torch
+import torch.nn as nn
+
+from fp16util import FlatMaster, master_params_to_model_params, model_grads_to_master_grads, network_to_half, prep_param_lists
+
+
+LOSS_SCALE = 128
+
+
+def make_model():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(16, 32), nn.BatchNorm1d(32), nn.ReLU(), nn.Linear(32, 4))
+    return network_to_half(model)
+
+
+def batches(num_batches=5):
+    torch.manual_seed(1)
+    return [(torch.randn(8, 16), torch.randint(0, 4, (8,))) for _ in range(num_batches)]
+
+
+def make_optimizer(params):
+    return torch.optim.SGD(params, lr=0.1, momentum=0.9, weight_decay=1e-4)
+
+
+def reference_step(model, model_params, master_params, optimizer, input, target):
+    "fp16 step of train_imagenet_nv before FlatMaster"
+    loss = nn.functional.cross_entropy(model(input).float(), target) * LOSS_SCALE
+    model.zero_grad()
+    loss.backward()
+    model_grads_to_master_grads(model_params, master_params)
+    for param in master_params:
+        param.grad.data = param.grad.data/LOSS_SCALE
+    optimizer.step()
+    master_params_to_model_params(model_params, master_params)
+
+
+def flat_step(model, flat_master, optimizer, input, target):
+    loss = nn.functional.cross_entropy(model(input).float(), target) * LOSS_SCALE
+    flat_master.zero_grad()
+    loss.backward()
+    flat_master.model_grads_to_master_grads(LOSS_SCALE)
+    optimizer.step()
+    flat_master.master_params_to_model_params()
+
+
+def test_flat_master_matches_reference():
+    ref_model = make_model()
+    model = copy.deepcopy(ref_model)
+    model_params, master_params = prep_param_lists(ref_model)
+    ref_optimizer = make_optimizer(master_params)
+    flat_master = FlatMaster(model)
+    optimizer = make_optimizer(flat_master.master_params)
+    assert {p.dtype for p in model.parameters()} == {torch.float16, torch.float32}
+
+    for input, target in batches():
+        reference_step(ref_model, model_params, master_params, ref_optimizer, input, target)
+        flat_step(model, flat_master, optimizer, input, target)
+
+    for ref, param, init in zip(ref_model.parameters(), model.parameters(), make_model().parameters()):
+        assert param.dtype == ref.dtype and torch.equal(param, ref) and not torch.equal(param, init)
+    for ref, master in zip(master_params, flat_master.master_params):
+        assert torch.equal(master, ref)
+    for name, ref in ref_model.state_dict().items(): assert torch.equal(model.state_dict()[name], ref)
+
+
+def test_flat_master_views():
+    model = make_model()
+    flat_master = FlatMaster(model)
+    assert len(flat_master.model_flat) == 2
+    for master in flat_master.master_params:
+        assert master.is_leaf and master.data_ptr() - flat_master.master.data_ptr() in range(0, flat_master.master.numel()*4)
+    for param in model.parameters():
+        assert any(param.data_ptr() - flat.data_ptr() in range(0, flat.numel()*flat.element_size()) for flat in flat_master.model_flat)
+
+    input, target = batches(1)[0]
+    flat_step(model, flat_master, make_optimizer(flat_master.master_params), input, target)
+    # grads are accumulated into the flat buffers, not replaced
+    for param in model.parameters():
+        assert any(param.grad.data_ptr() - grad.data_ptr() in range(0, grad.numel()*grad.element_size()) for grad in flat_master.model_grad)
+    assert flat_master.master_grad.abs().sum() > 0
+
+
+def test_flat_master_checkpoint():
+    model = make_model()
+    flat_master = FlatMaster(model)
+    optimizer = make_optimizer(flat_master.master_params)
+    for input, target in batches(2): flat_step(model, flat_master, optimizer, input, target)
+    checkpoint = {'state_dict': model.state_dict(), 'optimizer': optimizer.state_dict(), 'fp32_master': flat_master.state_dict()}
+
+    # optimizer state loads into per-parameter master params and the other way round
+    ref_model = make_model()
+    ref_model.load_state_dict(checkpoint['state_dict'])
+    ref_optimizer = make_optimizer(prep_param_lists(ref_model)[1])
+    ref_optimizer.load_state_dict(checkpoint['optimizer'])
+    make_optimizer(FlatMaster(make_model()).master_params).load_state_dict(ref_optimizer.state_dict())
+
+    resumed_model = make_model()
+    resumed_model.load_state_dict(checkpoint['state_dict'])
+    resumed = FlatMaster(resumed_model)
+    resumed.load_state_dict(checkpoint['fp32_master'])
+    assert torch.equal(resumed.master, flat_master.master)
+    for param, resumed_param in zip(model.parameters(), resumed_model.parameters()): assert torch.equal(param, resumed_param)
+
+
+def main():
+    sys.exit(pytest.main([__file__]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import collections
+import time
+import torch
+import torch.distributed as dist
+
+def broadcast_module(module, src=0):
+    "Copies parameters and buffers of rank src to every rank, as DistributedDataParallel does on construction"
+    for t in list(module.parameters()) + list(module.buffers()): dist.broadcast(t.data, src)
+
+def broadcast_buffers(module, src=0, process_group=None):
+    """Copies buffers (e.g. BatchNorm running statistics) of rank src to every rank. DistributedDataParallel does
+    this before every forward, without it call this at least before evaluation and checkpointing"""
+    for t in module.buffers(): dist.broadcast(t.data, src, group=process_group)
+
+class GradBuckets:
+    """
+    Averages gradients across ranks with allreduce overlapped with backward, for training without
+    DistributedDataParallel.
+
+    Parameters are packed into flat buckets of about ``bucket_cap_mb`` in reverse order, which is
+    roughly the order backward produces their gradients. A hook on each parameter's grad accumulator
+    copies the gradient into its bucket, and a full bucket starts an async allreduce while backward
+    goes on. Buckets are launched in index order, so every rank issues the same sequence of collectives.
+    Call :meth:`synchronize` after backward to wait for them and copy the averages back into ``.grad``.
+
+    A parameter is ready once its hook fired as often as in the first step, which launches all buckets from
+    :meth:`synchronize` and only counts firings. So several backward passes per step (e.g. accumulation over
+    micro-batches) are waited for. A hook firing more often than that re-packs its bucket if still possible,
+    and raises if the bucket was already sent with a partial gradient.
+
+    Args:
+        params: parameters to average, in forward order (e.g. ``model.parameters()``).
+        bucket_cap_mb (float, optional, default=25): size of a bucket.
+        fp16_compress (bool, optional, default=False): allreduce fp32 gradients in fp16, halving traffic.
+            Gradients are divided by world size before the allreduce so that the fp16 sums do not overflow.
+        process_group (optional): group to reduce over, default group if None.
+    """
+    def __init__(self, params, bucket_cap_mb=25, fp16_compress=False, process_group=None):
+        self.params = [p for p in params if p.requires_grad]
+        self.process_group = process_group
+        self.world_size = dist.get_world_size(process_group)
+        self.timings = []  # ms from launch of each bucket's allreduce until synchronize saw it done, last step
+
+        # parameters of one dtype go to the same open bucket, until it is full
+        cap = bucket_cap_mb*1024*1024
+        buckets, open_buckets = [], {}
+        for p in reversed(self.params):
+            dtype = torch.float16 if fp16_compress else p.dtype
+            if dtype not in open_buckets:
+                open_buckets[dtype] = []
+                buckets.append((dtype, open_buckets[dtype]))
+            bucket = open_buckets[dtype]
+            bucket.append(p)
+            if sum(p.numel() for p in bucket)*torch.empty(0, dtype=dtype).element_size() >= cap: del open_buckets[dtype]
+
+        self.buckets, self.buffers, self.slots = [], [], {}
+        for i, (dtype, bucket) in enumerate(buckets):
+            self.buffers.append(torch.empty(sum(p.numel() for p in bucket), dtype=dtype, device=bucket[0].device))
+            self.buckets.append(bucket)
+            offset = 0
+            for p in bucket:
+                self.slots[p] = (i, self.buffers[i][offset:offset+p.numel()].view_as(p))
+                offset += p.numel()
+
+        self.expected_firings = None  # per parameter, counted in the first step
+        # grad accumulators are kept alive so that their hooks stay registered
+        self.grad_accs = []
+        for p in self.params:
+            grad_acc = p.expand_as(p).grad_fn.next_functions[0][0]
+            grad_acc.register_hook(self.make_hook(p))
+            self.grad_accs.append(grad_acc)
+        self.reset()
+
+    def reset(self):
+        expected = self.expected_firings
+        self.pending = [sum(expected is not None and expected[p] > 0 for p in bucket) for bucket in self.buckets]
+        self.firings = collections.Counter()
+        self.next_bucket = 0
+        self.works = []
+
+    def make_hook(self, p):
+        def hook(*unused): self.mark_ready(p)
+        return hook
+
+    def pack(self, p):
+        slot = self.slots[p][1]
+        # averaging before the allreduce keeps fp16 sums in range
+        if p.grad is None: slot.zero_()
+        else: torch.div(p.grad.data, self.world_size, out=slot)
+
+    def mark_ready(self, p):
+        i = self.slots[p][0]
+        assert i >= self.next_bucket, 'Gradient hook fired after its bucket was sent, more backward passes than in first step?'
+        # .grad holds the sum of all firings so far
+        self.pack(p)
+        self.firings[p] += 1
+        if self.expected_firings is None or self.firings[p] != self.expected_firings[p]: return
+        self.pending[i] -= 1
+        while self.next_bucket < len(self.buckets) and self.pending[self.next_bucket] == 0: self.launch()
+
+    def launch(self):
+        # parameters that took no part in backward reduce their current .grad, or zeros without one
+        for p in self.buckets[self.next_bucket]:
+            if p not in self.firings: self.pack(p)
+        work = dist.all_reduce(self.buffers[self.next_bucket], group=self.process_group, async_op=True)
+        self.works.append((work, time.time()))
+        self.next_bucket += 1
+
+    def synchronize(self):
+        "Waits for the allreduce of every bucket and writes the averaged gradients into ``.grad``"
+        if self.expected_firings is None: self.expected_firings = {p: self.firings[p] for p in self.params}
+        while self.next_bucket < len(self.buckets): self.launch()
+
+        self.timings = []
+        for work, start in self.works:
+            work.wait()
+            self.timings.append(1000*(time.time()-start))
+        for p in self.params:
+            slot = self.slots[p][1]
+            if p.grad is None: p.grad = slot.to(p.dtype).clone()
+            else: p.grad.data.copy_(slot)
+        self.reset()
@@ -0,0 +1,176 @@
+import os
+import socket
+import sys
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+from fp16util import FlatMaster
+from grad_buckets import GradBuckets, broadcast_buffers, broadcast_module
+
+
+WORLD_SIZE = 2
+
+
+class Net(nn.Module):
+    def __init__(self):
+        super().__init__()
+        # first in forward order, so it lands in the last bucket
+        self.unused = nn.Linear(2, 2)
+        self.body = nn.Sequential(nn.Linear(8, 32), nn.BatchNorm1d(32), nn.ReLU(), nn.Linear(32, 32), nn.ReLU(), nn.Linear(32, 4))
+
+    def forward(self, x): return self.body(x)
+
+
+def make_model(seed):
+    torch.manual_seed(seed)
+    return Net()
+
+
+def make_batch(rank):
+    torch.manual_seed(100 + rank)
+    return torch.randn(16, 8), torch.randint(0, 4, (16,))
+
+
+def loss_fn(model, input, target):
+    return nn.functional.cross_entropy(model(input), target)
+
+
+def run(rank, port, fn, kwargs):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port))
+    dist.init_process_group('gloo', rank=rank, world_size=WORLD_SIZE)
+    try: fn(rank, **kwargs)
+    finally: dist.destroy_process_group()
+
+
+def spawn(fn, **kwargs):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    mp.spawn(run, args=(port, fn, kwargs), nprocs=WORLD_SIZE)
+
+
+def bucketed_grads(rank, out, bucket_cap_mb, fp16_compress):
+    # models start different on every rank until broadcast
+    model = make_model(rank)
+    broadcast_module(model)
+    buckets = GradBuckets(model.parameters(), bucket_cap_mb=bucket_cap_mb, fp16_compress=fp16_compress)
+    launched = []
+    for step in range(2):
+        model.zero_grad()
+        loss_fn(model, *make_batch(rank + step)).backward()
+        # buckets in flight before synchronize
+        launched.append(buckets.next_bucket)
+        buckets.synchronize()
+    torch.save({'grads': [p.grad for p in model.parameters()], 'num_buckets': len(buckets.buckets),
+                'launched': launched, 'timings': buckets.timings}, f'{out}/{rank}.pt')
+
+
+@pytest.mark.parametrize('bucket_cap_mb,fp16_compress,num_buckets', [(25, False, 1), (0.001, False, 3), (0.001, True, 2)])
+def test_grad_buckets_average(tmp_path, bucket_cap_mb, fp16_compress, num_buckets):
+    spawn(bucketed_grads, out=str(tmp_path), bucket_cap_mb=bucket_cap_mb, fp16_compress=fp16_compress)
+    results = [torch.load(f'{tmp_path}/{rank}.pt') for rank in range(WORLD_SIZE)]
+
+    model = make_model(0)
+    losses = [loss_fn(model, *make_batch(rank + 1)) for rank in range(WORLD_SIZE)]
+    (sum(losses)/WORLD_SIZE).backward()
+    tol = 1e-3 if fp16_compress else 1e-6
+    for result in results:
+        assert result['num_buckets'] == num_buckets
+        assert len(result['timings']) == result['num_buckets']
+        # the first step only counts hook firings, after it the unused parameter doesn't hold back its bucket
+        assert result['launched'] == [0, result['num_buckets']]
+        for grad, expected in zip(result['grads'], model.parameters()):
+            if expected.grad is None: assert grad.abs().sum() == 0
+            else: assert grad.dtype == expected.dtype and torch.allclose(grad, expected.grad, atol=tol)
+
+
+def bn_buffers(rank, out):
+    model = make_model(0)
+    # running statistics diverge on different batches
+    model(make_batch(rank)[0])
+    before = [b.clone() for b in model.buffers()]
+    broadcast_buffers(model)
+    torch.save({'before': before, 'after': list(model.buffers())}, f'{out}/{rank}.pt')
+
+
+def test_broadcast_buffers(tmp_path):
+    spawn(bn_buffers, out=str(tmp_path))
+    results = [torch.load(f'{tmp_path}/{rank}.pt') for rank in range(WORLD_SIZE)]
+    assert not torch.equal(results[0]['before'][0], results[1]['before'][0])
+    for result in results:
+        for after, expected in zip(result['after'], results[0]['before']): assert torch.equal(after, expected)
+
+
+def flat_master_step(rank, out, wrap):
+    # same order as train_imagenet_nv main: broadcast, FlatMaster, then the distributed wrapper
+    model = make_model(rank)
+    broadcast_module(model)
+    flat_master = FlatMaster(model)
+    if wrap == 'ddp': model = nn.parallel.DistributedDataParallel(model, find_unused_parameters=True)
+    else: buckets = GradBuckets(model.parameters())
+    optimizer = torch.optim.SGD(flat_master.master_params, 0.1)
+    flat_master.zero_grad()
+    loss_fn(model, *make_batch(rank)).backward()
+    if wrap != 'ddp': buckets.synchronize()
+    flat_master.model_grads_to_master_grads()
+    optimizer.step()
+    flat_master.master_params_to_model_params()
+    torch.save([p.detach() for p in model.parameters()], f'{out}/{rank}.pt')
+
+
+@pytest.mark.parametrize('wrap', ['ddp', 'grad_buckets'])
+def test_ranks_agree_after_flat_master_step(tmp_path, wrap):
+    spawn(flat_master_step, out=str(tmp_path), wrap=wrap)
+    results = [torch.load(f'{tmp_path}/{rank}.pt') for rank in range(WORLD_SIZE)]
+    for p0, p1 in zip(*results): assert torch.equal(p0, p1)
+
+
+class TiedNet(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.shared, self.head = nn.Linear(8, 8), nn.Linear(8, 4)
+
+    def forward(self, x): return self.head(torch.relu(self.shared(torch.relu(self.shared(x)))))
+
+
+def accumulated_grads(rank, out, micro_batches):
+    torch.manual_seed(0)
+    model = TiedNet()
+    buckets = GradBuckets(model.parameters(), bucket_cap_mb=0.0001)
+    for step in range(3):
+        model.zero_grad()
+        for k in range(micro_batches): loss_fn(model, *make_batch(rank + 10*k)).backward()
+        buckets.synchronize()
+    grads = [p.grad for p in model.parameters()]
+    # one more backward pass than in the first step comes after its bucket was sent
+    model.zero_grad()
+    for k in range(micro_batches + 1):
+        try: loss_fn(model, *make_batch(rank + 10*k)).backward()
+        except AssertionError as e: error = str(e)
+    torch.save({'grads': grads, 'error': error}, f'{out}/{rank}.pt')
+
+
+@pytest.mark.parametrize('micro_batches', [1, 2])
+def test_grad_buckets_tied_weights_and_accumulation(tmp_path, micro_batches):
+    spawn(accumulated_grads, out=str(tmp_path), micro_batches=micro_batches)
+    results = [torch.load(f'{tmp_path}/{rank}.pt') for rank in range(WORLD_SIZE)]
+
+    torch.manual_seed(0)
+    model = TiedNet()
+    losses = [loss_fn(model, *make_batch(rank + 10*k)) for rank in range(WORLD_SIZE) for k in range(micro_batches)]
+    (sum(losses)/WORLD_SIZE).backward()
+    for result in results:
+        assert 'bucket was sent' in result['error']
+        for grad, expected in zip(result['grads'], model.parameters()): assert torch.allclose(grad, expected.grad, atol=1e-6)
+
+
+def main():
+    sys.exit(pytest.main([__file__]))
+
+
+if __name__ == "__main__":
+    main()
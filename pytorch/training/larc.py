@@ -1,3 +1,4 @@
+import collections
 import torch
 from torch import nn
 from torch.autograd import Variable
@@ -73,25 +74,34 @@ class LARC(object):
                 weight_decay = group['weight_decay'] if 'weight_decay' in group else 0
                 weight_decays.append(weight_decay)
                 group['weight_decay'] = 0
+                # foreach ops take tensors of one device and dtype, e.g. fp16 weights and fp32 batchnorm params
+                by_type = collections.defaultdict(list)
                 for p in group['params']:
-                    if p.grad is None:
-                        continue
-                    param_norm = torch.norm(p.data)
-                    grad_norm = torch.norm(p.grad.data)
-
-                    if param_norm != 0 and grad_norm != 0:
-                        # calculate adaptive lr + weight decay
-                        adaptive_lr = self.trust_coefficient * (param_norm) / (grad_norm + param_norm * weight_decay + self.eps)
-
-                        # clip learning rate for LARC
-                        if self.clip:
-                            # calculation of adaptive_lr so that when multiplied by lr it equals `min(adaptive_lr, lr)`
-                            adaptive_lr = min(adaptive_lr/group['lr'], 1)
-
-                        p.grad.data += weight_decay * p.data
-                        p.grad.data *= adaptive_lr
+                    if p.grad is not None: by_type[(p.device, p.dtype)].append(p)
+                for typed_params in by_type.values():
+                    params = [p.data for p in typed_params]
+                    grads = [p.grad.data for p in typed_params]
+
+                    # norms of all params and grads in one multi-tensor pass
+                    param_norms = torch.stack(torch._foreach_norm(params))
+                    grad_norms = torch.stack(torch._foreach_norm(grads))
+                    adaptive_lr = self.trust_coefficient * (param_norms) / (grad_norms + param_norms * weight_decay + self.eps)
+
+                    # clip learning rate for LARC
+                    if self.clip:
+                        # calculation of adaptive_lr so that when multiplied by lr it equals `min(adaptive_lr, lr)`
+                        adaptive_lr = torch.clamp(adaptive_lr/group['lr'], max=1)
+
+                    # params with zero param or grad norm get neither weight decay nor adaptive lr
+                    update = (param_norms != 0) & (grad_norms != 0)
+                    adaptive_lr = torch.where(update, adaptive_lr, torch.ones_like(adaptive_lr))
+                    # one copy to host per pass, foreach ops only take their fast path with host scalars
+                    scales = torch.stack([update.to(adaptive_lr.dtype), adaptive_lr]).tolist()
+
+                    torch._foreach_add_(grads, torch._foreach_mul(params, [u * weight_decay for u in scales[0]]))
+                    torch._foreach_mul_(grads, scales[1])
 
         self.optim.step()
         # return weight decay control to optimizer
         for i, group in enumerate(self.optim.param_groups):
-            group['weight_decay'] = weight_decays[i]
\ No newline at end of file
+            group['weight_decay'] = weight_decays[i]
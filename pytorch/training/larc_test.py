@@ -0,0 +1,73 @@
+import sys
+
+import pytest
+import torch
+
+from larc import LARC
+
+
+def reference_step(larc):
+    "LARC.step as it was before the multi-tensor version: norms and adaptive lr per parameter on host"
+    with torch.no_grad():
+        weight_decays = []
+        for group in larc.optim.param_groups:
+            weight_decay = group['weight_decay'] if 'weight_decay' in group else 0
+            weight_decays.append(weight_decay)
+            group['weight_decay'] = 0
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                param_norm = torch.norm(p.data)
+                grad_norm = torch.norm(p.grad.data)
+                if param_norm != 0 and grad_norm != 0:
+                    adaptive_lr = larc.trust_coefficient * (param_norm) / (grad_norm + param_norm * weight_decay + larc.eps)
+                    if larc.clip:
+                        adaptive_lr = min(adaptive_lr/group['lr'], 1)
+                    p.grad.data += weight_decay * p.data
+                    p.grad.data *= adaptive_lr
+    larc.optim.step()
+    for i, group in enumerate(larc.optim.param_groups):
+        group['weight_decay'] = weight_decays[i]
+
+
+def make_params(dtypes=(torch.float32,)*5):
+    torch.manual_seed(0)
+    shapes = [(16, 3, 3, 3), (16,), (10, 16), (10,), (4,)]
+    params = [torch.nn.Parameter(torch.randn(*shape, dtype=dtype)) for shape, dtype in zip(shapes, dtypes)]
+    params[1].data.zero_()  # zero param norm
+    return params
+
+
+@pytest.mark.parametrize('dtypes', [(torch.float32,)*5, (torch.float64, torch.float32, torch.float32, torch.float64, torch.float32)])
+@pytest.mark.parametrize('clip', [True, False])
+@pytest.mark.parametrize('weight_decay', [0, 5e-4])
+def test_larc_matches_reference(clip, weight_decay, dtypes):
+    # groups of mixed dtypes, as network_to_half leaves batchnorm params in fp32
+    params, ref_params = make_params(dtypes), make_params(dtypes)
+    def make_larc(params):
+        # large lr so that clip mode hits both branches of min(adaptive_lr/lr, 1)
+        groups = [{'params': params[:3]}, {'params': params[3:], 'weight_decay': 0}]
+        return LARC(torch.optim.SGD(groups, lr=0.05, momentum=0.9, weight_decay=weight_decay), clip=clip)
+    larc, ref_larc = make_larc(params), make_larc(ref_params)
+
+    for step in range(4):
+        grads = [torch.randn_like(p) * 10**(i-2) for i, p in enumerate(params)]
+        grads[2].zero_()  # zero grad norm
+        for p, ref_p, grad in zip(params, ref_params, grads):
+            p.grad, ref_p.grad = grad.clone(), grad.clone()
+        params[4].grad = ref_params[4].grad = None
+        larc.step()
+        reference_step(ref_larc)
+
+    for p, ref_p in zip(params, ref_params):
+        assert torch.equal(p, ref_p)
+    assert not torch.equal(params[0], make_params(dtypes)[0])
+    assert larc.param_groups[0]['weight_decay'] == weight_decay
+
+
+def main():
+    sys.exit(pytest.main([__file__]))
+
+
+if __name__ == "__main__":
+    main()
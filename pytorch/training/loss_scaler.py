@@ -7,6 +7,16 @@ def to_python_float(t):
     else:
         return t[0]
 
+def has_inf_or_nan(tensors):
+    """
+    Returns True if any of ``tensors`` holds an inf or NaN. Per-tensor checks are reduced to one flag on
+    the device, so this costs a single device-to-host sync however many tensors are checked. Passing one
+    flat gradient buffer (see :class:`fp16util.FlatMaster`) makes it a single reduction as well.
+    """
+    flags = [torch.isfinite(x).all() for x in tensors]
+    if not flags: return False
+    return not bool(torch.stack(flags).all()) if len(flags) > 1 else not bool(flags[0])
+
 class LossScaler:
     """
     Class that manages a static loss scale.  This class is intended to interact with
@@ -26,6 +36,10 @@ class LossScaler:
     def has_overflow(self, params):
         return False
 
+    # `grads` is a list of gradient tensors, e.g. [flat_master.master_grad]
+    def has_overflow_grads(self, grads):
+        return False
+
     # `x` is a torch.Tensor
     def _has_inf_or_nan(x):
         return False
@@ -82,32 +96,15 @@ class DynamicLossScaler:
 
     # `params` is a list / generator of torch.Variable
     def has_overflow(self, params):
-        for p in params:
-            if p.grad is not None and DynamicLossScaler._has_inf_or_nan(p.grad.data):
-                return True
+        return self.has_overflow_grads([p.grad.data for p in params if p.grad is not None])
 
-        return False
+    # `grads` is a list of gradient tensors, e.g. [flat_master.master_grad]
+    def has_overflow_grads(self, grads):
+        return has_inf_or_nan(grads)
 
     # `x` is a torch.Tensor
     def _has_inf_or_nan(x):
-        try:
-            # if x is half, the .float() incurs an additional deep copy, but it's necessary if 
-            # Pytorch's .sum() creates a one-element tensor of the same type as x 
-            # (which is true for some recent version of pytorch).
-            cpu_sum = float(x.float().sum())
-            # More efficient version that can be used if .sum() returns a Python scalar
-            # cpu_sum = float(x.sum())
-        except RuntimeError as instance:
-            # We want to check if inst is actually an overflow exception.
-            # RuntimeError could come from a different error.
-            # If so, we still want the exception to propagate.
-            if "value cannot be converted" not in instance.args[0]:
-                raise
-            return True
-        else:
-            if cpu_sum == float('inf') or cpu_sum == -float('inf') or cpu_sum != cpu_sum:
-                return True
-            return False
+        return has_inf_or_nan([x])
 
     # `overflow` is boolean indicating whether the gradient overflowed
     def update_scale(self, overflow):
@@ -0,0 +1,65 @@
+import sys
+
+import pytest
+import torch
+
+from fp16util import FlatMaster, network_to_half
+from loss_scaler import DynamicLossScaler, LossScaler, has_inf_or_nan
+
+
+def test_has_inf_or_nan():
+    assert not has_inf_or_nan([])
+    assert not has_inf_or_nan([torch.ones(3), torch.ones(2).half()])
+    assert has_inf_or_nan([torch.ones(3), torch.tensor([1., float('inf')]).half()])
+    assert has_inf_or_nan([torch.tensor([float('nan')])])
+    assert has_inf_or_nan([torch.tensor([-float('inf')])])
+
+
+def test_dynamic_scaler_params():
+    scaler = DynamicLossScaler(init_scale=2**8, scale_window=2)
+    param = torch.nn.Parameter(torch.zeros(3))
+    assert not scaler.has_overflow([param])
+    param.grad = torch.tensor([0., float('nan'), 1.])
+    assert scaler.has_overflow([param]) and DynamicLossScaler._has_inf_or_nan(param.grad)
+    assert not LossScaler(128).has_overflow([param])
+
+    scaler.update_scale(True)
+    assert scaler.loss_scale == 2**7
+    scaler.update_scale(False)
+    scaler.update_scale(False)
+    assert scaler.loss_scale == 2**8
+
+
+def test_flat_master_skips_overflow_step():
+    torch.manual_seed(0)
+    model = network_to_half(torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.BatchNorm1d(4)))
+    flat_master = FlatMaster(model)
+    optimizer = torch.optim.SGD(flat_master.master_params, lr=0.1)
+    scaler = DynamicLossScaler(init_scale=2**16)
+    before = flat_master.master.clone()
+
+    def step(input):
+        loss_scale = scaler.loss_scale
+        flat_master.zero_grad()
+        (model(input).float().sum() * loss_scale).backward()
+        flat_master.model_grads_to_master_grads(loss_scale)
+        overflow = scaler.has_overflow_grads([flat_master.master_grad])
+        if not overflow:
+            optimizer.step()
+            flat_master.master_params_to_model_params()
+        scaler.update_scale(overflow)
+        return overflow
+
+    # fp16 weight grads of a large input overflow at scale 2**16
+    assert step(torch.full((8, 4), 1e3))
+    assert scaler.loss_scale == 2**15 and torch.equal(flat_master.master, before)
+    assert not step(torch.randn(8, 4))
+    assert not torch.equal(flat_master.master, before)
+
+
+def main():
+    sys.exit(pytest.main([__file__]))
+
+
+if __name__ == "__main__":
+    main()
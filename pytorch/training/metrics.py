@@ -0,0 +1,38 @@
+import torch
+
+class MetricsAccumulator:
+    """
+    Keeps running sums of examples, loss and top-1/top-5 correct counts on device, so recording a step
+    does not sync with the host. Sums are reduced across ranks and read back only in :meth:`reduce`,
+    which is a collective: every rank must call it at the same steps.
+
+    Loss is summed weighted by batch size, so averages stay exact when ranks or the final batches of an
+    epoch have uneven sizes.
+
+    Args:
+        device: device of the loss and correct counts passed to :meth:`update`.
+        reduce_function (optional): in-place sum across ranks, e.g. ``dist.all_reduce``. None for a single process.
+    """
+    def __init__(self, device, reduce_function=None):
+        self.sums = torch.zeros(4, device=device)  # examples, loss*examples, correct@1, correct@5
+        self.reduced = torch.zeros_like(self.sums)
+        self.reduce_function = reduce_function
+        self.steps = 0
+
+    def update(self, loss, corr1, corr5, batch_size):
+        self.sums[0] += batch_size
+        self.sums[1].add_(loss.detach().float(), alpha=batch_size)
+        self.sums[2:].add_(torch.cat([corr1.view(1), corr5.view(1)]))
+        self.steps += 1
+
+    def reduce(self):
+        """
+        Returns (examples, mean loss, prec@1, prec@5) of all ranks over the steps since the last call,
+        with a single allreduce and device-to-host copy.
+        """
+        self.reduced.copy_(self.sums)
+        self.sums.zero_()
+        self.steps = 0
+        if self.reduce_function is not None: self.reduce_function(self.reduced)
+        count, loss_sum, corr1, corr5 = self.reduced.tolist()
+        return count, loss_sum/count, corr1*100/count, corr5*100/count
@@ -0,0 +1,57 @@
+import sys
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from metrics import MetricsAccumulator
+
+
+def correct(output, target, k):
+    return (output.topk(k, 1)[1] == target[:, None]).sum().view(1)
+
+
+def make_batches(sizes, seed=0):
+    torch.manual_seed(seed)
+    return [(torch.randn(n, 10), torch.randint(0, 10, (n,))) for n in sizes]
+
+
+def test_epoch_average_exact_for_uneven_batches():
+    batches = make_batches([32, 32, 32, 32, 32, 7])
+    metrics = MetricsAccumulator('cpu')
+    sums = [0., 0., 0.]
+    counts = []
+    for i, (output, target) in enumerate(batches):
+        metrics.update(F.cross_entropy(output, target), correct(output, target, 1), correct(output, target, 5), len(target))
+        if i % 4 == 3 or i == len(batches) - 1:
+            count, loss, prec1, prec5 = metrics.reduce()
+            counts.append(count)
+            for j, val in enumerate([loss, prec1, prec5]): sums[j] += val*count
+    assert counts == [128, 39] and metrics.steps == 0
+
+    output, target = torch.cat([b[0] for b in batches]), torch.cat([b[1] for b in batches])
+    expected = [F.cross_entropy(output, target).item(), correct(output, target, 1).item()*100/len(target),
+                correct(output, target, 5).item()*100/len(target)]
+    for total, val in zip(sums, expected): assert abs(total/sum(counts) - val) < 1e-4
+
+
+def test_reduce_sums_ranks():
+    "a reduce_function doubling the sums stands in for two ranks with the same batches"
+    output, target = make_batches([16])[0]
+    args = F.cross_entropy(output, target), correct(output, target, 1), correct(output, target, 5), 16
+    single, doubled = MetricsAccumulator('cpu'), MetricsAccumulator('cpu', lambda t: t.mul_(2))
+    single.update(*args)
+    doubled.update(*args)
+    buffer = doubled.reduced
+    count, *averages = doubled.reduce()
+    assert count == 32 and averages == list(single.reduce())[1:]
+    # buffers are reused and cleared after every reduce
+    assert doubled.reduced is buffer and doubled.sums.abs().sum() == 0
+
+
+def main():
+    sys.exit(pytest.main([__file__]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Packs ImageFolder trees into large shard files for dataloader.PackedDataset.
+
+python pack_images.py ~/data/imagenet-sz/160 ~/data/imagenet-sz/160-packed
+
+Each of train/validation becomes a directory with shard-NNNNN.bin files holding concatenated
+image bytes and index.npz with shard/offset/length/label of every image. Images keep ImageFolder
+order, so indices (e.g. validation_sizes.npy) computed on the original tree stay valid.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torchvision.datasets as datasets
+from tqdm import tqdm
+import fire
+
+from dataloader import PACKED_INDEX_FN as INDEX_FN, packed_shard_fn as shard_fn
+
+def read_file(fname):
+    with open(fname, 'rb') as f: return f.read()
+
+def pack_folder(source_dir, dest_dir, shard_size_mb=1024, read_chunk=1024):
+    "Packs single ImageFolder directory. Index is written last, so its presence marks finished pack."
+    if os.path.exists(os.path.join(dest_dir, INDEX_FN)):
+        print(f'{dest_dir} already packed, skipping')
+        return
+    os.makedirs(dest_dir, exist_ok=True)
+    folder = datasets.ImageFolder(source_dir)
+    fnames, labels = zip(*folder.samples)
+    n = len(fnames)
+    shard, offset, length = np.zeros(n, np.int32), np.zeros(n, np.int64), np.zeros(n, np.int64)
+    shard_size = shard_size_mb * 1024 * 1024
+
+    shard_idx, shard_pos = 0, 0
+    out = open(shard_fn(dest_dir, shard_idx), 'wb')
+    with ThreadPoolExecutor() as e, tqdm(total=n, leave=False) as pbar:
+        for start in range(0, n, read_chunk):
+            for i, data in enumerate(e.map(read_file, fnames[start:start+read_chunk]), start):
+                if shard_pos and shard_pos + len(data) > shard_size:
+                    out.close()
+                    shard_idx, shard_pos = shard_idx+1, 0
+                    out = open(shard_fn(dest_dir, shard_idx), 'wb')
+                out.write(data)
+                shard[i], offset[i], length[i] = shard_idx, shard_pos, len(data)
+                shard_pos += len(data)
+            pbar.update(min(read_chunk, n-start))
+    out.close()
+
+    tmp_fn = os.path.join(dest_dir, 'index.tmp.npz')
+    np.savez(tmp_fn, shard=shard, offset=offset, length=length, label=np.array(labels, np.int64),
+             classes=np.array(folder.classes))
+    os.rename(tmp_fn, os.path.join(dest_dir, INDEX_FN))
+    print(f'Packed {n} images from {source_dir} into {shard_idx+1} shards')
+
+def pack(source_dir, dest_dir, shard_size_mb=1024, folders=('train', 'validation')):
+    for folder in folders:
+        pack_folder(os.path.join(source_dir, folder), os.path.join(dest_dir, folder), shard_size_mb)
+
+if __name__ == '__main__':
+  fire.Fire(pack)
@@ -1,29 +1,70 @@
+"""Resizes ImageNet so that shorter side of images is targ, e.g. to make -sz/160 and -sz/352 trees in one pass:
+
+python resize_images.py 160,352 --source_dir ~/data/imagenet --resize_folder ~/data/imagenet-sz
+
+Installing pillow-simd in place of pillow speeds up resizing further.
+"""
 import os
+import shutil
 from PIL import Image
 import math
 import glob
+from itertools import repeat
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 import fire
 
-def resize_img(fname, targ, path, new_path):
-    dest = os.path.join(path,new_path,str(targ),fname)
-    if os.path.exists(dest): return
-    im = Image.open(os.path.join(path, fname)).convert('RGB')
+def resize_img(fname, targs, path, new_path):
+    """Resizes image to every size in targs (shorter side) with a single decode, returns fname once all are written.
+    JPEGs are decoded with draft(), which downscales in DCT domain to the smallest power of 2 reduction above the
+    largest target. Images already small enough are copied as is when they are RGB."""
+    src = os.path.join(path, fname)
+    dests = {targ: os.path.join(path, new_path, str(targ), fname) for targ in targs}
+    for dest in dests.values(): os.makedirs(os.path.split(dest)[0], exist_ok=True)
+    im = Image.open(src)  # lazy, only header is read
     r,c = im.size
-    os.makedirs(os.path.split(dest)[0], exist_ok=True)
-    if min(r,c) < targ: return im.save(dest)
-    ratio = targ/min(r,c)
-    sz = (scale_to(r, ratio, targ), scale_to(c, ratio, targ))
-    im.resize(sz, Image.BILINEAR).save(dest)
-
-def resize_imgs(fnames, targ, path, new_path):
-    if not os.path.exists(os.path.join(path,new_path,str(targ),fnames[0])):
-        with ThreadPoolExecutor() as e:
-            ims = e.map(lambda x: resize_img(x, targ, path, new_path), fnames)
-            for x in tqdm(ims, total=len(fnames), leave=False): pass
-    return os.path.join(path,new_path,str(targ))
+    small = [targ for targ in targs if min(r,c) <= targ]
+    if small and im.mode == 'RGB' and im.format == 'JPEG':
+        for targ in small: shutil.copyfile(src, dests[targ])
+        small = []
+    large = [targ for targ in targs if min(r,c) > targ]
+    if not small and not large: return fname
+    # small images that need conversion are saved at full resolution, so no draft for them
+    if large and not small:
+        ratio = max(large)/min(r,c)
+        im.draft('RGB', (scale_to(r, ratio, max(large)), scale_to(c, ratio, max(large))))
+    im = im.convert('RGB')
+    for targ in small: im.save(dests[targ])
+    for targ in large:
+        # output size is computed from original size, draft may have rounded dimensions
+        ratio = targ/min(r,c)
+        sz = (scale_to(r, ratio, targ), scale_to(c, ratio, targ))
+        im.resize(sz, Image.BILINEAR).save(dests[targ])
+    return fname
+
+def manifest_fn(path, new_path, targ): return os.path.join(path, new_path, str(targ), 'manifest.txt')
+
+def read_manifest(fn):
+    if not os.path.exists(fn): return set()
+    with open(fn) as f: return set(f.read().splitlines())
+
+def resize_imgs(fnames, targs, path, new_path, workers=None):
+    """Resizes fnames to all targs in a process pool. Finished files are appended to per-size manifest, so interrupted
+    runs continue where they stopped."""
+    manifests = {targ: read_manifest(manifest_fn(path, new_path, targ)) for targ in targs}
+    todo = [(fname, [targ for targ in targs if fname not in manifests[targ]]) for fname in fnames]
+    todo = [(fname, missing) for fname, missing in todo if missing]
+    print(f'Resizing {len(todo)} of {len(fnames)} images to {targs}')
+    if todo:
+        for targ in targs: os.makedirs(os.path.join(path, new_path, str(targ)), exist_ok=True)
+        manifest_files = {targ: open(manifest_fn(path, new_path, targ), 'a') for targ in targs}
+        with ProcessPoolExecutor(workers) as e:
+            done = e.map(resize_img, *zip(*todo), repeat(path), repeat(new_path), chunksize=256)
+            for (fname, missing), _ in tqdm(zip(todo, done), total=len(todo), leave=False):
+                for targ in missing: manifest_files[targ].write(fname+'\n')
+        for f in manifest_files.values(): f.close()
+    return [os.path.join(path,new_path,str(targ)) for targ in targs]
 
 def read_dir(path, folder):
     full_path = os.path.join(path, folder)
@@ -46,7 +87,8 @@ def read_dirs(path, folder):
 
 def scale_to(x, ratio, targ): return max(math.floor(x*ratio), targ)
 
-def resize(targ, source_dir=None, resize_folder='resize'):
+def resize(targ, source_dir=None, resize_folder='resize', workers=None):
+    targs = sorted(targ) if isinstance(targ, (list, tuple)) else [targ]
     if source_dir is None:
         source_dir = Path.home()/'data/imagenet'
     val_filenames, val_labels, val_all_labels = read_dirs(source_dir, 'validation'); 
@@ -55,8 +97,8 @@ def resize(targ, source_dir=None, resize_folder='resize'):
     train_filenames, train_labels, train_all_labels = read_dirs(source_dir, 'train'); len(train_filenames)
     print(f'Found {len(train_filenames)} training images')
 
-    resize_imgs(train_filenames, targ, source_dir, resize_folder)
-    resize_imgs(val_filenames, targ, source_dir, resize_folder)
+    resize_imgs(train_filenames, targs, source_dir, resize_folder, workers)
+    resize_imgs(val_filenames, targs, source_dir, resize_folder, workers)
 
 if __name__ == '__main__':
   fire.Fire(resize)
\ No newline at end of file
@@ -21,6 +21,9 @@ from tensorboardX import SummaryWriter
 
 # import models
 from fp16util import *
+from loss_scaler import DynamicLossScaler, LossScaler
+from metrics import MetricsAccumulator
+from grad_buckets import GradBuckets, broadcast_buffers, broadcast_module
 import gc
 
 import resnet
@@ -92,9 +95,15 @@ def get_parser():
     parser.add_argument('--fp16', action='store_true', help='Run model fp16 mode.')
     parser.add_argument('--loss-scale', type=float, default=1,
                         help='Loss scaling, positive power of 2 values can improve fp16 convergence.')
+    parser.add_argument('--dynamic-loss-scale', action='store_true',
+                        help='Skip steps with fp16 overflow and adjust loss scale, starting from --loss-scale if above 1, else 2**16.')
     parser.add_argument('--prof', dest='prof', action='store_true', help='Only run a few iters for profiling.')
     parser.add_argument('--distributed', action='store_true', help='Run distributed training')
     parser.add_argument('--c10d', action='store_true', help='Run distributed training with c10d')
+    parser.add_argument('--grad-buckets', action='store_true',
+                        help='Average gradients with grad_buckets.GradBuckets instead of DistributedDataParallel')
+    parser.add_argument('--bucket-cap-mb', default=25, type=float, help='size of gradient buckets for --grad-buckets')
+    parser.add_argument('--fp16-allreduce', action='store_true', help='Allreduce fp32 gradients in fp16 with --grad-buckets')
     parser.add_argument('--world-size', default=-1, type=int, 
                         help='total number of processes (machines*gpus)')
     parser.add_argument('--dist-url', default='env://', type=str,
@@ -105,34 +114,68 @@ def get_parser():
                         'or automatically set by using \'python -m multiproc\'.')
     parser.add_argument('--logdir', default='', type=str,
                         help='where logs go')
+    parser.add_argument('--cache-dir', default='/dev/shm/decoded', type=str,
+                        help='where phases with "cache":True keep decoded training images (local NVMe or tmpfs)')
+    parser.add_argument('--cache-budget-gb', default=64, type=float,
+                        help='max size of decoded image cache per phase, remaining images are decoded from JPEG')
+    parser.add_argument('--prefetch-depth', default=1, type=int, help='number of batches copied to GPU ahead of time')
+    parser.add_argument('--gpu-aug', action='store_true', help='Do random crops and flips of training images on GPU')
     return parser
 
 cudnn.benchmark = True
 args = get_parser().parse_args()
 if args.local_rank > 0: sys.stdout = open(f'{args.save_dir}/GPU_{args.local_rank}.log', 'w')
+if args.grad_buckets: assert(args.distributed and not args.c10d)
 if args.c10d:
     assert(args.distributed)
     from torch.distributed import c10d
     from torch.nn.parallel import distributed_c10d
 
 class DataManager():
-    def __init__(self, phases):
+    """Serves train and validation data of all phases from one persistent worker pool (dataloader.PhasedLoader).
+    Stream of batches is laid out up front: train epoch, validation, next train epoch... from start_epoch to tot_epochs,
+    so next phase's first batches are prefetched before the phase boundary."""
+    def __init__(self, phases, start_epoch, tot_epochs, evaluate=False):
         self.phases = self.preload_phase_data(phases)
+        self.start_epoch = start_epoch
+        epochs = [start_epoch] if evaluate else range(start_epoch, tot_epochs)
+        segments = []
+        for epoch in epochs:
+            data_phase, bs = self.get_data_phase(epoch)
+            trn_dataset, trn_smp, val_dataset, val_smp = data_phase['data']
+            if not evaluate:
+                if isinstance(trn_smp, dataloader.DistArBatchSampler): trn_batch_smp = trn_smp.with_batch_size(bs)
+                else: trn_batch_smp = torch.utils.data.BatchSampler(trn_smp or torch.utils.data.RandomSampler(trn_dataset), bs, drop_last=False)
+                segments.append((data_phase['dataset_idx'], trn_batch_smp, epoch))
+            segments.append((data_phase['dataset_idx']+1, val_smp, epoch))
+        datasets = [ds for p in self.phases if 'data' in p for ds in (p['data'][0], p['data'][2])]
+        self.loader = dataloader.PhasedLoader(datasets, segments, workers=args.workers)
+        self.val_dl = self.loader.segment(len(segments)-1) if evaluate else None
+
     def set_epoch(self, epoch):
         cur_phase = self.get_phase(epoch)
         if cur_phase: self.set_data(cur_phase)
-        if hasattr(self.trn_smp, 'set_epoch'): self.trn_smp.set_epoch(epoch)
-        if hasattr(self.val_smp, 'set_epoch'): self.val_smp.set_epoch(epoch)
+        segment_idx = 2*(epoch-self.start_epoch)
+        self.trn_dl, self.val_dl = self.loader.segment(segment_idx), self.loader.segment(segment_idx+1)
+        self.trn_aug = None
+        if args.gpu_aug:
+            data_phase, _ = self.get_data_phase(epoch)
+            self.trn_aug = dataloader.GPUAugment(data_phase['sz'], (data_phase.get('min_scale', 0.08), 1.0))
 
     def get_phase(self, epoch):
         return next((p for p in self.phases if p['ep'] == epoch), None)
 
+    def get_data_phase(self, epoch):
+        """Returns last phase with data started by epoch and current batch size"""
+        started = [p for p in self.phases if p['ep'] <= epoch]
+        assert started, f'No data phase for epoch {epoch}'
+        return next(p for p in reversed(started) if 'data' in p), started[-1]['bs']
+
     def set_data(self, phase):
-        """Initializes data loader."""
+        """Logs phase change, data itself is switched by the loader. Phases are kept, get_data_phase needs them."""
         if phase.get('keep_dl', False):
             print(f'Batch size changed, dataset remains the same. \nBatch size: {phase["bs"]}')
             log_tb('sizes/batch', phase['bs'])
-            self.trn_dl.batch_sampler.batch_size = phase['bs']
             return
         
         print(f'Dataset changed. \nImage size: {phase["sz"]} \nBatch size: {phase["bs"]} \nTrain Directory: {phase["trndir"]}\nValidation Directory: {phase["valdir"]}')
@@ -140,9 +183,6 @@ class DataManager():
         log_tb('sizes/batch', phase['bs'])
         log_tb('sizes/world', args.world_size)
 
-        self.trn_dl, self.val_dl, self.trn_smp, self.val_smp = phase['data']
-        self.phases.remove(phase)
-
         # clear memory before we begin training
         gc.collect()
         torch.cuda.empty_cache()
@@ -152,10 +192,13 @@ class DataManager():
         
     def preload_phase_data(self, phases):
         previous_bs = None
+        num_datasets = 0
         for phase in phases:
             if not phase.get('keep_dl', False):
                 self.expand_directories(phase)
                 phase['data'] = self.preload_data(**phase)
+                phase['dataset_idx'] = num_datasets  # train dataset, validation dataset follows it
+                num_datasets += 2
 
             if args.autoscale_lr2batch and previous_bs: 
                 phase['autoscale_lr'] = phase['bs']/previous_bs
@@ -164,17 +207,19 @@ class DataManager():
         return phases
 
     def expand_directories(self, phase):
+        # trndir/valdir may also point at trees packed with pack_images.py, dataloader detects them
         trndir = phase.get('trndir', '')
         valdir = phase.get('valdir', trndir)
         phase['trndir'] = args.data+trndir+'/train'
         phase['valdir'] = args.data+valdir+'/validation'
 
-    def preload_data(self, ep, sz, bs, trndir, valdir, **kwargs): # dummy ep var to prevent error
-        """Pre-initializes data-loaders. Use set_data to start using it."""
+    def preload_data(self, ep, sz, bs, trndir, valdir, cache=False, **kwargs): # dummy ep var to prevent error
+        """Creates datasets and samplers of the phase."""
         if sz == 128: val_bs = 512
         elif sz == 224: val_bs = 192
         else: val_bs = 128
-        return dataloader.get_loaders(trndir, valdir, bs=bs, val_bs=val_bs, sz=sz, workers=args.workers, distributed=args.distributed, **kwargs)
+        if cache: kwargs.update(cache_dir=args.cache_dir, cache_budget_gb=args.cache_budget_gb)
+        return dataloader.get_datasets(trndir, valdir, sz, val_bs, distributed=args.distributed, gpu_aug=args.gpu_aug, bs=bs, **kwargs)
 
 # ### Learning rate scheduler
 class Scheduler():
@@ -311,18 +356,32 @@ def main():
     # Load model from checkpoint. This must happen distributed as model is saved without it
     if args.resume:
         checkpoint = torch.load(args.resume, map_location = lambda storage, loc: storage.cuda(args.local_rank))
-        model.load_state_dict(checkpoint['state_dict'])
+        load_model_state(model, checkpoint['state_dict'])
         args.start_epoch = checkpoint['epoch']
         best_prec5 = checkpoint['best_prec5']
 
+    # ranks start from the weights of rank 0. FlatMaster copies them into its fp32 masters, so this can't be left
+    # to DistributedDataParallel, whose broadcast only reaches model params and would be undone by the first step
+    if args.c10d: c10d_broadcast_module(model, process_group)
+    elif args.distributed: broadcast_module(model)
+
+    # master params and grads are flattened before DistributedDataParallel sees the model
+    global flat_master, loss_scaler, grad_buckets
+    if args.fp16:
+        flat_master = FlatMaster(model)
+        if args.dynamic_loss_scale: loss_scaler = DynamicLossScaler(init_scale=args.loss_scale if args.loss_scale > 1 else 2**16)
+        else: loss_scaler = LossScaler(args.loss_scale)
+        if args.resume and 'fp32_master' in checkpoint: flat_master.load_state_dict(checkpoint['fp32_master'])
+
     if args.c10d:
         model = distributed_c10d._DistributedDataParallelC10d(model, process_group, device_ids=[args.local_rank], output_device=args.local_rank)
         c10d_sanity_check()
+    elif args.distributed and args.grad_buckets:
+        grad_buckets = GradBuckets(model.parameters(), bucket_cap_mb=args.bucket_cap_mb, fp16_compress=args.fp16_allreduce)
     elif args.distributed: model = nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank], output_device=args.local_rank)
 
-    global model_params, master_params
-    if args.fp16: model_params, master_params = prep_param_lists(model)
-    else: model_params = master_params = model.parameters()
+    if args.fp16: model_params, master_params = flat_master.model_params, flat_master.master_params
+    else: model_params = master_params = list(model.parameters())
 
     optim_params = experimental_utils.bnwd_optim_params(model, model_params, master_params) if args.no_bn_wd else master_params
 
@@ -335,9 +394,9 @@ def main():
 
     # Load data data manager and lr scheduler from phases
     phases = eval(args.phases)
-    print("Creating data loaders (this could take 6-12 minutes)")
-    dm = DataManager([p for p in phases if 'bs' in p])
     scheduler = Scheduler(optimizer, [p for p in phases if 'lr' in p], args.scale_lr)
+    print("Creating data loaders (this could take 6-12 minutes)")
+    dm = DataManager([p for p in phases if 'bs' in p], args.start_epoch, scheduler.tot_epochs, evaluate=args.evaluate)
 
     start_time = datetime.now() # Loading start to after everything is loaded
     if args.evaluate: return validate(dm.val_dl, model, criterion, 0, start_time)
@@ -352,8 +411,10 @@ def main():
         estart = time.time()
         dm.set_epoch(epoch)
 
-        train(dm.trn_dl, model, criterion, optimizer, scheduler, epoch)
+        train(dm.trn_dl, model, criterion, optimizer, scheduler, epoch, augment=dm.trn_aug)
         if args.prof: break
+        # BatchNorm statistics of rank 0 are evaluated and saved, as with DistributedDataParallel
+        if args.grad_buckets: broadcast_buffers(model)
         prec5 = validate(dm.val_dl, model, criterion, epoch, start_time)
 
         is_best = prec5 > best_prec5
@@ -377,13 +438,17 @@ def to_python_float(t):
     if hasattr(t, 'item'): return t.item()
     else: return t[0]
 
+def c10d_broadcast_module(module, process_group):
+    "grad_buckets.broadcast_module for the c10d process group, which is not the default group"
+    for t in list(module.parameters()) + list(module.buffers()): process_group.broadcast([t.data], c10d.BroadcastOptions()).wait()
+
 def c10d_sanity_check():
     print('Sanity check to make sure tensor creation works')
     tt = torch.tensor([1]).float().cuda()
     print('Currently deadlock here', tt)
     print('Woot able to reduce tensor:', sum_tensor(tt))
 
-def train(trn_loader, model, criterion, optimizer, scheduler, epoch):
+def train(trn_loader, model, criterion, optimizer, scheduler, epoch, augment=None):
     global is_chief, event_writer, global_example_count, last_recv_bytes, last_transmit_bytes, last_log_time
 
     batch_time = AverageMeter()
@@ -394,6 +459,8 @@ def train(trn_loader, model, criterion, optimizer, scheduler, epoch):
 
     recv_meter = AverageMeter()
     transmit_meter = AverageMeter()
+    skipped_steps = 0
+    metrics = MetricsAccumulator(torch.cuda.current_device(), reduce_function if args.distributed else None)
     
     # switch to train mode
     model.train()
@@ -403,7 +470,7 @@ def train(trn_loader, model, criterion, optimizer, scheduler, epoch):
     trn_len = len(trn_loader)
 
     # print('Begin training loop:', st)
-    for i,(input,target) in enumerate(dataloader.DataPrefetcher(trn_loader, fp16=args.fp16)):
+    for i,(input,target) in enumerate(dataloader.DataPrefetcher(trn_loader, fp16=args.fp16, depth=args.prefetch_depth, augment=augment)):
         batch_size = input.size(0)
         batch_num = i+1
         # if i == 0: print('Received input:', time.time()-st)
@@ -417,42 +484,31 @@ def train(trn_loader, model, criterion, optimizer, scheduler, epoch):
         output = model(input)
         loss = criterion(output, target)
 
-        if args.distributed:
-            # Must keep track of global batch size, since not all machines are guaranteed equal batches at the end of an epoch
-            corr1, corr5 = correct(output.data, target, topk=(1, 5))
-            metrics = torch.tensor([batch_size, loss, corr1, corr5]).float().cuda()
-            batch_total, reduced_loss, corr1, corr5 = sum_tensor(metrics).cpu().numpy()
-            reduced_loss = reduced_loss/args.world_size
-            prec1 = corr1*(100.0/batch_total)
-            prec5 = corr5*(100.0/batch_total)
-        else:
-            reduced_loss = loss.data
-            batch_total = input.size(0)
-            prec1, prec5 = accuracy(output.data, target, topk=(1, 5)) # measure accuracy and record loss
-
-        reduced_loss = to_python_float(reduced_loss)
-        batch_total = to_python_float(batch_total)
-        prec1 = to_python_float(prec1)
-        prec5 = to_python_float(prec5)
-        losses.update(reduced_loss, batch_total)
-        top1.update(prec1, batch_total)
-        top5.update(prec5, batch_total)
+        # Sums stay on device and are reduced only when printing. Must keep track of global batch size,
+        # since not all machines are guaranteed equal batches at the end of an epoch
+        corr1, corr5 = correct(output.data, target, topk=(1, 5))
+        metrics.update(loss, corr1, corr5, batch_size)
 
         # compute gradient and do SGD step
         # if i == 0: print('Evaluate and loss:', time.time()-st)
         if args.fp16:
-            loss = loss*args.loss_scale
-            model.zero_grad()
+            loss_scale = loss_scaler.loss_scale
+            loss = loss*loss_scale
+            flat_master.zero_grad()
             loss.backward()
-            model_grads_to_master_grads(model_params, master_params)
-            for param in master_params:
-                param.grad.data = param.grad.data/args.loss_scale
-            optimizer.step()
-            master_params_to_model_params(model_params, master_params)
-            torch.cuda.synchronize()
+            if args.grad_buckets: grad_buckets.synchronize()
+            flat_master.model_grads_to_master_grads(loss_scale)
+            # inf/nan of any grad survives the copy, so one check of the flat master grads covers all params
+            overflow = loss_scaler.has_overflow_grads([flat_master.master_grad])
+            if overflow: skipped_steps += 1
+            else:
+                optimizer.step()
+                flat_master.master_params_to_model_params()
+            loss_scaler.update_scale(overflow)
         else:
             optimizer.zero_grad()
             loss.backward()
+            if args.grad_buckets: grad_buckets.synchronize()
             optimizer.step()
 
         # if i == 0: print('Backward step:', time.time()-st)
@@ -461,6 +517,14 @@ def train(trn_loader, model, criterion, optimizer, scheduler, epoch):
         end = time.time()
 
         should_print = (batch_num%args.print_freq == 0) or (batch_num==trn_len)
+        if should_print:
+            # every rank reduces here, so AverageMeter.val averages the batches since the last print
+            # and AverageMeter.avg is the exact epoch average at the last batch
+            window_steps = metrics.steps
+            batch_total, reduced_loss, prec1, prec5 = metrics.reduce()
+            losses.update(reduced_loss, batch_total)
+            top1.update(prec1, batch_total)
+            top5.update(prec5, batch_total)
         if args.local_rank == 0 and should_print:
           
             log_tb("memory/allocated_gb", torch.cuda.memory_allocated()/1e9)
@@ -470,10 +534,15 @@ def train(trn_loader, model, criterion, optimizer, scheduler, epoch):
             
             log_tb("times/step", 1000*batch_time.val)
             log_tb("times/data", 1000*data_time.val)
-            log_tb("losses/xent", losses.val)
-            log_tb("sizes/batch_total", batch_total)
-            log_tb("losses/train_1", top1.val)   # precision@1
-            log_tb("losses/train_5", top5.val)   # precision@5
+            if args.grad_buckets:
+                for bucket, ms in enumerate(grad_buckets.timings): log_tb(f"times/allreduce_bucket_{bucket}", ms)
+            log_tb("losses/xent_window_avg", losses.val)
+            log_tb("sizes/batch_total", batch_total/window_steps)
+            log_tb("losses/train_1_window_avg", top1.val)   # precision@1
+            log_tb("losses/train_5_window_avg", top5.val)   # precision@5
+            if args.fp16:
+                log_tb("losses/loss_scale", loss_scaler.loss_scale)
+                log_tb("losses/skipped_steps", skipped_steps)
             images_per_sec = batch_size/batch_time.val
             log_tb("times/1gpu_images_per_sec", images_per_sec)
             log_tb("times/8gpu_images_per_sec", 8*images_per_sec)
@@ -500,9 +569,9 @@ def train(trn_loader, model, criterion, optimizer, scheduler, epoch):
             output = ('Epoch: [{0}][{1}/{2}]\t' \
                     + 'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t' \
                     + 'Data {data_time.val:.3f} ({data_time.avg:.3f})\t' \
-                    + 'Loss {loss.val:.4f} ({loss.avg:.4f})\t' \
-                    + 'Prec@1 {top1.val:.3f} ({top1.avg:.3f})\t' \
-                    + 'Prec@5 {top5.val:.3f} ({top5.avg:.3f})\t' \
+                    + 'Loss(window avg) {loss.val:.4f} ({loss.avg:.4f})\t' \
+                    + 'Prec@1(window avg) {top1.val:.3f} ({top1.avg:.3f})\t' \
+                    + 'Prec@5(window avg) {top5.val:.3f} ({top5.avg:.3f})\t' \
                       + 'bw {recv_meter.val:.3f} {transmit_meter.val:.3f}').format(
                     epoch, batch_num, trn_len, batch_time=batch_time,
                       data_time=data_time, loss=losses, top1=top1, top5=top5,
@@ -511,7 +580,8 @@ def train(trn_loader, model, criterion, optimizer, scheduler, epoch):
             with open(f'{args.save_dir}/full.log', 'a') as f:
                 f.write(output + '\n')
 
-        global_example_count+=batch_total
+        # host side count of all ranks' examples, so every batch advances the tensorboard step without a sync
+        global_example_count += batch_size*(args.world_size if args.distributed else 1)
 
              
             
@@ -532,7 +602,7 @@ def validate(val_loader, model, criterion, epoch, start_time):
     end = time.time()
     val_len = len(val_loader)
 
-    for i,(input,target) in enumerate(dataloader.DataPrefetcher(val_loader, fp16=args.fp16)):
+    for i,(input,target) in enumerate(dataloader.DataPrefetcher(val_loader, fp16=args.fp16, depth=args.prefetch_depth)):
         batch_num = i+1
         if args.distributed:
             prec1, prec5, loss, batch_total = distributed_predict(input, target, model, criterion)
@@ -585,8 +655,7 @@ def distributed_predict(input, target, model, criterion):
         with torch.no_grad():
             # using module instead of model because DistributedDataParallel forward function has a sync point.
             # with distributed validation sampler, we don't always have data for each gpu
-            assert(is_distributed_model(model))
-            output = model.module(input)
+            output = model.module(input) if is_distributed_model(model) else model(input)
             loss = criterion(output, target).data
         # measure accuracy and record loss
         valid_batches = 1
@@ -607,9 +676,14 @@ def save_checkpoint(epoch, model, best_prec5, optimizer, is_best=False, filename
         'epoch': epoch+1, 'state_dict': model.state_dict(),
         'best_prec5': best_prec5, 'optimizer' : optimizer.state_dict(),
     }
+    if args.fp16: state['fp32_master'] = flat_master.state_dict()
     torch.save(state, filename)
     if is_best: shutil.copyfile(filename, f'{args.save_dir}/{filename}')
 
+def load_model_state(model, state_dict):
+    "Loads weights saved with or without DistributedDataParallel wrapper, whose keys start with module."
+    model.load_state_dict({k[len('module.'):] if k.startswith('module.') else k: v for k, v in state_dict.items()})
+
 def is_distributed_model(model):
     return isinstance(model, nn.parallel.DistributedDataParallel) or (args.c10d and isinstance(model, distributed_c10d._DistributedDataParallelC10d))
 
@@ -0,0 +1,64 @@
+import importlib
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+
+class SizedDataset(torch.utils.data.Dataset):
+    def __init__(self, sz, n): self.sz, self.n = sz, n
+    def __len__(self): return self.n
+    def __getitem__(self, idx): return np.full((self.sz, self.sz, 3), idx, dtype=np.uint8), idx
+
+
+def preload_data(self, ep, sz, bs, trndir, valdir, **kwargs):
+    val_sampler = torch.utils.data.BatchSampler(torch.utils.data.SequentialSampler(range(4)), 2, drop_last=False)
+    return SizedDataset(sz, 8), None, SizedDataset(sz, 4), val_sampler
+
+
+@pytest.fixture
+def nv(monkeypatch):
+    # arguments are parsed on import
+    monkeypatch.setattr(sys, 'argv', [sys.argv[0], 'imagenet', '--workers', '0'])
+    module = importlib.import_module('train_imagenet_nv')
+    monkeypatch.setattr(module, 'event_writer', module.NoOp(), raising=False)
+    monkeypatch.setattr(module, 'global_example_count', 0, raising=False)
+    monkeypatch.setattr(module.DataManager, 'preload_data', preload_data)
+    return module
+
+
+@pytest.mark.parametrize('gpu_aug', [False, True])
+def test_data_manager_phase_boundaries(nv, monkeypatch, gpu_aug):
+    monkeypatch.setattr(nv.args, 'gpu_aug', gpu_aug)
+    phases = [{'ep': 0, 'sz': 8, 'bs': 4}, {'ep': 1, 'bs': 2, 'keep_dl': True}, {'ep': 2, 'sz': 16, 'bs': 4}]
+    dm = nv.DataManager(phases, 0, 4)
+    expected = [(8, 4), (8, 2), (16, 4), (16, 4)]
+    for epoch, (sz, bs) in enumerate(expected):
+        dm.set_epoch(epoch)
+        batches = list(dm.trn_dl)
+        assert len(batches) == len(dm.trn_dl) == 8 // bs
+        assert all(input.shape == (bs, 3, sz, sz) for input, _ in batches)
+        assert [input.shape[-1] for input, _ in dm.val_dl] == [sz, sz]
+        if gpu_aug: assert dm.trn_aug.sz == sz
+        else: assert dm.trn_aug is None
+        # phases stay known after their switch, per phase checkpoints are named by them
+        assert dm.get_phase(epoch) is (phases[epoch] if epoch < len(phases) else None)
+
+
+def test_load_model_state_strips_ddp_prefix(nv):
+    source = torch.nn.Sequential(torch.nn.Linear(2, 2), torch.nn.BatchNorm1d(2))
+    source[1].running_mean.fill_(3)
+    ddp_state = {'module.'+k: v for k, v in source.state_dict().items()}
+    for state in [source.state_dict(), ddp_state]:
+        model = torch.nn.Sequential(torch.nn.Linear(2, 2), torch.nn.BatchNorm1d(2))
+        nv.load_model_state(model, state)
+        for k, v in model.state_dict().items(): assert torch.equal(v, source.state_dict()[k])
+
+
+def main():
+    sys.exit(pytest.main([__file__]))
+
+
+if __name__ == "__main__":
+    main()
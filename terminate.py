@@ -64,7 +64,14 @@ if not args.limit_to_key:
 def main():
   ec2 = u.create_ec2_resource()         # ec2 resource
   ec2_client = u.create_ec2_client()    # ec2 client
-  instances = list(ec2.instances.all()) # todo: use filter?
+  # filter on server side by name, state and key
+  name_pattern = '' if fragment in u.EMPTY_NAME else '*%s*'%(fragment,)
+  states = ['pending', 'running', 'stopping', 'stopped']
+  if args.skip_stopped:
+    states = ['pending', 'running']
+  key_pattern = '*%s*'%(USER_KEY_NAME,) if args.limit_to_key else ''
+  filters = u.make_instance_filters(name_pattern, states, key_pattern)
+  instances = list(ec2.instances.filter(Filters=filters))
   region = u.get_region()
 
   instances_to_kill = []
@@ -88,6 +95,7 @@ def main():
 
   # print extra info if couldn't find anything to kill
   if not instances_to_kill:
+    instances = list(ec2.instances.all())
     valid_names = sorted(list(set("%s,%s"%(u.get_name(i),
                                            u.get_state(i)) for i in instances)))
     from pprint import pprint as pp
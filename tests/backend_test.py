@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+
+import pytest
+
+module_path=os.path.dirname(os.path.abspath(__file__))
+sys.path.append(module_path+'/..')
+import backend
+
+
+def test_parallel_map_keeps_order():
+  # later items finish first
+  results = backend.parallel_map(lambda i: time.sleep(0.01*(5-i)) or i*i, range(5))
+  assert results == [0, 1, 4, 9, 16]
+  assert backend.parallel_map(lambda i: i, []) == []
+
+
+def fail_on_odd(i):
+  if i % 2:
+    raise ValueError(i)
+  return i
+
+
+def test_parallel_map_fail_fast():
+  started = []
+  def fn(i):
+    started.append(i)
+    time.sleep(0.05)
+    return fail_on_odd(i)
+  with pytest.raises(ValueError) as e:
+    backend.parallel_map(fn, range(6), max_workers=1)
+  # the worker may already have picked up the next item, later ones are cancelled
+  assert e.value.args == (1,) and started[:2] == [0, 1] and len(started) <= 3
+
+
+def test_parallel_map_collect_all():
+  started = []
+  def fn(i):
+    started.append(i)
+    return fail_on_odd(i)
+  with pytest.raises(backend.ParallelError) as e:
+    backend.parallel_map(fn, range(6), max_workers=2, fail_fast=False)
+  assert sorted(started) == list(range(6))
+  assert [r if isinstance(r, int) else r.args for r in e.value.results] == [0, (1,), 2, (3,), 4, (5,)]
+  assert [err.args for err in e.value.errors] == [(1,), (3,), (5,)]
+  assert '3/6 parallel calls failed' in str(e.value)
+
+  assert backend.parallel_map(fail_on_odd, [0, 2], fail_fast=False) == [0, 2]
+
+
+def main():
+  sys.exit(pytest.main([__file__]))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,259 @@
+import datetime
+import fnmatch
+import hashlib
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+module_path=os.path.dirname(os.path.abspath(__file__))
+sys.path.append(module_path+'/..')
+import util as u
+
+
+class FakeChannel:
+  def __init__(self, client):
+    self.client = client
+    self.closed = False
+
+  def close(self):
+    with self.client.lock:
+      if not self.closed:
+        self.closed = True
+        self.client.open_channels -= 1
+
+
+class FakeFile:
+  def __init__(self, channel):
+    self.channel = channel
+
+  def read(self):
+    time.sleep(0.01)
+    return b'out'
+
+
+class FakeClient:
+  """paramiko.SSHClient stand-in that counts simultaneously open channels"""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.active = True
+    self.open_channels = 0
+    self.max_open_channels = 0
+
+  def get_transport(self):
+    return self
+
+  def is_active(self):
+    return self.active
+
+  def exec_command(self, cmd, **kwargs):
+    assert self.active, "channel open failed"
+    with self.lock:
+      self.open_channels += 1
+      self.max_open_channels = max(self.max_open_channels, self.open_channels)
+    channel = FakeChannel(self)
+    return FakeFile(channel), FakeFile(channel), FakeFile(channel)
+
+  def close(self):
+    self.active = False
+
+
+def run_threads(fn, num_threads):
+  threads = [threading.Thread(target=fn) for _ in range(num_threads)]
+  for t in threads: t.start()
+  for t in threads: t.join()
+
+
+def test_ssh_session_bounds_all_exec_channels():
+  client = FakeClient()
+  session = u.SshSession(lambda: client, max_channels=3)
+
+  def exec_and_run():
+    session.run('ls')
+    with session.exec_command('tail -f log') as (stdin, stdout, stderr):
+      stdout.read()
+  run_threads(exec_and_run, 10)
+  assert client.max_open_channels == 3 and client.open_channels == 0
+  assert session.stats['channels_opened'] == 20
+
+
+def test_ssh_session_long_lived_channels_dont_block():
+  clients = []
+  def connect():
+    clients.append(FakeClient())
+    return clients[-1]
+  session = u.SshSession(connect, max_channels=2, channel_wait_sec=0.1)
+  streams = [session.exec_command('tail -f log%d'%(i,), long_lived=True)
+             for i in range(4)]
+  for stream in streams:
+    stream.__enter__()
+  assert session.run('ls') == (b'out', b'out')
+  assert len(clients) == 2 and clients[1].open_channels == 4
+  assert clients[0].open_channels == 0
+
+  # bounded channels held for good fail with a clear error instead of hanging
+  with session.exec_command('sleep 1000'), session.exec_command('sleep 1000'):
+    try:
+      session.run('ls')
+      assert False, "run should have timed out"
+    except AssertionError as e:
+      assert 'All 2 exec channels stayed busy' in str(e)
+  assert session.run('ls') == (b'out', b'out')
+  for stream in streams:
+    stream.__exit__(None, None, None)
+  assert clients[1].open_channels == 0
+
+
+def test_ssh_session_reconnects_once():
+  clients = []
+  def connect():
+    time.sleep(0.05)
+    clients.append(FakeClient())
+    return clients[-1]
+  session = u.SshSession(connect, max_channels=8)
+  clients[0].active = False
+
+  results = []
+  run_threads(lambda: results.append(session.run('ls')), 8)
+  assert results == [(b'out', b'out')]*8
+  assert len(clients) == 2 and session.stats['reconnects'] == 1
+  assert session.client is clients[1]
+
+
+def test_cached_resource(monkeypatch):
+  region = ['us-east-1']
+  calls = []
+  monkeypatch.setattr(u, 'get_region', lambda: region[0])
+
+  @u.cached_resource
+  def lookup(name=''):
+    calls.append((region[0], name))
+    return len(calls)
+
+  assert lookup() == lookup() == 1
+  assert lookup('a') == 2
+  region[0] = 'us-west-2'
+  assert lookup() == 3
+  # invalidation only drops entries of the current region
+  u.invalidate_resource_cache()
+  assert lookup() == 4
+  region[0] = 'us-east-1'
+  assert lookup() == 1
+
+  monkeypatch.setattr(u, 'RESOURCE_CACHE_TTL_SEC', 0)
+  assert lookup() == 5
+
+
+class FakeInstance:
+  def __init__(self, name, id, public_ip, private_ip, launch_hour, state='running'):
+    self.tags = [{'Key': 'Name', 'Value': name}] if name else None
+    self.id = id
+    self.public_ip_address = public_ip
+    self.private_ip_address = private_ip
+    self.launch_time = datetime.datetime(2018, 1, 1, launch_hour)
+    self.state = {'Name': state}
+    self.key_name = 'key'
+
+
+class FakeEc2:
+  """ec2 resource stand-in that applies Name and state filters like EC2 does"""
+  def __init__(self, instances):
+    self.all_instances = instances
+    self.instances = self
+    self.filter_calls = []
+
+  def filter(self, Filters):
+    self.filter_calls.append(Filters)
+    result = self.all_instances
+    for f in Filters:
+      if f['Name'] == 'tag:Name':
+        result = [i for i in result if fnmatch.fnmatchcase(u.get_name(i.tags), f['Values'][0])]
+      elif f['Name'] == 'instance-state-name':
+        result = [i for i in result if i.state['Name'] in f['Values']]
+      else:
+        assert False, f
+    return result
+
+
+def make_fake_ec2(monkeypatch):
+  ec2 = FakeEc2([
+    FakeInstance('1.worker.run', 'i-0de492df6b20c35fe', '34.1.2.3', '10.0.0.2', 3),
+    FakeInstance('0.worker.run', 'i-0aa', '34.1.2.4', '10.0.0.3', 2),
+    FakeInstance('0.ps.run', 'i-0bb', '34.1.2.5', '10.0.0.4', 1),
+    FakeInstance('0.worker.other', 'i-0cc', '34.1.2.6', '10.0.0.5', 4, state='stopped'),
+    FakeInstance('0.worker.old', 'i-0dd', '34.1.2.7', '10.0.0.6', 5, state='terminated'),
+    FakeInstance('', 'i-0ee', '34.1.2.8', '10.0.0.7', 6),
+  ])
+  monkeypatch.setattr(u, 'create_ec2_resource', lambda: ec2)
+  monkeypatch.setattr(u, 'get_region', lambda: 'us-east-1')
+  return ec2
+
+
+def test_make_instance_filters():
+  assert u.make_instance_filters() == []
+  assert u.make_instance_filters('*') == []
+  assert u.make_instance_filters('*.run', ['running']) == [
+    {'Name': 'tag:Name', 'Values': ['*.run']},
+    {'Name': 'instance-state-name', 'Values': ['running']}]
+  assert u.make_instance_filters(states=('running', 'stopped'), key_pattern='key-*') == [
+    {'Name': 'instance-state-name', 'Values': ['running', 'stopped']},
+    {'Name': 'key-name', 'Values': ['key-*']}]
+
+
+def test_instance_index(monkeypatch):
+  ec2 = make_fake_ec2(monkeypatch)
+  index = u.InstanceIndex('*.run')
+  assert ec2.filter_calls == [u.make_instance_filters('*.run', ('running', 'stopped'))]
+  assert [i.id for i in index.lookup('worker.run')] == ['i-0aa', 'i-0de492df6b20c35fe']
+  assert [i.id for i in index.lookup('ps.run')] == ['i-0bb']
+  assert index.lookup('worker.other') == []
+
+  assert [i.id for i in u.lookup_aws_instances('worker.other')] == ['i-0cc']
+  # a given index is reused without another describe call
+  assert [i.id for i in u.lookup_aws_instances('ps.run', index=index)] == ['i-0bb']
+  assert len(ec2.filter_calls) == 2
+
+
+def test_get_instances(monkeypatch):
+  ec2 = make_fake_ec2(monkeypatch)
+  def ids(fragment):
+    return [i.id for i in u.get_instances(fragment, verbose=False, filter_by_key=False)]
+
+  # most recently launched first
+  assert ids('worker.run') == ['i-0de492df6b20c35fe', 'i-0aa']
+  assert ec2.filter_calls[-1][0] == {'Name': 'tag:Name', 'Values': ['*worker.run*']}
+  assert ids('i-0bb') == ['i-0bb']
+  assert ids('10.0.0.7') == ['i-0ee']
+  assert ids('34.1.2.3') == ['i-0de492df6b20c35fe']
+  # partial id without i- prefix matches no name, so all running instances are searched
+  assert ids('492df6') == ['i-0de492df6b20c35fe']
+  assert ids('0.worker.other') == []
+  assert ids('') == ['i-0ee', 'i-0de492df6b20c35fe', 'i-0aa', 'i-0bb']
+
+
+def test_parse_sha1sum_output(tmp_path):
+  names = ['plain.txt', 'with space.txt', ' leading space', 'back\\slash', 'new\nline', 'star*']
+  for i, name in enumerate(names):
+    (tmp_path/name).write_bytes(b'contents %d'%(i,))
+  # sha1sum reports missing files on stderr, merged here like with get_pty
+  cmd = 'cd %s && sha1sum %s missing.txt 2>&1; sha1sum -b plain.txt'%(
+    tmp_path, ' '.join(shlex.quote(name) for name in names))
+  output = subprocess.run(['bash', '-c', cmd], stdout=subprocess.PIPE).stdout.decode()
+  assert 'missing.txt' in output
+
+  expected = {name: hashlib.sha1(b'contents %d'%(i,)).hexdigest() for i, name in enumerate(names)}
+  assert u.parse_sha1sum_output(output) == expected
+  assert u.parse_sha1sum_output(output.replace('\n', '\r\n')) == expected
+  assert u.parse_sha1sum_output('') == {}
+
+
+def main():
+  sys.exit(pytest.main([__file__]))
+
+
+if __name__ == "__main__":
+  main()
@@ -1,8 +1,11 @@
 # Local implementation of backend.py using separate tmux sessions for jobs
 
+import codecs
 import datetime
 import glob
 import os
+import select
+import signal
 import subprocess
 import sys
 import shlex
@@ -16,6 +19,7 @@ import backend
 import util as u
 
 TASKDIR_PREFIX='/tmp/tasklogs'
+STREAM_CHUNK_SIZE=32768  # bytes read from command output at a time in stream_output
 
 # TODO: use separate session for each task, for parity with AWS job launcher
 
@@ -87,6 +91,7 @@ class Task(backend.Task):
     self.job = job
     self.id = task_id
     self.cached_ip = None
+    self.last_run_timing = None
     self._port = portpicker.pick_unused_port()
     print("Assigning %s:%s to port %s"%(self.job.name, self.id, self.port))
     self.connect_instructions = 'tmux a -t '+self.tmux_window
@@ -113,22 +118,34 @@ class Task(backend.Task):
         self.run(line)
 
 
-  def _wait_for_file(self, fn, max_wait_sec=600, check_interval=0.02):
+  def _read_status_fifo(self, fd, cmd, max_wait_sec):
+    """Blocks until command writes its exit status into FIFO opened as fd,
+    returns status as string."""
     start_time = time.time()
+    contents = b''
     while True:
-      if time.time() - start_time > max_wait_sec:
+      remaining_sec = max_wait_sec - (time.time() - start_time)
+      if remaining_sec <= 0:
         assert False, "Timeout %s exceeded for %s" %(max_wait_sec, cmd)
-      if not self.file_exists(fn):
-        # print("check for %s returned %s, sleeping for %s"%(fn,
-        #                                                    self.file_exists(fn),
-        #                                                    check_interval))
-        time.sleep(check_interval)
+      readable, _, _ = select.select([fd], [], [], remaining_sec)
+      if not readable:
         continue
+      chunk = os.read(fd, 1024)
+      if chunk:
+        contents += chunk
+      elif contents:  # writer closed FIFO
+        return contents.decode().strip()
       else:
-        break
+        time.sleep(0.001)
 
+  def _tmux_send_keys(self, keys):
+    subprocess.check_call(['tmux', 'send-keys', '-t', self.tmux_window, keys,
+                           'Enter'])
 
-  def run(self, cmd, sync=True, ignore_errors=False):
+  def run(self, cmd, sync=True, ignore_errors=False, max_wait_sec=600):
+    """Runs command in task's tmux window. For sync commands, exit status
+    is passed back through a FIFO so completion is detected without
+    polling."""
     self._run_counter+=1
     self.log(cmd)
     cmd = cmd.strip()
@@ -145,34 +162,102 @@ class Task(backend.Task):
     
     open(cmd_in_fn, 'w').write(cmd+'\n')
     modified_cmd = '%s ; echo $? > %s'%(cmd, cmd_out_fn)
-    start_time = time.time()
-    #    time.sleep(0.01) # tmux gets confused when too many messages get sent at
-    # once
+    if sync:
+      # open reading end before sending the command so that command never
+      # blocks when writing its status. Status is written from a background
+      # subshell, so the tmux window can't get stuck on the FIFO even if
+      # nobody reads it anymore
+      modified_cmd = '%s ; (echo $? > %s &)'%(cmd, cmd_out_fn)
+      os.mkfifo(cmd_out_fn)
+      fd = os.open(cmd_out_fn, os.O_RDONLY | os.O_NONBLOCK)
+
     self.log("%s> %s"%(self.tmux_window, cmd))
-    tmux_cmd = 'tmux send-keys -t {} {} Enter'.format(self.tmux_window, shlex.quote(modified_cmd))
-    self._ossystem(tmux_cmd)
-    if not sync:
-      return
-    
-    self._wait_for_file(cmd_out_fn)
-    contents = open(cmd_out_fn).read()
-    
-    # if empty wait a bit to allow for race condition
-    if len(contents) == 0: time.sleep(0.1)
-    contents = open(cmd_out_fn).read().strip()
+    contents = None
+    try:
+      self._tmux_send_keys(modified_cmd)
+      if not sync:
+        return
+      contents = self._read_status_fifo(fd, cmd, max_wait_sec)
+    finally:
+      if sync:
+        # on timeout or error, remove the FIFO so that the late status goes
+        # into a regular file instead of waiting for a reader
+        if contents is None:
+          os.unlink(cmd_out_fn)
+        os.close(fd)
 
     if contents != '0':
       if not ignore_errors:
         assert False, "Command %s returned status %s"%(cmd, contents)
       else:
         self.log("Warning: command %s returned status %s"%(cmd, contents))
-
-  def run_and_capture_output(self, cmd, sync=True, ignore_errors=False):
-    cmd_stdout_fn  = '%s/%d.stdout'%(self.scratch, self._run_counter)
-    assert '|' not in cmd, "don't support piping (since we append piping here)"
-    cmd = f'{cmd} | tee {cmd_stdout_fn}'
-    self.run(cmd, sync, ignore_errors)
-    return self.file_read(cmd_stdout_fn)
+    return int(contents)
+
+  def stream_output(self, cmd, ignore_errors=False, max_wait_sec=600,
+                    session_env=True):
+    """Runs command in taskdir as a subprocess, yields lines of its output
+    (stdout and stderr merged) as they arrive. Command and its children are
+    killed if it doesn't finish in max_wait_sec. If session_env, command
+    sees variables exported in the task's tmux window. Exit status is saved
+    in last_run_status, timings in last_run_timing."""
+    self.log("exec> %s", cmd)
+    self.last_run_status = None
+    start_time = time.time()
+    first_output_ms = None
+    bash_cmd = cmd
+    if session_env:
+      env_fn = self.scratch+'/session.env'
+      self._save_session_env(env_fn)
+      bash_cmd = '. %s 2>/dev/null; %s'%(shlex.quote(env_fn), cmd)
+    p = subprocess.Popen(['bash', '-c', bash_cmd], cwd=self.taskdir,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                         start_new_session=True)
+    fd = p.stdout.fileno()
+    status = None
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    partial_line = ''
+    try:
+      while True:
+        remaining_sec = max_wait_sec - (time.time() - start_time)
+        assert remaining_sec > 0, "Timeout %s exceeded for %s"%(max_wait_sec,
+                                                               cmd)
+        readable, _, _ = select.select([fd], [], [], remaining_sec)
+        if not readable:
+          continue
+        data = os.read(fd, STREAM_CHUNK_SIZE)
+        if not data:
+          break
+        if first_output_ms is None:
+          first_output_ms = 1000*(time.time()-start_time)
+        lines = (partial_line + decoder.decode(data)).split('\n')
+        partial_line = lines.pop()
+        for line in lines:
+          yield line+'\n'
+      partial_line += decoder.decode(b'', final=True)
+      if partial_line:
+        yield partial_line
+      remaining_sec = max_wait_sec - (time.time() - start_time)
+      status = p.wait(timeout=max(remaining_sec, 0))
+    except subprocess.TimeoutExpired:
+      assert False, "Timeout %s exceeded for %s" %(max_wait_sec, cmd)
+    finally:
+      # on timeout or error, also kill children that may hold the output open
+      if status is None:
+        try:
+          os.killpg(p.pid, signal.SIGKILL)
+        except ProcessLookupError:
+          pass
+        p.wait()
+      p.stdout.close()
+
+    self.last_run_status = status
+    self.last_run_timing = {'first_output_ms': first_output_ms,
+                            'local_ms': 1000*(time.time()-start_time)}
+    if status != 0:
+      if not ignore_errors:
+        assert False, "Command %s returned status %s"%(cmd, status)
+      else:
+        self.log("Warning: command %s returned status %s"%(cmd, status))
     
   def _run_raw(self, cmd):
     """Runs command directly, skipping tmux interface. Use if want to create additional tmux sessions manually."""
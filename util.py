@@ -1,6 +1,9 @@
 # methods common to create_resources and delete_resources
 import os
 import argparse
+import contextlib
+import functools
+import hashlib
 import random
 import string
 import boto3
@@ -31,6 +34,8 @@ DEFAULT_UNIX_DEVICE='/dev/xvdq' # used to be /dev/xvdf
 
 EMPTY_NAME="noname"
 
+RESOURCE_CACHE_TTL_SEC=300  # how long to reuse results of describe calls
+
 def now_micros():
   """Return current micros since epoch as integer."""
   return int(time.time()*1e6)
@@ -162,13 +167,49 @@ def wait_until_available(resource):
       assert False, "Timeout exceeded waiting for %s"%(resource,)
     time.sleep(WAIT_TIMEOUT_SEC)
 
+# cache of describe results, {(region, fn_name, args): (timestamp, result)}
+_resource_cache = {}
+_resource_cache_lock = threading.RLock()
+
+def cached_resource(fn):
+  """Decorator that caches result of resource lookup function for
+  RESOURCE_CACHE_TTL_SEC, separately for each region and arguments. Use
+  invalidate_resource_cache after creating or deleting resources."""
+
+  @functools.wraps(fn)
+  def wrapper(*args):
+    key = (get_region(), fn.__name__) + args
+    # hold the lock during the lookup so concurrent callers (ie, tasks
+    # initializing in parallel) share a single describe call
+    with _resource_cache_lock:
+      entry = _resource_cache.get(key)
+      if entry and time.time() - entry[0] < RESOURCE_CACHE_TTL_SEC:
+        return entry[1]
+      result = fn(*args)
+      _resource_cache[key] = (time.time(), result)
+      return result
+  return wrapper
+
+
+def invalidate_resource_cache():
+  """Forgets all cached resource lookups for current region."""
+  region = get_region()
+  with _resource_cache_lock:
+    for key in list(_resource_cache):
+      if key[0] == region:
+        del _resource_cache[key]
+
+
+@cached_resource
 def get_vpc_dict():
   """Returns dictionary of named VPCs {name: vpc}
 
   Assert fails if there's more than one VPC with same name."""
 
   client = create_ec2_client()
-  response = client.describe_vpcs()
+  # only named VPC's are returned
+  response = client.describe_vpcs(Filters=[{'Name': 'tag-key',
+                                            'Values': ['Name']}])
   assert is_good_response(response)
 
   result = OrderedDict()
@@ -185,11 +226,14 @@ def get_vpc_dict():
   return result
 
 
+@cached_resource
 def get_security_group_dict():
   """Returns dictionary of named security groups {name: securitygroup}."""
 
   client = create_ec2_client()
-  response = client.describe_security_groups()
+  # only named security groups are returned
+  response = client.describe_security_groups(Filters=[{'Name': 'tag-key',
+                                                       'Values': ['Name']}])
   assert is_good_response(response)
 
   result = OrderedDict()
@@ -205,6 +249,7 @@ def get_security_group_dict():
   return result
 
 
+@cached_resource
 def get_placement_group_dict():
   """Returns dictionary of {placement_group_name: (state, strategy)}"""
 
@@ -224,6 +269,7 @@ def get_placement_group_dict():
   return result
 
 
+@cached_resource
 def get_keypair_dict():
   """Returns dictionary of {keypairname: keypair}"""
   
@@ -240,6 +286,7 @@ def get_keypair_dict():
   return result
   
 
+@cached_resource
 def get_efs_dict():
   """Returns dictionary of {efs_name: efs_id}"""
   # there's no EC2 resource for EFS objects, so return EFS_ID instead
@@ -251,9 +298,14 @@ def get_efs_dict():
   result = OrderedDict()
   for efs_response in response['FileSystems']:
     fs_id = efs_response['FileSystemId']
-    tag_response = efs_client.describe_tags(FileSystemId=fs_id)
-    assert u.is_good_response(tag_response)
-    key = u.get_name(tag_response['Tags'])
+    # describe_file_systems includes value of Name tag, only fall back on
+    # per-filesystem describe_tags for responses that lack it
+    if 'Name' in efs_response:
+      key = efs_response['Name']
+    else:
+      tag_response = efs_client.describe_tags(FileSystemId=fs_id)
+      assert u.is_good_response(tag_response)
+      key = u.get_name(tag_response['Tags'])
     if not key or key==EMPTY_NAME:   # skip EFS's without a name
       continue
     assert key not in result
@@ -312,6 +364,7 @@ def create_efs(name):
   assert is_good_response(response)
 
   # make sure EFS is now visible
+  invalidate_resource_cache()
   efs_dict = get_efs_dict()
   assert name in efs_dict
   return efs_dict[name]
@@ -458,13 +511,20 @@ def get_mount_targets_list(efs_id):
     
   return result
 
+@cached_resource
 def get_subnet_dict(vpc):
   """Returns dictionary of "availability zone" -> subnet for given VPC."""
+  client = create_ec2_client()
+  response = client.describe_subnets(Filters=[{'Name': 'vpc-id',
+                                               'Values': [vpc.id]}])
+  assert is_good_response(response)
+
+  ec2 = create_ec2_resource()
   subnet_dict = {}
-  for subnet in vpc.subnets.all():
-    zone = subnet.availability_zone
+  for subnet_response in response['Subnets']:
+    zone = subnet_response['AvailabilityZone']
     assert zone not in subnet_dict, "More than one subnet in %s, why?" %(zone,)
-    subnet_dict[zone] = subnet
+    subnet_dict[zone] = ec2.Subnet(subnet_response['SubnetId'])
   return subnet_dict
 
 
@@ -676,29 +736,64 @@ def _StreamOutputToStdout(fd):  # todo: pep convention
   
   return t
 
-def lookup_aws_instances(job_name, states=['running', 'stopped']):
-  """Returns all AWS instances for given AWS job name, like
-   simple.worker"""
+def make_instance_filters(name_pattern='', states=None, key_pattern=''):
+  """Returns EC2 Filters argument matching instances whose Name tag matches
+  wildcard name_pattern, ie "*.worker.simple", and which are in one of given
+  states. Empty pattern matches everything, including unnamed instances."""
+  filters = []
+  if name_pattern and name_pattern != '*':
+    filters.append({'Name': 'tag:Name', 'Values': [name_pattern]})
+  if states:
+    filters.append({'Name': 'instance-state-name', 'Values': list(states)})
+  if key_pattern:
+    filters.append({'Name': 'key-name', 'Values': [key_pattern]})
+  return filters
+
+
+class InstanceIndex:
+  """Index of {job_name: [instance, ...]} for instances named like
+  "taskid.role.run", with instances of each job ordered by task id.
+
+  Built from a single describe call filtered on server side by name_pattern,
+  so reuse the same index for lookups of several jobs, ie
+    index = InstanceIndex('*.'+run_name)
+    index.lookup('worker.'+run_name)
+  """
 
-  #  print("looking up", job_name)
+  def __init__(self, name_pattern='*', states=('running', 'stopped')):
+    ec2 = u.create_ec2_resource()
+    # TODO: add waiting so that instances in state "initializing" are supported
+    instances = ec2.instances.filter(
+      Filters=make_instance_filters(name_pattern, states))
 
-  # todo: assert fail when there are multiple instances with same name?
-  ec2 = u.create_ec2_resource()
+    self.jobs = OrderedDict()
+    for i in instances:
+      task_id, job_name = u.get_parsed_job_name(i.tags)
+      if job_name is None:
+        continue
+      self.jobs.setdefault(job_name, []).append((task_id, i))
 
-  # TODO: add waiting so that instances in state "initializing" are supported
-  instances = ec2.instances.filter(
-    Filters=[{'Name': 'instance-state-name', 'Values': states}])
+    for job_name in self.jobs:
+      self.jobs[job_name].sort(key=itemgetter(0))
+
+  def lookup(self, job_name):
+    """Returns instances of given job name, ordered by task id."""
+    return [i for task_id, i in self.jobs.get(job_name, [])]
 
-  result = []
-  for i in instances.all():
-    task_id, current_job_name = u.get_parsed_job_name(i.tags)
-    # print("Obtained job name", current_job_name, "task", task_id)
 
-    if current_job_name == job_name:
-      result.append(i)
+def lookup_aws_instances(job_name, states=['running', 'stopped'],
+                         index=None):
+  """Returns all AWS instances for given AWS job name, like
+   simple.worker, ordered by task id. If index (InstanceIndex) is given,
+   uses it instead of querying AWS."""
 
+  #  print("looking up", job_name)
 
-  return result
+  # todo: assert fail when there are multiple instances with same name?
+  if index is None:
+    # task names look like 0.simple.worker
+    index = InstanceIndex('*.'+job_name, states)
+  return index.lookup(job_name)
 
 def lookup_volume(name):
   """Looks up volume matching given name or id."""
@@ -726,6 +821,7 @@ def maybe_create_placement_group(name='', max_retries=10):
   except boto3.exceptions.botocore.exceptions.ClientError as e:
     print("Creating placement group: "+name)
     res = client.create_placement_group(GroupName=name, Strategy='cluster')
+    invalidate_resource_cache()
 
   counter = 0
   while True:
@@ -805,6 +901,228 @@ def ssh_to_host(hostname,
 
   return ssh_client
 
+class SshSession:
+  """Long-lived SSH connection to a single host shared by all file and
+  command operations of a task.
+
+  Keeps one persistent SFTP session and limits number of concurrently open
+  exec channels to max_channels, so that together with the SFTP channel they
+  stay under sshd's MaxSessions (10 by default). Long-lived channels (ie,
+  tail -f) go to a second connection instead, so they can't use up the
+  channels of other commands. If the underlying transport drops, the
+  connection is recreated with connect_fn on next use, once no matter how
+  many threads noticed the drop.
+
+  Args:
+    connect_fn: function that returns connected paramiko.SSHClient
+    max_channels: maximum number of simultaneously open exec channels
+    channel_wait_sec: how long to wait for a free channel before failing
+
+  Counters for opened channels, transferred bytes and reconnects are kept in
+  stats dictionary.
+  """
+
+  def __init__(self, connect_fn, max_channels=8, channel_wait_sec=600):
+    self._connect_fn = connect_fn
+    self._lock = threading.RLock()
+    self._channel_semaphore = threading.BoundedSemaphore(max_channels)
+    self.max_channels = max_channels
+    self.channel_wait_sec = channel_wait_sec
+    self._sftp = None
+    self._long_lived_client = None  # connection of long-lived exec channels
+    self._generation = 0  # incremented by every reconnect
+    self.client = None
+    self.stats = {'channels_opened': 0, 'bytes_sent': 0,
+                  'bytes_received': 0, 'reconnects': 0}
+    self.client = self._connect_fn()
+
+  def is_active(self):
+    transport = self.client.get_transport() if self.client else None
+    return transport is not None and transport.is_active()
+
+  def reconnect(self, generation=None):
+    """Drops current connection and connects again. If generation is given
+    and the connection was already recreated since then by another thread,
+    does nothing."""
+    with self._lock:
+      if generation is not None and generation != self._generation:
+        return
+      print("SshSession: connection dropped, reconnecting")
+      try:
+        self.client.close()
+      except Exception:
+        pass
+      self._sftp = None
+      self.client = self._connect_fn()
+      self._generation += 1
+      self.stats['reconnects'] += 1
+
+  def _ensure_connected(self):
+    generation = self._generation
+    if not self.is_active():
+      self.reconnect(generation)
+
+  @property
+  def sftp(self):
+    """Returns persistent SFTP session, opening it if needed."""
+    with self._lock:
+      self._ensure_connected()
+      if self._sftp is None:
+        self._sftp = self.client.open_sftp()
+        self.stats['channels_opened'] += 1
+      return self._sftp
+
+  def _retry_on_disconnect(self, fn):
+    """Calls fn, if it failed because connection dropped, reconnects and
+    calls fn again. Other errors (ie, missing file) are propagated."""
+    generation = self._generation
+    try:
+      return fn()
+    except Exception:
+      if self.is_active() and generation == self._generation:
+        raise
+    self.reconnect(generation)
+    return fn()
+
+  def put(self, local_fn, remote_fn):
+    def _put():
+      with self._lock:
+        self.sftp.put(local_fn, remote_fn)
+    self._retry_on_disconnect(_put)
+    self.stats['bytes_sent'] += os.path.getsize(local_fn)
+
+  def put_dir(self, local_dir, remote_dir):
+    def _put_dir():
+      with self._lock:
+        put_dir(self.sftp, local_dir, remote_dir)
+    self._retry_on_disconnect(_put_dir)
+    for root, dirs, files in os.walk(local_dir):
+      for fn in files:
+        self.stats['bytes_sent'] += os.path.getsize(os.path.join(root, fn))
+
+  def get(self, remote_fn, local_fn):
+    def _get():
+      with self._lock:
+        self.sftp.get(remote_fn, local_fn)
+    self._retry_on_disconnect(_get)
+    self.stats['bytes_received'] += os.path.getsize(local_fn)
+
+  def read(self, remote_fn):
+    """Returns contents of remote file as bytes."""
+    def _read():
+      with self._lock:
+        with self.sftp.open(remote_fn, 'rb') as f:
+          return f.read()
+    contents = self._retry_on_disconnect(_read)
+    self.stats['bytes_received'] += len(contents)
+    return contents
+
+  def write(self, remote_fn, contents):
+    """Writes string or bytes to remote file."""
+    if isinstance(contents, str):
+      contents = contents.encode()
+    def _write():
+      with self._lock:
+        with self.sftp.open(remote_fn, 'wb') as f:
+          f.write(contents)
+    self._retry_on_disconnect(_write)
+    self.stats['bytes_sent'] += len(contents)
+
+  @contextlib.contextmanager
+  def open(self, remote_fn, mode='rb'):
+    """Opens remote file through the persistent SFTP session. Other file
+    operations of this session wait until the file is closed."""
+    with self._lock:
+      f = self._retry_on_disconnect(lambda: self.sftp.open(remote_fn, mode))
+      try:
+        yield f
+      finally:
+        f.close()
+
+  def write_blocks(self, remote_fn, blocks, size):
+    """Overwrites given blocks of existing remote file and truncates it to
+    size. blocks is a list of (offset, bytes)."""
+    def _write_blocks():
+      with self._lock:
+        with self.sftp.open(remote_fn, 'r+b') as f:
+          for offset, data in blocks:
+            f.seek(offset)
+            f.write(data)
+          f.truncate(size)
+    self._retry_on_disconnect(_write_blocks)
+    self.stats['bytes_sent'] += sum(len(data) for offset, data in blocks)
+
+  def exists(self, remote_fn):
+    def _stat():
+      with self._lock:
+        self.sftp.stat(remote_fn)
+    try:
+      self._retry_on_disconnect(_stat)
+      return True
+    except IOError:
+      return False
+
+  def _get_long_lived_client(self):
+    with self._lock:
+      client = self._long_lived_client
+      transport = client.get_transport() if client else None
+      if transport is None or not transport.is_active():
+        self._long_lived_client = self._connect_fn()
+      return self._long_lived_client
+
+  @contextlib.contextmanager
+  def exec_command(self, cmd, long_lived=False, **kwargs):
+    """Opens new exec channel, same arguments as
+    paramiko.SSHClient.exec_command, yields (stdin, stdout, stderr). The
+    channel counts towards max_channels until the with block exits, which
+    closes it. Waits up to channel_wait_sec if max_channels are already in
+    use. long_lived channels, which stay open for the life of a task, are
+    opened on a separate connection and not counted."""
+    if long_lived:
+      stdin, stdout, stderr = self._get_long_lived_client().exec_command(
+        cmd, **kwargs)
+    else:
+      if not self._channel_semaphore.acquire(timeout=self.channel_wait_sec):
+        assert False, ("All %d exec channels stayed busy for %s seconds, "
+                       "running %s" % (self.max_channels,
+                                       self.channel_wait_sec, cmd))
+      try:
+        self._ensure_connected()
+        stdin, stdout, stderr = self._retry_on_disconnect(
+          lambda: self.client.exec_command(cmd, **kwargs))
+      except BaseException:
+        self._channel_semaphore.release()
+        raise
+    self.stats['channels_opened'] += 1
+    try:
+      yield stdin, stdout, stderr
+    finally:
+      try:
+        stdout.channel.close()
+      finally:
+        if not long_lived:
+          self._channel_semaphore.release()
+
+  def run(self, cmd, get_pty=False, timeout=None):
+    """Runs cmd to completion in an exec channel, returns stdout/stderr as
+    bytes. Blocks if max_channels are already in use."""
+    with self.exec_command(cmd, get_pty=get_pty,
+                           timeout=timeout) as (stdin, stdout, stderr):
+      stdout_bytes = stdout.read()
+      stderr_bytes = stderr.read()
+    self.stats['bytes_received'] += len(stdout_bytes) + len(stderr_bytes)
+    return stdout_bytes, stderr_bytes
+
+  def close(self):
+    with self._lock:
+      if self._sftp is not None:
+        self._sftp.close()
+        self._sftp = None
+      self.client.close()
+      if self._long_lived_client is not None:
+        self._long_lived_client.close()
+
+
 # TODO: inversion procedure is incorrect
 # TODO: probably want to be seconds in local time zone instead
 def seconds_from_datetime(dt):
@@ -854,6 +1172,61 @@ def put_dir(sftp, source, target):
       put_dir(sftp, os.path.join(source, item), '%s/%s' % (target, item))
 
 
+_sha1_cache = {}  # {(path, size, mtime): sha1}
+
+def file_sha1(fn):
+  """Returns sha1 hexdigest of file contents. Digests are cached by path,
+  size and modification time so repeated uploads don't rehash files."""
+  st = os.stat(fn)
+  key = (os.path.abspath(fn), st.st_size, st.st_mtime_ns)
+  if key not in _sha1_cache:
+    sha1 = hashlib.sha1()
+    with open(fn, 'rb') as f:
+      for block in iter(lambda: f.read(1<<20), b''):
+        sha1.update(block)
+    _sha1_cache[key] = sha1.hexdigest()
+  return _sha1_cache[key]
+
+
+def block_sha1s(fn, block_size):
+  """Returns list of sha1 hexdigests of consecutive block_size blocks of
+  file."""
+  result = []
+  with open(fn, 'rb') as f:
+    for block in iter(lambda: f.read(block_size), b''):
+      result.append(hashlib.sha1(block).hexdigest())
+  return result
+
+
+def list_files(dirname):
+  """Returns relative paths of all files under dirname."""
+  result = []
+  for root, dirs, files in os.walk(dirname):
+    for fn in files:
+      result.append(os.path.relpath(os.path.join(root, fn), dirname))
+  return sorted(result)
+
+
+def parse_sha1sum_output(output):
+  """Parses output of sha1sum into {path: sha1}. Paths may contain spaces.
+  Names that sha1sum escaped (line starts with \\, ie for names with
+  newlines or backslashes) are unescaped. Other lines, ie error messages
+  about missing files, are skipped."""
+  unescape = {'\\': '\\', 'n': '\n', 'r': '\r'}
+  result = {}
+  for line in output.split('\n'):
+    # "<sha1>  <path>", or "<sha1> *<path>" for binary mode
+    m = re.match(r'(\\?)([0-9a-f]{40}) [ *](.*)$', line.rstrip('\r'))
+    if not m:
+      continue
+    escaped, sha1, path = m.groups()
+    if escaped:
+      path = re.sub(r'\\(.)', lambda e: unescape.get(e.group(1), e.group(0)),
+                    path)
+    result[path] = sha1
+  return result
+
+
 def chunks(l, n):
   """Yield successive n-sized chunks from l."""
   for i in range(0, len(l), n):
@@ -884,26 +1257,32 @@ def get_instances(fragment, verbose=True, filter_by_key=True):
         user's default key
   """
 
-  from tzlocal import get_localzone # $ pip install tzlocal
-
-
   def vprint(*args):
     if verbose: print(*args)
     
   region = u.get_region()
-  client = u.create_ec2_client()
   ec2 =u.create_ec2_resource()
-  response = client.describe_instances()
-    
+
+  def matching_instances(name_pattern):
+    instances = ec2.instances.filter(
+      Filters=make_instance_filters(name_pattern, states=['running']))
+    instance_list = []
+    for instance in instances:
+      name = u.get_name(instance.tags)
+      if (fragment in name or fragment in instance.public_ip_address or
+          fragment in instance.id or fragment in instance.private_ip_address):
+        instance_list.append((toseconds(instance.launch_time), instance))
+    return instance_list
+
+  # most lookups are by name, so filter by name on the server first. If
+  # nothing matches, fragment may be a part of id or ip address, so fall
+  # back to matching it against all running instances
   instance_list = []
-  for instance in ec2.instances.all():
-    if instance.state['Name'] != 'running':
-      continue
-    
-    name = u.get_name(instance.tags)
-    if (fragment in name or fragment in instance.public_ip_address or
-        fragment in instance.id or fragment in instance.private_ip_address):
-      instance_list.append((toseconds(instance.launch_time), instance))
+  if fragment and not (fragment.startswith('i-') or
+                       re.match('^[0-9.]+$', fragment)):
+    instance_list = matching_instances('*%s*'%(fragment,))
+  if not instance_list:
+    instance_list = matching_instances('')
 
   sorted_instance_list = reversed(sorted(instance_list, key=itemgetter(0)))
   cmd = ''